@@ -1,25 +1,96 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, Request, render_template, request, redirect, url_for, flash, session, jsonify, send_file, g
+from flask import abort
+from flask import Response, has_request_context, stream_with_context, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
-from datetime import datetime
-from functools import wraps
+from datetime import datetime, date as date_type, time as time_type, timedelta
+from functools import wraps, lru_cache
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import json
+import logging
+import mimetypes
+import multiprocessing
 import os
+import re
+import sqlite3
+import tempfile
+import threading
+import timeit
+import uuid
+import zipfile
+from time import monotonic, perf_counter
+import click
+import jinja2
+from jinja2 import nodes
+from jinja2.ext import Extension
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
+from python_http_client.exceptions import HTTPError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.schema import CreateIndex
+import file_processing
+
+try:
+    import numpy as np
+except ImportError:  # optional: lab trend analytics fall back to pure Python
+    np = None
 
 
 app = Flask(__name__)
-print(f" SENDGRID_API_KEY in environment: {bool(os.environ.get('SENDGRID_API_KEY'))}")
-if os.environ.get('SENDGRID_API_KEY'):
-    key = os.environ.get('SENDGRID_API_KEY')
-    print(f" API Key starts with: {key[:10]}...")
-    print(f" API Key length: {len(key)}")
-else:
+if not os.environ.get('SENDGRID_API_KEY'):
     print("SENDGRID_API_KEY not found in environment variables!")
 
 app.config['SENDGRID_API_KEY'] = os.environ.get('SENDGRID_API_KEY')
+app.config['EMAIL_FROM'] = os.environ.get('EMAIL_FROM', 's.kayitare@alustudent.com')
+app.config['EMAIL_TRANSPORT'] = os.environ.get('EMAIL_TRANSPORT', 'sendgrid')
+app.config['EMAIL_WORKER_THREADS'] = int(os.environ.get('EMAIL_WORKER_THREADS', 1))
+app.config['EMAIL_BATCH_SIZE'] = int(os.environ.get('EMAIL_BATCH_SIZE', 50))
+app.config['EMAIL_MAX_ATTEMPTS'] = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5))
+app.config['EMAIL_RETRY_BASE_SECONDS'] = int(os.environ.get('EMAIL_RETRY_BASE_SECONDS', 30))
+app.config['EMAIL_FAKE_DIR'] = os.environ.get('EMAIL_FAKE_DIR')
+app.config['REMINDER_LEAD_HOURS'] = int(os.environ.get('REMINDER_LEAD_HOURS', 24))
+app.config['REMINDER_BATCH_SIZE'] = int(os.environ.get('REMINDER_BATCH_SIZE', 1000))
+app.config['REMINDER_INTERVAL_SECONDS'] = int(os.environ.get('REMINDER_INTERVAL_SECONDS', 300))
+app.config['DOCTOR_STATS_CACHE_TTL'] = int(os.environ.get('DOCTOR_STATS_CACHE_TTL', 60))
+app.config['CARE_ACCESS_DAYS'] = int(os.environ.get('CARE_ACCESS_DAYS', 0))
+app.config['CARE_ACCESS_CACHE_TTL'] = int(os.environ.get('CARE_ACCESS_CACHE_TTL', 30))
+app.config['LAB_TREND_CACHE_TTL'] = int(os.environ.get('LAB_TREND_CACHE_TTL', 600))
+app.config['LAB_TREND_WINDOW'] = int(os.environ.get('LAB_TREND_WINDOW', 3))
+app.config['USER_PROFILE_CACHE_TTL'] = int(os.environ.get('USER_PROFILE_CACHE_TTL', 300))
+app.config['USER_PROFILE_CACHE_SIZE'] = int(os.environ.get('USER_PROFILE_CACHE_SIZE', 4096))
+app.config['FRAGMENT_CACHE_MB'] = int(os.environ.get('FRAGMENT_CACHE_MB', 32))
+app.config['REQUEST_LOG'] = os.environ.get('REQUEST_LOG', '1') == '1'
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_THREADS'] = int(os.environ.get('PASSWORD_HASH_THREADS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 32))
+app.config['LOGIN_THROTTLE_WINDOW'] = int(os.environ.get('LOGIN_THROTTLE_WINDOW', 900))
+app.config['LOGIN_MAX_FAILURES_PER_ACCOUNT'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_ACCOUNT', 5))
+app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 50))
+# Reverse proxies (nginx, a load balancer) in front of the app whose X-Forwarded-* headers are trusted
+app.config['TRUSTED_PROXY_COUNT'] = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+app.config['IMPORT_API_TOKEN'] = os.environ.get('IMPORT_API_TOKEN')
+app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+app.config['IMPORT_COMMIT_ROWS'] = int(os.environ.get('IMPORT_COMMIT_ROWS', 20000))
 app.config['SECRET_KEY'] = 'evuraqwertysecretkey'
+if app.config['TRUSTED_PROXY_COUNT']:
+    # request.remote_addr becomes the client's address instead of the proxy's, so the
+    # per-IP login throttle and the request log see real clients
+    proxies = app.config['TRUSTED_PROXY_COUNT']
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
 DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///evura.db')
 if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
     DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
@@ -27,22 +98,232 @@ if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# DATABASE ENGINE
+# Pool settings apply to Postgres; SQLite connections get the pragmas below instead
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_STATEMENT_CACHE_SIZE'] = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 1000))
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'wal').upper()
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'normal').upper()
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_MMAP_MB'] = int(os.environ.get('SQLITE_MMAP_MB', 256))
+app.config['SQLITE_CACHE_MB'] = int(os.environ.get('SQLITE_CACHE_MB', 64))
+
+SQLITE_JOURNAL_MODES = {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'}
+SQLITE_SYNCHRONOUS_LEVELS = {'OFF', 'NORMAL', 'FULL', 'EXTRA'}
+
+def database_engine_options(url):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database"""
+    url = make_url(url)
+    # Compiled SQL is cached per engine, so repeated queries skip SQL compilation
+    options = {'query_cache_size': app.config['DB_STATEMENT_CACHE_SIZE']}
+    if url.get_backend_name() == 'sqlite':
+        # pysqlite keeps prepared statements per connection; a bigger cache covers every hot query
+        options['connect_args'] = {'cached_statements': app.config['DB_STATEMENT_CACHE_SIZE']}
+    else:
+        options.update(pool_size=app.config['DB_POOL_SIZE'], max_overflow=app.config['DB_MAX_OVERFLOW'],
+                       pool_timeout=app.config['DB_POOL_TIMEOUT'], pool_recycle=app.config['DB_POOL_RECYCLE'],
+                       pool_pre_ping=app.config['DB_POOL_PRE_PING'])
+    return options
+
+def sqlite_pragmas():
+    """Pragmas run on every new SQLite connection"""
+    journal_mode = app.config['SQLITE_JOURNAL_MODE']
+    synchronous = app.config['SQLITE_SYNCHRONOUS']
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ValueError(f'SQLITE_JOURNAL_MODE must be one of {sorted(SQLITE_JOURNAL_MODES)}')
+    if synchronous not in SQLITE_SYNCHRONOUS_LEVELS:
+        raise ValueError(f'SQLITE_SYNCHRONOUS must be one of {sorted(SQLITE_SYNCHRONOUS_LEVELS)}')
+    return [
+        # Set first, so workers starting together wait for each other's journal mode switch
+        f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}",
+        # WAL lets readers carry on while one worker writes, instead of locking the whole file
+        f'PRAGMA journal_mode={journal_mode}',
+        # NORMAL is durable in WAL mode except for the last commits on power loss
+        f'PRAGMA synchronous={synchronous}',
+        f"PRAGMA mmap_size={app.config['SQLITE_MMAP_MB'] * 1024 * 1024}",
+        # Negative cache_size is in KiB rather than pages
+        f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_MB'] * 1024}",
+    ]
+
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database_engine_options(DATABASE_URL)
+
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
 
 # File upload configuration
-UPLOAD_FOLDER = 'uploads'
+# Absolute, so file paths mean the same thing to send_file as to the blob store wherever the server starts
+UPLOAD_FOLDER = os.path.join(app.root_path, 'uploads')
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'dcm', 'doc', 'docx'}
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 
+# Uploads stream to disk, so the limit only bounds disk use (DICOM/MRI studies run to gigabytes).
+# It applies to the views marked @large_upload; every other request keeps the small MAX_REQUEST_MB.
+app.config['MAX_UPLOAD_MB'] = int(os.environ.get('MAX_UPLOAD_MB', 2048))
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_REQUEST_MB', 16)) * 1024 * 1024
+# Hand file bodies to the front-end server: '' (serve from Flask), 'x-sendfile' (Apache/lighttpd)
+# or 'x-accel-redirect' (nginx, with FILE_OFFLOAD_PREFIX as an internal location aliased to uploads/)
+app.config['FILE_OFFLOAD'] = os.environ.get('FILE_OFFLOAD', '').lower()
+app.config['FILE_OFFLOAD_PREFIX'] = os.environ.get('FILE_OFFLOAD_PREFIX', '/protected-uploads/')
+# Thumbnails and previews are made by worker processes after the upload commits; 0 starts none
+# in the web process, leaving the work to `flask process-files`
+app.config['FILE_PROCESSING_WORKERS'] = int(os.environ.get('FILE_PROCESSING_WORKERS', 2))
+app.config['FILE_PROCESSING_BATCH_SIZE'] = int(os.environ.get('FILE_PROCESSING_BATCH_SIZE', 8))
+app.config['THUMBNAIL_PX'] = int(os.environ.get('THUMBNAIL_PX', 320))
+app.config['PREVIEW_PX'] = int(os.environ.get('PREVIEW_PX', 1280))
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# MEDICAL FILE STORAGE
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+class HashingUploadFile:
+    """Temp file in the blob store that hashes everything written into it.
+
+    The form parser streams each uploaded part straight into one of these, so a
+    file is written to disk once, in chunks, and its SHA-256 is known when the
+    upload ends. Unless the blob store takes it over, the file is deleted on close.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='upload-', suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+        self.persisted = False
+
+    def write(self, data):
+        self._sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def close(self):
+        self._file.close()
+        if not self.persisted and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class BlobStore:
+    """Content-addressed file store: each blob lives once at <root>/ab/cd/<sha256>"""
+
+    def __init__(self, root):
+        self.root = root
+        self.temp_dir = os.path.join(root, 'tmp')
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def put_upload(self, upload):
+        """Move a finished HashingUploadFile into place; returns (sha256, size)"""
+        upload.flush()
+        digest = upload.hexdigest()
+        target = self.path_for(digest)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(upload.path, target)
+            upload.persisted = True
+        return digest, upload.size
+
+    def put_stream(self, stream):
+        """Copy any readable stream into the store in chunks; returns (sha256, size)"""
+        upload = HashingUploadFile(self.temp_dir)
+        try:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+                upload.write(chunk)
+            return self.put_upload(upload)
+        finally:
+            upload.close()
+
+    def put_file_storage(self, file_storage):
+        """Store a werkzeug FileStorage, reusing the parser's temp file when it is ours"""
+        if isinstance(file_storage.stream, HashingUploadFile):
+            return self.put_upload(file_storage.stream)
+        return self.put_stream(file_storage.stream)
+
+blob_store = BlobStore(os.path.join(UPLOAD_FOLDER, 'blobs'))
+PREVIEW_FOLDER = os.path.join(UPLOAD_FOLDER, 'previews')
+
+class MedicalUploadRequest(Request):
+    """Streams uploaded files into the blob store instead of spooling them in memory"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingUploadFile(blob_store.temp_dir)
+
+app.request_class = MedicalUploadRequest
+
+def medical_file_path(medical_file):
+    """Where a MedicalFile's bytes live: the blob store, or the flat uploads/ folder for legacy rows"""
+    if medical_file.sha256:
+        return blob_store.path_for(medical_file.sha256)
+    return os.path.join(app.config['UPLOAD_FOLDER'], medical_file.filename)
+
+def medical_file_preview_path(medical_file, size):
+    """Where the 'thumbnail' or 'preview' JPEG of a file lives; blobs share them by content"""
+    if medical_file.sha256:
+        digest = medical_file.sha256
+        return os.path.join(PREVIEW_FOLDER, digest[:2], digest[2:4], f'{digest}-{size}.jpg')
+    return os.path.join(PREVIEW_FOLDER, 'legacy', f'{medical_file.id}-{size}.jpg')
+
+def send_medical_file(medical_file):
+    """Download response with conditional GET and Range support.
+
+    Blobs get their SHA-256 as a strong ETag, so a cached copy is answered with
+    304 and an interrupted scan download resumes with a Range request. Responses
+    are private and revalidated on every use because access can be revoked.
+    """
+    path = medical_file_path(medical_file)
+    etag = medical_file.sha256 or True
+    offload = app.config['FILE_OFFLOAD']
+
+    if offload in ('x-sendfile', 'x-accel-redirect'):
+        # The front-end server streams the body and answers Range requests itself
+        response = app.response_class(mimetype=mimetypes.guess_type(medical_file.original_filename)[0]
+                                      or 'application/octet-stream')
+        if offload == 'x-sendfile':
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        else:
+            relative = os.path.relpath(path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = app.config['FILE_OFFLOAD_PREFIX'].rstrip('/') + '/' + relative
+        response.headers.set('Content-Disposition', 'attachment', filename=medical_file.original_filename)
+        response.set_etag(medical_file.sha256 or f'{os.path.getmtime(path):.0f}-{os.path.getsize(path)}')
+        response.last_modified = os.path.getmtime(path)
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            response.headers.pop('X-Sendfile', None)
+            response.headers.pop('X-Accel-Redirect', None)
+    else:
+        response = send_file(os.path.abspath(path), as_attachment=True, download_name=medical_file.original_filename,
+                             etag=etag, conditional=True)
+
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
 class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
@@ -56,9 +337,13 @@ class Patient(db.Model):
     chronic_conditions = db.Column(db.Text)  
     emergency_contact = db.Column(db.String(20))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped whenever the patient's profile or records change; part of every cached fragment key
+    records_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     
     appointments = db.relationship('Appointment', backref='patient', lazy=True, foreign_keys='Appointment.patient_id')
     records = db.relationship('MedicalRecord', backref='patient', lazy=True)
+    conditions = db.relationship('ChronicCondition', secondary='patient_condition', lazy=True,
+                                 order_by='ChronicCondition.name')
 
     def has_chronic_conditions(self):
         return bool(self.chronic_conditions and self.chronic_conditions.strip())
@@ -78,18 +363,101 @@ class Doctor(db.Model):
     appointments = db.relationship('Appointment', backref='doctor', lazy=True, foreign_keys='Appointment.doctor_id')
     records = db.relationship('MedicalRecord', backref='doctor', lazy=True)
 
+    # Doctor search matches case-insensitive prefixes, so index the lowered values
+    __table_args__ = (
+        db.Index('ix_doctor_username_lower', db.func.lower(username)),
+        db.Index('ix_doctor_specialization_lower', db.func.lower(specialization), years_experience),
+        db.Index('ix_doctor_hospital_lower', db.func.lower(hospital)),
+        db.Index('ix_doctor_years_experience', years_experience),
+    )
+
+# A doctor's slot is taken while an appointment in it is pending or confirmed.
+# Kept as SQL text so the partial index predicate and queries match literally.
+ACTIVE_SLOT_SQL = "status IN ('pending', 'confirmed')"
+REMINDER_DUE_SQL = "status = 'confirmed' AND reminder_sent_at IS NULL"
+
 class Appointment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
     date = db.Column(db.String(20), nullable=False)
     time = db.Column(db.String(10), nullable=False)
+    slot_date = db.Column(db.Date, nullable=True)
+    slot_time = db.Column(db.Time, nullable=True)
     reason = db.Column(db.Text)
     status = db.Column(db.String(20), default='pending') 
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    reminder_sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_appointment_doctor_created', 'doctor_id', 'created_at', 'id'),
+        db.Index('ix_appointment_patient_created', 'patient_id', 'created_at', 'id'),
+        db.Index('ix_appointment_doctor_status', 'doctor_id', 'status'),
+        db.Index('ix_appointment_doctor_slot', 'doctor_id', 'date', 'time'),
+        # Double booking is rejected by the database, not by a check-then-insert
+        db.Index('uq_appointment_active_slot', 'doctor_id', 'slot_date', 'slot_time', unique=True,
+                 sqlite_where=db.text(ACTIVE_SLOT_SQL), postgresql_where=db.text(ACTIVE_SLOT_SQL)),
+        # Only confirmed appointments still owed a reminder, so the scheduler's range scan stays small
+        db.Index('ix_appointment_reminder_due', 'slot_date', 'slot_time', 'id',
+                 sqlite_where=db.text(REMINDER_DUE_SQL), postgresql_where=db.text(REMINDER_DUE_SQL)),
+    )
+
+class DoctorWorkingHours(db.Model):
+    """Weekly blocks of time in which a doctor accepts bookings"""
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    weekday = db.Column(db.Integer, nullable=False)  # 0 = Monday
+    start_time = db.Column(db.Time, nullable=False)
+    end_time = db.Column(db.Time, nullable=False)
+    slot_minutes = db.Column(db.Integer, default=30, nullable=False)
+
+    __table_args__ = (db.Index('ix_working_hours_doctor_weekday', 'doctor_id', 'weekday'),)
+
+class DoctorStats(db.Model):
+    """Per-doctor appointment counters, kept up to date as appointments change"""
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), primary_key=True)
+    total_appointments = db.Column(db.Integer, default=0, nullable=False)
+    completed_appointments = db.Column(db.Integer, default=0, nullable=False)
+    total_patients = db.Column(db.Integer, default=0, nullable=False)
+
+class DoctorPatientLink(db.Model):
+    """Appointments per doctor/patient pair; a new row means a new patient for the doctor"""
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    appointment_count = db.Column(db.Integer, default=0, nullable=False)
+
+class CareAccessGrant(db.Model):
+    """A doctor's access to a patient's records, granted by booking and renewed on confirmation"""
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    granted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=True)  # NULL: until revoked
+    revoked_at = db.Column(db.DateTime, nullable=True)
+
+    doctor = db.relationship('Doctor')
+
+    __table_args__ = (db.Index('uq_care_access_grant_doctor_patient', 'doctor_id', 'patient_id', unique=True),)
+
+class ChronicCondition(db.Model):
+    """One entry per distinct chronic condition, matched on its normalized name"""
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(200), nullable=False)  # lowercased, whitespace collapsed
+    name = db.Column(db.String(200), nullable=False)
+
+    __table_args__ = (db.Index('uq_chronic_condition_key', 'key', unique=True),)
+
+class PatientCondition(db.Model):
+    """Chronic conditions a patient lists on their profile"""
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('chronic_condition.id'), primary_key=True)
+
+    __table_args__ = (db.Index('ix_patient_condition_condition', 'condition_id', 'patient_id'),)
 
 # Medical Records Models for later usage in patient history
+FILE_QUEUE_SQL = "processing_status IN ('pending', 'processing')"
+
 class MedicalFile(db.Model):
     """Store uploaded medical files (X-rays, MRI, lab reports, etc.)"""
     id = db.Column(db.Integer, primary_key=True)
@@ -99,6 +467,8 @@ class MedicalFile(db.Model):
     # File details
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
+    sha256 = db.Column(db.String(64), nullable=True, index=True)  # blob_store key; NULL for legacy uploads
+    file_size = db.Column(db.BigInteger, nullable=True)
     file_type = db.Column(db.String(50), nullable=False)  # X-ray, MRI, Lab Report, Prescription
     file_category = db.Column(db.String(50), nullable=False)  # Imaging, Lab, Prescription, Report
     
@@ -110,15 +480,41 @@ class MedicalFile(db.Model):
     # Chronic disease tracking
     is_chronic_related = db.Column(db.Boolean, default=False)
     chronic_condition = db.Column(db.String(200), nullable=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('chronic_condition.id'), nullable=True)
     
     # Timestamps
     test_date = db.Column(db.DateTime, nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # Background processing: pending, processing, ready, skipped (libraries missing), failed, unsupported
+    processing_status = db.Column(db.String(20), default='pending', server_default=db.text("'pending'"),
+                                  nullable=False)
+    processing_started_at = db.Column(db.DateTime, nullable=True)
+    processing_error = db.Column(db.Text, nullable=True)
+    has_preview = db.Column(db.Boolean, default=False, server_default=db.text('false'), nullable=False)
+    
+    # Read from the file itself (DICOM tags or EXIF)
+    study_date = db.Column(db.DateTime, nullable=True)
+    modality = db.Column(db.String(16), nullable=True)  # DICOM modality code: CR, CT, MR, US...
+    file_metadata = db.Column(db.Text, nullable=True)  # JSON of the other tags read
+    
     # Relationships
     patient = db.relationship('Patient', backref='medical_files')
     doctor = db.relationship('Doctor', backref='uploaded_files')
 
+    __table_args__ = (
+        db.Index('ix_medical_file_patient_date', 'patient_id', 'test_date', 'id'),
+        db.Index('ix_medical_file_patient_condition', 'patient_id', 'condition_id', 'test_date', 'id'),
+        db.Index('ix_medical_file_patient_modality', 'patient_id', 'modality', 'study_date'),
+        # Only files still waiting for a worker, so claiming work never scans processed rows
+        db.Index('ix_medical_file_processing_queue', 'id',
+                 sqlite_where=db.text(FILE_QUEUE_SQL), postgresql_where=db.text(FILE_QUEUE_SQL)),
+    )
+
+    @property
+    def details(self):
+        return json.loads(self.file_metadata) if self.file_metadata else {}
+
 class TestResult(db.Model):
     """Store structured test results (blood work, imaging interpretations)"""
     id = db.Column(db.Integer, primary_key=True)
@@ -138,6 +534,7 @@ class TestResult(db.Model):
     hospital_name = db.Column(db.String(200), nullable=True)
     is_chronic_related = db.Column(db.Boolean, default=False)
     chronic_condition = db.Column(db.String(200), nullable=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('chronic_condition.id'), nullable=True)
     
     # Linked file
     medical_file_id = db.Column(db.Integer, db.ForeignKey('medical_file.id'), nullable=True)
@@ -151,6 +548,30 @@ class TestResult(db.Model):
     doctor = db.relationship('Doctor', backref='ordered_tests')
     medical_file = db.relationship('MedicalFile', backref='test_results')
 
+    __table_args__ = (
+        db.Index('ix_test_result_patient_date', 'patient_id', 'test_date', 'id'),
+        db.Index('ix_test_result_patient_condition', 'patient_id', 'condition_id', 'test_date', 'id'),
+    )
+
+class LabValue(db.Model):
+    """Numeric reading parsed from a test result, kept for trend analytics"""
+    id = db.Column(db.Integer, primary_key=True)
+    test_result_id = db.Column(db.Integer, db.ForeignKey('test_result.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    test_key = db.Column(db.String(200), nullable=False)  # test name lowercased, whitespace collapsed
+    value = db.Column(db.Float, nullable=False)
+    unit = db.Column(db.String(50), nullable=False, default='')
+    range_low = db.Column(db.Float, nullable=True)
+    range_high = db.Column(db.Float, nullable=True)
+    measured_at = db.Column(db.DateTime, nullable=False)
+
+    test_result = db.relationship('TestResult', backref=db.backref('lab_value', uselist=False))
+
+    __table_args__ = (
+        db.Index('uq_lab_value_test_result', 'test_result_id', unique=True),
+        db.Index('ix_lab_value_patient_test', 'patient_id', 'test_key', 'unit', 'measured_at'),
+    )
+
 class Procedure(db.Model):
     """Store surgical procedures and treatments"""
     id = db.Column(db.Integer, primary_key=True)
@@ -169,6 +590,7 @@ class Procedure(db.Model):
     hospital_name = db.Column(db.String(200), nullable=True)
     is_chronic_related = db.Column(db.Boolean, default=False)
     chronic_condition = db.Column(db.String(200), nullable=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('chronic_condition.id'), nullable=True)
     
     # Timestamps
     procedure_date = db.Column(db.DateTime, nullable=False)
@@ -178,242 +600,2681 @@ class Procedure(db.Model):
     patient = db.relationship('Patient', backref='procedures')
     doctor = db.relationship('Doctor', backref='performed_procedures')
 
-class Prescription(db.Model):
-    """Store medication prescriptions"""
-    id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
-    
-    # Medication details
-    medication_name = db.Column(db.String(200), nullable=False)
-    dosage = db.Column(db.String(100), nullable=False)
-    frequency = db.Column(db.String(100), nullable=False)
-    duration = db.Column(db.String(100), nullable=False)
-    
-    # Medical context
-    reason = db.Column(db.Text, nullable=False)
-    instructions = db.Column(db.Text, nullable=True)
-    
-    is_chronic_related = db.Column(db.Boolean, default=False)
-    chronic_condition = db.Column(db.String(200), nullable=True)
-    
-    # Effectiveness tracking
-    effectiveness = db.Column(db.String(50), nullable=True)  # Effective, Partial, Ineffective
-    side_effects = db.Column(db.Text, nullable=True)
-    
-    # Timestamps
-    prescribed_date = db.Column(db.DateTime, default=datetime.utcnow)
-    start_date = db.Column(db.DateTime, nullable=False)
-    end_date = db.Column(db.DateTime, nullable=True)
-    
-    # Relationships
-    patient = db.relationship('Patient', backref='prescriptions')
-    doctor = db.relationship('Doctor', backref='prescriptions')
+    __table_args__ = (
+        db.Index('ix_procedure_patient_date', 'patient_id', 'procedure_date', 'id'),
+        db.Index('ix_procedure_patient_condition', 'patient_id', 'condition_id', 'procedure_date', 'id'),
+    )
+
+class Prescription(db.Model):
+    """Store medication prescriptions"""
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    
+    # Medication details
+    medication_name = db.Column(db.String(200), nullable=False)
+    dosage = db.Column(db.String(100), nullable=False)
+    frequency = db.Column(db.String(100), nullable=False)
+    duration = db.Column(db.String(100), nullable=False)
+    
+    # Medical context
+    reason = db.Column(db.Text, nullable=False)
+    instructions = db.Column(db.Text, nullable=True)
+    
+    is_chronic_related = db.Column(db.Boolean, default=False)
+    chronic_condition = db.Column(db.String(200), nullable=True)
+    condition_id = db.Column(db.Integer, db.ForeignKey('chronic_condition.id'), nullable=True)
+    
+    # Effectiveness tracking
+    effectiveness = db.Column(db.String(50), nullable=True)  # Effective, Partial, Ineffective
+    side_effects = db.Column(db.Text, nullable=True)
+    
+    # Timestamps
+    prescribed_date = db.Column(db.DateTime, default=datetime.utcnow)
+    start_date = db.Column(db.DateTime, nullable=False)
+    end_date = db.Column(db.DateTime, nullable=True)
+    
+    # Relationships
+    patient = db.relationship('Patient', backref='prescriptions')
+    doctor = db.relationship('Doctor', backref='prescriptions')
+
+    __table_args__ = (
+        db.Index('ix_prescription_patient_date', 'patient_id', 'prescribed_date', 'id'),
+        db.Index('ix_prescription_patient_condition', 'patient_id', 'condition_id', 'prescribed_date', 'id'),
+    )
+
+class MedicalRecord(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=True)
+    diagnosis = db.Column(db.Text, nullable=False)
+    treatment = db.Column(db.Text)
+    prescription = db.Column(db.Text)
+    notes = db.Column(db.Text)
+    visit_date = db.Column(db.String(20), nullable=False)
+    follow_up_required = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_medical_record_patient_created', 'patient_id', 'created_at'),)
+
+class EmailOutbox(db.Model):
+    """Notification emails waiting for delivery, written in the same transaction as the change that triggers them"""
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    template_name = db.Column(db.String(50), nullable=False)
+    context = db.Column(db.Text, nullable=False)  # JSON template variables
+    
+    # Delivery state
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, sending
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    claim_token = db.Column(db.String(32), nullable=True, index=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class EmailDeadLetter(db.Model):
+    """Emails that failed permanently or ran out of retries"""
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    template_name = db.Column(db.String(50), nullable=False)
+    context = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    queued_at = db.Column(db.DateTime, nullable=True)
+    failed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchemaMigration(db.Model):
+    """Versions of the migrations below that have been applied to this database"""
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# SCHEMA MIGRATIONS
+#
+# db.create_all() only creates missing tables, so anything added to an existing
+# table (indexes, columns) ships as a numbered migration. Migrations must be
+# idempotent: on a fresh database create_all() has already built the objects.
+
+def create_indexes(*index_names):
+    """Migration step that creates the named indexes declared on the models"""
+    def migrate(conn):
+        indexes = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+        for name in index_names:
+            conn.execute(CreateIndex(indexes[name], if_not_exists=True))
+    return migrate
+
+def add_columns(model, *column_names):
+    """Migration step that adds model columns missing from an existing table"""
+    def migrate(conn):
+        table = model.__table__
+        existing = {column['name'] for column in db.inspect(conn).get_columns(table.name)}
+        for name in column_names:
+            if name not in existing:
+                column = table.c[name]
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(dialect=conn.dialect)}'
+                if column.server_default is not None:
+                    ddl += f' DEFAULT {column.server_default.arg}'
+                    if not column.nullable:
+                        ddl += ' NOT NULL'
+                conn.execute(db.text(ddl))
+    return migrate
+
+def backfill_appointment_slots(conn):
+    """Parse the free-text date/time of existing appointments into slot_date/slot_time.
+
+    Active appointments that already collide keep NULL slots (the first one wins)
+    so the unique slot index can be built.
+    """
+    table = Appointment.__table__
+    rows = conn.execute(db.select(table.c.id, table.c.doctor_id, table.c.date, table.c.time, table.c.status)
+                        .where(table.c.slot_date.is_(None)).order_by(table.c.id)).all()
+    taken = set(conn.execute(db.select(table.c.doctor_id, table.c.slot_date, table.c.slot_time)
+                             .where(table.c.slot_date.isnot(None), db.text(ACTIVE_SLOT_SQL))).all())
+    updates = []
+    for row_id, doctor_id, date_text, time_text, status in rows:
+        try:
+            slot = (doctor_id, parse_slot_date(date_text), parse_slot_time(time_text))
+        except (TypeError, ValueError):
+            continue
+        if status in ('pending', 'confirmed'):
+            if slot in taken:
+                continue
+            taken.add(slot)
+        updates.append({'row_id': row_id, 'new_date': slot[1], 'new_time': slot[2]})
+    if updates:
+        conn.execute(table.update().where(table.c.id == db.bindparam('row_id'))
+                     .values(slot_date=db.bindparam('new_date'), slot_time=db.bindparam('new_time')), updates)
+
+def compute_doctor_stats(conn):
+    """Doctor counters and doctor/patient links recomputed from the appointment table"""
+    appointments = Appointment.__table__
+    stats = {doctor_id: {'total_appointments': total, 'completed_appointments': completed or 0,
+                         'total_patients': patients}
+             for doctor_id, total, completed, patients in conn.execute(
+                 db.select(appointments.c.doctor_id, db.func.count(),
+                           db.func.sum(db.case((appointments.c.status == 'completed', 1), else_=0)),
+                           db.func.count(db.distinct(appointments.c.patient_id)))
+                 .group_by(appointments.c.doctor_id))}
+    links = [{'doctor_id': doctor_id, 'patient_id': patient_id, 'appointment_count': count}
+             for doctor_id, patient_id, count in conn.execute(
+                 db.select(appointments.c.doctor_id, appointments.c.patient_id, db.func.count())
+                 .group_by(appointments.c.doctor_id, appointments.c.patient_id))]
+    return stats, links
+
+def rebuild_doctor_stats(conn):
+    """Rewrite the doctor stats tables from scratch; returns the doctor ids whose counters had drifted"""
+    stats, links = compute_doctor_stats(conn)
+    table = DoctorStats.__table__
+    stored = {row.doctor_id: {'total_appointments': row.total_appointments,
+                              'completed_appointments': row.completed_appointments,
+                              'total_patients': row.total_patients}
+              for row in conn.execute(db.select(table))}
+    drifted = sorted(doctor_id for doctor_id in stats.keys() | stored.keys()
+                     if stats.get(doctor_id) != stored.get(doctor_id))
+
+    conn.execute(DoctorPatientLink.__table__.delete())
+    conn.execute(table.delete())
+    if links:
+        conn.execute(DoctorPatientLink.__table__.insert(), links)
+    if stats:
+        conn.execute(table.insert(), [{'doctor_id': doctor_id, **counters} for doctor_id, counters in stats.items()])
+    return drifted
+
+def backfill_care_access(conn):
+    """Grant open-ended access for every doctor/patient pair with an appointment but no grant yet"""
+    appointments, grants = Appointment.__table__, CareAccessGrant.__table__
+    first_booked = db.func.coalesce(db.func.min(appointments.c.created_at), db.func.current_timestamp())
+    pairs = (db.select(appointments.c.doctor_id, appointments.c.patient_id, first_booked)
+             .where(~db.exists().where(grants.c.doctor_id == appointments.c.doctor_id,
+                                       grants.c.patient_id == appointments.c.patient_id))
+             .group_by(appointments.c.doctor_id, appointments.c.patient_id))
+    conn.execute(grants.insert().from_select(['doctor_id', 'patient_id', 'granted_at'], pairs))
+
+# Record text searched from a patient's history. Each kind's code packs (kind, id) into
+# the SQLite FTS rowid as id * 8 + code, so triggers find a record's entry without a scan.
+SEARCH_SOURCES = {
+    'test': (TestResult, 1, ('test_name', 'result_value', 'interpretation')),
+    'prescription': (Prescription, 2, ('medication_name', 'reason')),
+    'procedure': (Procedure, 3, ('procedure_name', 'description')),
+    'file': (MedicalFile, 4, ('description', 'diagnosis')),
+    'record': (MedicalRecord, 5, ('diagnosis', 'notes')),
+}
+
+def sqlite_has_fts5(conn):
+    return conn.exec_driver_sql("SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar() == 1
+
+def create_record_search_index(conn):
+    """(Re)build the full-text index: an FTS5 table kept current by triggers on SQLite,
+    generated tsvector columns with GIN indexes on Postgres"""
+    if conn.dialect.name == 'postgresql':
+        for model, _, columns in SEARCH_SOURCES.values():
+            table = model.__tablename__
+            text = " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                                 f"GENERATED ALWAYS AS (to_tsvector('english', {text})) STORED")
+            conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING gin (search_vector)')
+        return
+    if conn.dialect.name != 'sqlite' or not sqlite_has_fts5(conn):
+        return  # search falls back to LIKE
+    conn.exec_driver_sql('DROP TABLE IF EXISTS record_search')
+    conn.exec_driver_sql("CREATE VIRTUAL TABLE record_search USING fts5(patient_key, body, tokenize='porter unicode61')")
+    for model, code, columns in SEARCH_SOURCES.values():
+        table = model.__tablename__
+        def row(ref):
+            text = " || ' ' || ".join(f"coalesce({ref}.{column}, '')" for column in columns)
+            return f"{ref}.id * 8 + {code}, 'p' || {ref}.patient_id, {text}"
+        insert = f'INSERT INTO record_search(rowid, patient_key, body) SELECT {row("new")}'
+        delete = f'DELETE FROM record_search WHERE rowid = old.id * 8 + {code}'
+        for suffix, ddl in (
+            ('ai', f'AFTER INSERT ON {table} BEGIN {insert}; END'),
+            ('ad', f'AFTER DELETE ON {table} BEGIN {delete}; END'),
+            ('au', f'AFTER UPDATE OF patient_id, {", ".join(columns)} ON {table} BEGIN {delete}; {insert}; END'),
+        ):
+            conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS record_search_{table}_{suffix}')
+            conn.exec_driver_sql(f'CREATE TRIGGER record_search_{table}_{suffix} {ddl}')
+        conn.exec_driver_sql(f'INSERT INTO record_search(rowid, patient_key, body) SELECT {row(table)} FROM {table}')
+
+def migrate_medical_file_hashes(conn):
+    add_columns(MedicalFile, 'sha256', 'file_size')(conn)
+    create_indexes('ix_medical_file_sha256')(conn)
+
+def migrate_typed_appointment_slots(conn):
+    add_columns(Appointment, 'slot_date', 'slot_time')(conn)
+    backfill_appointment_slots(conn)
+    create_indexes('uq_appointment_active_slot')(conn)
+
+def migrate_condition_registry(conn):
+    for model in (MedicalFile, TestResult, Procedure, Prescription):
+        add_columns(model, 'condition_id')(conn)
+    create_indexes('ix_medical_file_patient_condition', 'ix_test_result_patient_condition',
+                   'ix_procedure_patient_condition', 'ix_prescription_patient_condition')(conn)
+    rebuild_condition_registry(conn)
+
+def migrate_lab_values(conn):
+    index_lab_values(conn)
+
+def reparse_comma_lab_values(conn):
+    # Results such as '4,500' were first read with the comma as a decimal point
+    results = TestResult.__table__
+    with_commas = db.select(results.c.id).where(db.or_(results.c.result_value.contains(','),
+                                                        results.c.normal_range.contains(',')))
+    conn.execute(LabValue.__table__.delete().where(LabValue.__table__.c.test_result_id.in_(with_commas)))
+    index_lab_values(conn)
+
+def migrate_appointment_reminders(conn):
+    add_columns(Appointment, 'reminder_sent_at')(conn)
+    create_indexes('ix_appointment_reminder_due')(conn)
+
+def migrate_medical_file_processing(conn):
+    add_columns(MedicalFile, 'processing_status', 'processing_started_at', 'processing_error', 'has_preview',
+                'study_date', 'modality', 'file_metadata')(conn)
+    create_indexes('ix_medical_file_patient_modality', 'ix_medical_file_processing_queue')(conn)
+
+MIGRATIONS = [
+    (1, 'doctor search indexes', create_indexes(
+        'ix_doctor_username_lower', 'ix_doctor_specialization_lower', 'ix_doctor_hospital_lower',
+        'ix_doctor_years_experience')),
+    (2, 'composite indexes for appointment and record access paths', create_indexes(
+        'ix_appointment_doctor_created', 'ix_appointment_patient_created', 'ix_appointment_doctor_status',
+        'ix_appointment_doctor_slot', 'ix_medical_file_patient_date', 'ix_test_result_patient_date',
+        'ix_procedure_patient_date', 'ix_prescription_patient_date', 'ix_medical_record_patient_created')),
+    (3, 'typed appointment slots with a unique active-slot index', migrate_typed_appointment_slots),
+    (4, 'content hash and size for medical files', migrate_medical_file_hashes),
+    (5, 'populate doctor stats summary tables', rebuild_doctor_stats),
+    (6, 'patient records version for fragment cache keys', add_columns(Patient, 'records_version')),
+    (7, 'full-text index over patient records', create_record_search_index),
+    (8, 'care access grants for existing doctor/patient pairs', backfill_care_access),
+    (9, 'chronic condition registry parsed from free text', migrate_condition_registry),
+    (10, 'numeric lab values parsed from test results', migrate_lab_values),
+    (11, 'reminder tracking for upcoming appointments', migrate_appointment_reminders),
+    (12, 'preview and metadata processing state for medical files', migrate_medical_file_processing),
+    (13, 'lab values with thousands separators parsed again', reparse_comma_lab_values),
+]
+
+def run_migrations():
+    """Apply pending migrations in version order, each in its own transaction. Returns the versions applied."""
+    applied_now = []
+    for version, name, migrate in MIGRATIONS:
+        with db.engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                # Serialize concurrent workers starting up against the same database
+                conn.execute(db.text('SELECT pg_advisory_xact_lock(7246001)'))
+            already = conn.execute(db.select(SchemaMigration.version).where(SchemaMigration.version == version)).first()
+            if already:
+                continue
+            migrate(conn)
+            conn.execute(db.insert(SchemaMigration).values(version=version, name=name, applied_at=datetime.utcnow()))
+            applied_now.append(version)
+    return applied_now
+
+@app.cli.command('db-migrate')
+def db_migrate_command():
+    """Create missing tables and apply pending schema migrations"""
+    db.create_all()
+    applied = run_migrations()
+    click.echo(f"Applied migrations: {applied}" if applied else 'Database is up to date')
+
+@app.cli.command('db-status')
+def db_status_command():
+    """List schema migrations and whether each has been applied"""
+    applied = {m.version: m.applied_at for m in SchemaMigration.query.all()}
+    for version, name, _ in MIGRATIONS:
+        state = f"applied {applied[version]:%Y-%m-%d %H:%M}" if version in applied else 'pending'
+        click.echo(f"{version:4d}  {name:60s} {state}")
+
+def explain_query(stmt, conn):
+    """Return the database's query plan for a statement as one string"""
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={'render_postcompile': True})
+    params = {}
+    for name, value in compiled.params.items():
+        # Apply the column types' conversions (dates, times) the way a normal execute would
+        bind = compiled.binds.get(name)
+        process = bind.type.dialect_impl(conn.dialect).bind_processor(conn.dialect) if bind is not None else None
+        params[name] = process(value) if process else value
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    return '\n'.join(' '.join(str(col) for col in row) for row in conn.exec_driver_sql(prefix + str(compiled), params))
+
+def hot_query_plans():
+    """The app's hottest statements paired with the index each one is expected to use"""
+    since = '2025-01-01 00:00:00'
+    return [
+        ('consultations page', db.select(Appointment).where(Appointment.doctor_id == 1).order_by(
+            Appointment.created_at.desc(), Appointment.id.desc()).limit(21), 'ix_appointment_doctor_created'),
+        ('patient appointments page', db.select(Appointment).where(Appointment.patient_id == 1).order_by(
+            Appointment.created_at.desc(), Appointment.id.desc()).limit(11), 'ix_appointment_patient_created'),
+        ('dashboard status counts', db.select(Appointment.status, db.func.count(Appointment.id)).where(
+            Appointment.doctor_id == 1).group_by(Appointment.status), 'ix_appointment_doctor_status'),
+        ('free slot lookup', booked_slots_query(1, '2025-01-01', '2025-01-07'), 'uq_appointment_active_slot'),
+        ('reminder window', db.select(Appointment.id).where(reminder_window(datetime(2025, 1, 1, 9))),
+         'ix_appointment_reminder_due'),
+        ('timeline files', _timeline_branch('file', 1, None, None, False, None, (since, 1, 'file'), True, 26),
+         'ix_medical_file_patient_date'),
+        ('timeline tests', _timeline_branch('test', 1, None, None, False, None, None, True, 26),
+         'ix_test_result_patient_date'),
+        ('timeline procedures', _timeline_branch('procedure', 1, None, None, False, None, None, True, 26),
+         'ix_procedure_patient_date'),
+        ('timeline prescriptions', _timeline_branch('prescription', 1, None, None, False, None, None, True, 26),
+         'ix_prescription_patient_date'),
+        ('condition timeline tests', _timeline_branch('test', 1, None, None, True, 1, None, True, 26),
+         'ix_test_result_patient_condition'),
+        ('condition cohort', db.select(PatientCondition.patient_id).where(PatientCondition.condition_id == 1),
+         'ix_patient_condition_condition'),
+        ('file processing queue', db.select(MedicalFile.id).where(_claimable_files(datetime(2025, 1, 1)))
+         .order_by(MedicalFile.id).limit(8), 'ix_medical_file_processing_queue'),
+        ('scans by modality', db.select(MedicalFile.id).where(MedicalFile.patient_id == 1, MedicalFile.modality == 'CT')
+         .order_by(MedicalFile.study_date.desc()), 'ix_medical_file_patient_modality'),
+        ('recent medical records', db.select(MedicalRecord).where(MedicalRecord.patient_id == 1).order_by(
+            MedicalRecord.created_at.desc()).limit(5), 'ix_medical_record_patient_created'),
+        ('doctor name search', db.select(Doctor).where(prefix_match(Doctor.username, 'mu')),
+         'ix_doctor_username_lower'),
+    ]
+
+@app.cli.command('explain-hot-queries')
+def explain_hot_queries_command():
+    """Check with EXPLAIN that the hot queries are served by their indexes"""
+    failures = 0
+    with db.engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            # Small tables make the planner prefer sequential scans; ask whether an index path exists
+            conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        for label, stmt, index_name in hot_query_plans():
+            plan = explain_query(stmt, conn)
+            ok = index_name in plan
+            failures += not ok
+            click.echo(f"{'ok  ' if ok else 'MISS'} {label:28s} {index_name}")
+            if not ok:
+                click.echo('     ' + plan.replace('\n', '\n     '))
+    if failures:
+        raise SystemExit(1)
+
+# INSTRUMENTATION
+
+# Every request is timed and its SQL counted through engine events. Metrics are
+# served in Prometheus text format at /metrics; each request also writes one JSON
+# line to the evura.requests logger, and slow statements go to evura.slow_queries.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+class Histogram:
+    """Prometheus-style cumulative histogram, one series per label set"""
+
+    def __init__(self, name, documentation, label_names, buckets=LATENCY_BUCKETS):
+        self.name, self.documentation = name, documentation
+        self.label_names, self.buckets = label_names, buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.setdefault(labels, [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                label_text = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, labels))
+                prefix = label_text + ',' if label_text else ''
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-2]}')
+                lines.append(f'{self.name}_count{{{label_text}}} {series[-2]}')
+                lines.append(f'{self.name}_sum{{{label_text}}} {series[-1]:.6f}')
+        return lines
+
+class CounterMetric:
+    """Prometheus counter, one value per label set"""
+
+    def __init__(self, name, documentation, label_names):
+        self.name, self.documentation, self.label_names = name, documentation, label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                label_text = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, labels))
+                lines.append(f'{self.name}{{{label_text}}} {value}')
+        return lines
+
+REQUEST_SECONDS = Histogram('evura_request_duration_seconds', 'Request latency by endpoint.', ('endpoint', 'method'))
+REQUESTS_TOTAL = CounterMetric('evura_requests_total', 'Requests by endpoint and status.', ('endpoint', 'method', 'status'))
+REQUEST_SQL_STATEMENTS = Histogram('evura_request_sql_statements', 'SQL statements per request.', ('endpoint',),
+                                   buckets=STATEMENT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram('evura_request_sql_seconds', 'Time in SQL per request.', ('endpoint',))
+REQUEST_TEMPLATE_SECONDS = Histogram('evura_request_template_seconds', 'Time rendering templates per request.',
+                                     ('endpoint',))
+SLOW_QUERIES_TOTAL = CounterMetric('evura_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.', ('endpoint',))
+EMAIL_SEND_SECONDS = Histogram('evura_email_send_seconds', 'Outbound email send time.', ('outcome',))
+PASSWORD_HASH_SECONDS = Histogram('evura_password_hash_seconds', 'bcrypt time including queueing.', ('operation',))
+LOGINS_THROTTLED_TOTAL = CounterMetric('evura_logins_throttled_total', 'Logins refused before hashing.', ('reason',))
+METRICS = [REQUEST_SECONDS, REQUESTS_TOTAL, REQUEST_SQL_STATEMENTS, REQUEST_SQL_SECONDS, REQUEST_TEMPLATE_SECONDS,
+           SLOW_QUERIES_TOTAL, EMAIL_SEND_SECONDS, PASSWORD_HASH_SECONDS, LOGINS_THROTTLED_TOTAL]
+
+request_log = logging.getLogger('evura.requests')
+slow_query_log = logging.getLogger('evura.slow_queries')
+for _logger in (request_log, slow_query_log):
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    _logger.addHandler(_handler)
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+request_log.disabled = not app.config['REQUEST_LOG']
+
+def _current_endpoint():
+    return (request.endpoint or 'unknown') if has_request_context() else 'background'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_started'].pop()
+    endpoint = _current_endpoint()
+    if has_request_context() and 'request_metrics' in g:
+        g.request_metrics['sql_count'] += 1
+        g.request_metrics['sql_seconds'] += elapsed
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        SLOW_QUERIES_TOTAL.inc(endpoint)
+        slow_query_log.warning(json.dumps({
+            'event': 'slow_query', 'endpoint': endpoint, 'ms': round(elapsed * 1000, 2),
+            'statement': ' '.join(statement.split())[:1000],
+        }))
+
+@event.listens_for(Engine, 'handle_error')
+def _drop_statement_timer(context):
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+@before_render_template.connect_via(app)
+def _start_template_timer(sender, template, context, **extra):
+    if 'request_metrics' in g:
+        g.request_metrics['template_started'].append(perf_counter())
+
+@template_rendered.connect_via(app)
+def _record_template_time(sender, template, context, **extra):
+    if 'request_metrics' in g and g.request_metrics['template_started']:
+        g.request_metrics['template_seconds'] += perf_counter() - g.request_metrics['template_started'].pop()
+
+@app.before_request
+def _start_request_metrics():
+    g.request_metrics = {'started': perf_counter(), 'sql_count': 0, 'sql_seconds': 0.0,
+                         'template_seconds': 0.0, 'template_started': []}
+
+@app.after_request
+def _record_request_metrics(response):
+    metrics = g.pop('request_metrics', None)
+    if metrics is None:
+        return response
+    elapsed = perf_counter() - metrics['started']
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_SECONDS.observe(elapsed, endpoint, request.method)
+    REQUESTS_TOTAL.inc(endpoint, request.method, str(response.status_code))
+    REQUEST_SQL_STATEMENTS.observe(metrics['sql_count'], endpoint)
+    REQUEST_SQL_SECONDS.observe(metrics['sql_seconds'], endpoint)
+    REQUEST_TEMPLATE_SECONDS.observe(metrics['template_seconds'], endpoint)
+    request_log.info(json.dumps({
+        'event': 'request', 'method': request.method, 'path': request.path, 'endpoint': endpoint,
+        'status': response.status_code, 'ms': round(elapsed * 1000, 2), 'sql_count': metrics['sql_count'],
+        'sql_ms': round(metrics['sql_seconds'] * 1000, 2), 'template_ms': round(metrics['template_seconds'] * 1000, 2),
+    }))
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint, authorised by METRICS_TOKEN"""
+    # The peer address proves nothing behind a reverse proxy, so a bearer token is required
+    token = app.config['METRICS_TOKEN']
+    supplied = request.headers.get('Authorization', '')
+    supplied = supplied[len('Bearer '):].strip() if supplied.startswith('Bearer ') else ''
+    if not token:
+        return 'Not Found', 404
+    if not hmac.compare_digest(supplied.encode(), token.encode()):
+        return 'Unauthorized', 401, {'WWW-Authenticate': 'Bearer'}
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend([
+        '# HELP evura_fragment_cache_bytes Bytes held by the fragment cache.',
+        '# TYPE evura_fragment_cache_bytes gauge',
+        f'evura_fragment_cache_bytes {fragment_cache.size}',
+        '# HELP evura_fragment_cache_hits_total Fragment cache hits.',
+        '# TYPE evura_fragment_cache_hits_total counter',
+        f'evura_fragment_cache_hits_total {fragment_cache.hits}',
+        '# HELP evura_fragment_cache_misses_total Fragment cache misses.',
+        '# TYPE evura_fragment_cache_misses_total counter',
+        f'evura_fragment_cache_misses_total {fragment_cache.misses}',
+    ])
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# EMAIL FUNCTIONS
+
+EMAIL_CLAIM_LEASE = timedelta(minutes=5)
+
+class EmailDeliveryError(Exception):
+    """Raised by a transport; permanent errors are dead-lettered without retrying"""
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+class SendGridTransport:
+    """Delivers through a single SendGrid client reused for every message"""
+    def __init__(self, api_key, from_email):
+        self.client = SendGridAPIClient(api_key=api_key) if api_key else None
+        self.from_email = from_email
+
+    def send(self, to, subject, html_content):
+        if self.client is None:
+            raise EmailDeliveryError('SENDGRID_API_KEY is not configured', permanent=True)
+        message = Mail(from_email=self.from_email, to_emails=to, subject=subject, html_content=html_content)
+        try:
+            self.client.send(message)
+        except HTTPError as e:
+            permanent = 400 <= e.status_code < 500 and e.status_code != 429
+            raise EmailDeliveryError(f"SendGrid returned {e.status_code}: {e.body}", permanent=permanent)
+        except Exception as e:
+            raise EmailDeliveryError(f"{type(e).__name__}: {e}")
+
+class FakeEmailTransport:
+    """In-memory transport for local development and tests, optionally saving each message as an HTML file"""
+    def __init__(self, fail_with=None, outbox_dir=None):
+        self.sent = []
+        self.fail_with = fail_with  # optional EmailDeliveryError raised on every send
+        self.outbox_dir = outbox_dir
+
+    def send(self, to, subject, html_content):
+        if self.fail_with:
+            raise self.fail_with
+        self.sent.append({'to': to, 'subject': subject, 'html': html_content})
+        if self.outbox_dir:
+            os.makedirs(self.outbox_dir, exist_ok=True)
+            name = f"{datetime.utcnow():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.html"
+            with open(os.path.join(self.outbox_dir, name), 'w', encoding='utf-8') as f:
+                f.write(f'<!-- To: {to}\n     Subject: {subject} -->\n{html_content}')
+
+EMAIL_TRANSPORTS = {
+    'sendgrid': lambda: SendGridTransport(app.config.get('SENDGRID_API_KEY'), app.config['EMAIL_FROM']),
+    'fake': lambda: FakeEmailTransport(outbox_dir=app.config['EMAIL_FAKE_DIR']),
+}
+
+def create_email_transport():
+    return EMAIL_TRANSPORTS[app.config['EMAIL_TRANSPORT']]()
+
+def queue_email(to, subject, template_name, **kwargs):
+    """Add an email to the outbox; it is sent once the caller's transaction commits"""
+    db.session.add(EmailOutbox(
+        to_email=to, subject=subject, template_name=template_name,
+        context=json.dumps(kwargs, default=str)
+    ))
+
+def _claimable_outbox_rows(now):
+    return db.and_(
+        EmailOutbox.next_attempt_at <= now,
+        db.or_(EmailOutbox.status == 'pending',
+               db.and_(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < now - EMAIL_CLAIM_LEASE))
+    )
+
+def _dead_letter(entry, error):
+    db.session.add(EmailDeadLetter(
+        to_email=entry.to_email, subject=entry.subject, template_name=entry.template_name,
+        context=entry.context, attempts=entry.attempts, last_error=error, queued_at=entry.created_at
+    ))
+    db.session.delete(entry)
+
+def deliver_outbox_batch(transport, batch_size=None):
+    """Claim up to batch_size due emails, send them and record the outcome. Returns the number handled."""
+    batch_size = batch_size or app.config['EMAIL_BATCH_SIZE']
+    now = datetime.utcnow()
+    token = uuid.uuid4().hex
+
+    # Claim with a single UPDATE so concurrent workers never pick the same rows
+    due_ids = db.select(EmailOutbox.id).where(_claimable_outbox_rows(now)).order_by(EmailOutbox.id).limit(batch_size)
+    db.session.execute(
+        db.update(EmailOutbox).where(EmailOutbox.id.in_(due_ids), _claimable_outbox_rows(now))
+        .values(status='sending', claim_token=token, claimed_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    batch = EmailOutbox.query.filter_by(claim_token=token).order_by(EmailOutbox.id).all()
+    for entry in batch:
+        entry.attempts += 1
+        try:
+            html_content = render_email_template(entry.template_name, **json.loads(entry.context))
+            send_started = perf_counter()
+            try:
+                transport.send(entry.to_email, f"E-Vura Healthcare: {entry.subject}", html_content)
+            except EmailDeliveryError:
+                EMAIL_SEND_SECONDS.observe(perf_counter() - send_started, 'failed')
+                raise
+            EMAIL_SEND_SECONDS.observe(perf_counter() - send_started, 'sent')
+            db.session.delete(entry)
+        except EmailDeliveryError as e:
+            if e.permanent or entry.attempts >= app.config['EMAIL_MAX_ATTEMPTS']:
+                print(f" Email to {entry.to_email} dead-lettered after {entry.attempts} attempt(s): {e}")
+                _dead_letter(entry, str(e))
+            else:
+                delay = app.config['EMAIL_RETRY_BASE_SECONDS'] * 2 ** (entry.attempts - 1)
+                entry.status, entry.claim_token, entry.last_error = 'pending', None, str(e)
+                entry.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        except Exception as e:
+            _dead_letter(entry, f"{type(e).__name__}: {e}")
+    db.session.commit()
+    return len(batch)
+
+def drain_outbox(transport):
+    """Deliver due emails batch by batch until none are left. Returns the number handled."""
+    total = 0
+    while True:
+        handled = deliver_outbox_batch(transport)
+        total += handled
+        if not handled:
+            return total
+
+class EmailWorkerPool:
+    """Background threads draining the email outbox, each holding one reusable transport"""
+    def __init__(self, flask_app, transport_factory=create_email_transport, poll_interval=5):
+        self.app = flask_app
+        self.transport_factory = transport_factory
+        self.poll_interval = poll_interval
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self, threads=None):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for i in range(threads or self.app.config['EMAIL_WORKER_THREADS']):
+                worker = threading.Thread(target=self._run, name=f'email-worker-{i}', daemon=True)
+                worker.start()
+                self._threads.append(worker)
+
+    def wake(self):
+        """Nudge the workers after new mail is committed, starting them on first use"""
+        if self.app.config['EMAIL_WORKER_THREADS'] > 0:
+            self.start()
+        self._wakeup.set()
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        self._wakeup.set()
+        with self._lock:
+            for worker in self._threads:
+                worker.join(timeout)
+            self._threads = []
+
+    def _run(self):
+        with self.app.app_context():
+            transport = self.transport_factory()
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    handled = deliver_outbox_batch(transport)
+            except Exception as e:
+                print(f" Email worker error: {type(e).__name__}: {e}")
+                handled = 0
+            if not handled:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+email_workers = EmailWorkerPool(app)
+
+@app.cli.command('send-emails')
+@click.option('--workers', default=None, type=int, help='Number of delivery threads')
+@click.option('--once', is_flag=True, help='Drain the outbox once and exit')
+def send_emails_command(workers, once):
+    """Deliver queued notification emails"""
+    if once:
+        click.echo(f'Processed {drain_outbox(create_email_transport())} queued email(s)')
+        return
+    email_workers.start(workers)
+    click.echo('Email workers running, press Ctrl+C to stop')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        email_workers.stop()
+
+# Email templates live in templates/emails. The environment's own cache keeps each one
+# compiled for the life of the process, and with auto_reload off it never stats the files again.
+email_templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(app.root_path, 'templates', 'emails')),
+    autoescape=True,
+    auto_reload=False,
+)
+
+def get_email_template(template_name):
+    try:
+        return email_templates.get_template(f'{template_name}.html')
+    except jinja2.TemplateNotFound:
+        return email_templates.get_template('notification.html')
+
+def render_email_template(template_name, **kwargs):
+    """Render an email by template name; values are HTML-escaped"""
+    return get_email_template(template_name).render(**kwargs)
+
+@app.cli.command('bench-email-render')
+@click.option('--iterations', default=20000, help='Renders per template')
+def bench_email_render_command(iterations):
+    """Time render_email_template for each notification template against the old f-string renderer"""
+    from benchmark import legacy_render_email_template
+    context = dict(doctor_name='Mugisha', patient_name='Uwase', date='2025-03-01', time='10:00 AM',
+                   reason='Follow-up', chronic_conditions='Type 2 diabetes', hospital='CHUK')
+    click.echo(f"{'template':24s} {'jinja':>8s} {'f-string':>9s}  us/render")
+    for template_name in ('appointment_request', 'appointment_confirmed', 'appointment_rejected',
+                          'appointment_completed', 'appointment_reminder'):
+        jinja = timeit.timeit(lambda: render_email_template(template_name, **context), number=iterations)
+        legacy = timeit.timeit(lambda: legacy_render_email_template(template_name, **context), number=iterations)
+        click.echo(f'{template_name:24s} {jinja / iterations * 1e6:8.2f} {legacy / iterations * 1e6:9.2f}')
+
+# HELPER FUNCTIONS
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session or 'user_type' not in session:
+            flash('Please log in to access this page.', 'warning')
+            return redirect(url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def patient_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get('user_type') != 'patient':
+            flash('Access denied. Patients only.', 'danger')
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def doctor_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get('user_type') != 'doctor':
+            flash('Access denied. Doctors only.', 'danger')
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def large_upload(f):
+    """Let this view read bodies up to MAX_UPLOAD_MB instead of MAX_CONTENT_LENGTH"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        request.max_content_length = app.config['MAX_UPLOAD_MB'] * 1024 * 1024
+        return f(*args, **kwargs)
+    return decorated_function
+
+# CACHING
+
+class TTLCache:
+    """Thread-safe in-process cache; entries expire after ttl seconds, least recently used go first"""
+
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# FRAGMENT CACHE
+
+class FragmentCache:
+    """LRU cache of rendered template fragments, bounded by their total size in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self.size -= old[1]
+            self._entries[key] = (html, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+fragment_cache = FragmentCache(max_bytes=app.config['FRAGMENT_CACHE_MB'] * 1024 * 1024)
+
+class FragmentCacheExtension(Extension):
+    """{% cache 'name', key, ... %}...{% endcache %} renders the body once per distinct key.
+
+    Keys must include a version stamp (e.g. patient.records_version) so that a
+    data change makes old fragments unreachable; they then age out of the LRU.
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_cached', [nodes.List(key)]), [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key, caller):
+        if not fragment_cache.max_bytes:
+            return caller()
+        key = tuple(key)
+        html = fragment_cache.get(key)
+        if html is None:
+            html = caller()
+            fragment_cache.set(key, html)
+        return html
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+def bump_records_version(patient_id):
+    """Invalidate a patient's cached fragments (runs in the caller's transaction)"""
+    db.session.execute(db.update(Patient).where(Patient.id == patient_id)
+                       .values(records_version=Patient.records_version + 1))
+
+# CURRENT USER
+
+USER_MODELS = {'patient': Patient, 'doctor': Doctor}
+
+# Layout data only (never medical details), shared across requests and workers' threads
+user_profile_cache = TTLCache(ttl=app.config['USER_PROFILE_CACHE_TTL'], maxsize=app.config['USER_PROFILE_CACHE_SIZE'])
+
+def current_user():
+    """The logged-in Patient or Doctor, loaded at most once per request"""
+    if 'current_user' not in g:
+        model = USER_MODELS.get(session.get('user_type'))
+        g.current_user = db.session.get(model, session['user_id']) if model and 'user_id' in session else None
+    return g.current_user
+
+def get_user_profile(user_type, user_id):
+    """Username, type and hospital for the layout, cached across requests"""
+    key = (user_type, user_id)
+    profile = user_profile_cache.get(key)
+    if profile is None:
+        if (session.get('user_type'), session.get('user_id')) == key:
+            user = current_user()
+        else:
+            user = db.session.get(USER_MODELS[user_type], user_id)
+        if user is None:
+            return None
+        profile = {
+            'id': user.id, 'type': user_type, 'username': user.username,
+            'hospital': getattr(user, 'hospital', None), 'specialization': getattr(user, 'specialization', None),
+        }
+        user_profile_cache.set(key, profile)
+    return profile
+
+def invalidate_user_profile(user_type, user_id):
+    user_profile_cache.invalidate((user_type, user_id))
+
+@app.context_processor
+def inject_current_profile():
+    if session.get('user_type') not in USER_MODELS or 'user_id' not in session:
+        return {}
+    return {'current_profile': get_user_profile(session['user_type'], session['user_id'])}
+
+# PASSWORD HASHING
+
+class PasswordHashBusy(Exception):
+    """More logins are waiting on bcrypt than PASSWORD_HASH_QUEUE allows"""
+
+class PasswordHasher:
+    """Runs bcrypt on a small thread pool, so a login burst queues for a few hashing
+    threads instead of every request thread burning CPU at once"""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def _run(self, operation, fn, *args):
+        # Created on first use so each forked gunicorn worker gets its own threads
+        with self._lock:
+            if self._executor is None:
+                threads = self.app.config['PASSWORD_HASH_THREADS']
+                self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='password-hash')
+                self._slots = threading.BoundedSemaphore(threads + self.app.config['PASSWORD_HASH_QUEUE'])
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHashBusy()
+        started = perf_counter()
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+            PASSWORD_HASH_SECONDS.observe(perf_counter() - started, operation)
+
+    def hash(self, password):
+        rounds = self.app.config['BCRYPT_LOG_ROUNDS']
+        return self._run('hash', bcrypt.generate_password_hash, password, rounds).decode('utf-8')
+
+    def verify(self, password_hash, password):
+        return self._run('verify', bcrypt.check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if the hash was made with a different cost than BCRYPT_LOG_ROUNDS"""
+        try:
+            return int(password_hash.split('$')[2]) != self.app.config['BCRYPT_LOG_ROUNDS']
+        except (IndexError, ValueError):
+            return False
+
+class LoginThrottle:
+    """Failed logins per account and per IP in a sliding window, checked before hashing"""
+
+    def __init__(self, window, maxsize=100000):
+        self.window, self.maxsize = window, maxsize
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        return failures
+
+    def retry_after(self, key, limit):
+        """Seconds until the key may try again, 0 if it is under the limit"""
+        now = monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if not failures or len(failures) < limit:
+                return 0
+            return int(failures[-limit] + self.window - now) + 1
+
+    def record_failure(self, key):
+        now = monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if failures is None:
+                failures = self._failures[key] = deque()
+            failures.append(now)
+            self._failures.move_to_end(key)
+            while len(self._failures) > self.maxsize:
+                self._failures.popitem(last=False)
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._failures.clear()
+
+password_hasher = PasswordHasher(app)
+login_throttle = LoginThrottle(window=app.config['LOGIN_THROTTLE_WINDOW'])
+
+def login_retry_after(user_type, email):
+    """Seconds the account or client IP must wait before another login attempt"""
+    return max(
+        login_throttle.retry_after(('account', user_type, email), app.config['LOGIN_MAX_FAILURES_PER_ACCOUNT']),
+        login_throttle.retry_after(('ip', request.remote_addr), app.config['LOGIN_MAX_FAILURES_PER_IP']),
+    )
+
+def record_login_failure(user_type, email):
+    login_throttle.record_failure(('account', user_type, email))
+    login_throttle.record_failure(('ip', request.remote_addr))
+
+# DOCTOR STATS
+
+# Other workers' caches are not invalidated, so the TTL bounds how stale a profile can be
+doctor_stats_cache = TTLCache(ttl=app.config['DOCTOR_STATS_CACHE_TTL'])
+
+def _increment_counters(model, key, **deltas):
+    """Atomically add deltas to a counter row, creating it if needed; returns True if it was created"""
+    # Flush pending rows first so their errors (e.g. a taken slot) are not mistaken for a counter race
+    db.session.flush()
+    table = model.__table__
+    where = [table.c[name] == value for name, value in key.items()]
+    update = table.update().where(*where).values({table.c[name]: table.c[name] + delta
+                                                  for name, delta in deltas.items()})
+    if db.session.execute(update).rowcount:
+        return False
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(**key, **deltas))
+        return True
+    except IntegrityError:
+        # Another transaction created the row first
+        db.session.execute(update)
+        return False
+
+def record_appointment_booked(doctor_id, patient_id):
+    """Count a new appointment in the doctor's stats (same transaction as the booking)"""
+    new_patient = _increment_counters(DoctorPatientLink, {'doctor_id': doctor_id, 'patient_id': patient_id},
+                                      appointment_count=1)
+    _increment_counters(DoctorStats, {'doctor_id': doctor_id}, total_appointments=1,
+                        total_patients=1 if new_patient else 0)
+
+def record_status_change(doctor_id, old_status, new_status):
+    """Keep the completed counter in step with an appointment's status change"""
+    delta = (new_status == 'completed') - (old_status == 'completed')
+    if delta:
+        _increment_counters(DoctorStats, {'doctor_id': doctor_id}, completed_appointments=delta)
+
+def get_doctor_profile_stats(doctor_id):
+    """Patients, appointments and completed consultations for a doctor's profile"""
+    stats = doctor_stats_cache.get(doctor_id)
+    if stats is None:
+        row = db.session.get(DoctorStats, doctor_id)
+        stats = {
+            'total_patients': row.total_patients if row else 0,
+            'total_appointments': row.total_appointments if row else 0,
+            'completed_appointments': row.completed_appointments if row else 0,
+        }
+        doctor_stats_cache.set(doctor_id, stats)
+    return stats
+
+@app.cli.command('rebuild-doctor-stats')
+def rebuild_doctor_stats_command():
+    """Recompute the doctor stats tables from appointments and report drift"""
+    with db.engine.begin() as conn:
+        drifted = rebuild_doctor_stats(conn)
+    doctor_stats_cache.clear()
+    if drifted:
+        click.echo(f'Corrected drifted stats for doctors: {drifted}')
+    else:
+        click.echo('Doctor stats were in sync')
+
+# CARE ACCESS
+#
+# A doctor may open a patient's records while holding an unrevoked, unexpired grant.
+# Callers invalidate the cache after committing a change; other workers see it once the TTL runs out.
+
+care_access_cache = TTLCache(ttl=app.config['CARE_ACCESS_CACHE_TTL'], maxsize=8192)
+
+def care_access_expiry(now):
+    days = app.config['CARE_ACCESS_DAYS']
+    return now + timedelta(days=days) if days else None
+
+def grant_care_access(doctor_id, patient_id):
+    """Grant, renew or restore a doctor's access to a patient (same transaction as the booking)"""
+    now = datetime.utcnow()
+    values = {'granted_at': now, 'expires_at': care_access_expiry(now), 'revoked_at': None}
+    table = CareAccessGrant.__table__
+    update = table.update().where(table.c.doctor_id == doctor_id, table.c.patient_id == patient_id).values(values)
+    if db.session.execute(update).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(doctor_id=doctor_id, patient_id=patient_id, **values))
+    except IntegrityError:
+        # Another booking created the grant first
+        db.session.execute(update)
+
+def renew_care_access(doctor_id, patient_id):
+    """Push back the expiry of a grant the patient has not revoked"""
+    table = CareAccessGrant.__table__
+    db.session.execute(table.update()
+                       .where(table.c.doctor_id == doctor_id, table.c.patient_id == patient_id,
+                              table.c.revoked_at.is_(None))
+                       .values(expires_at=care_access_expiry(datetime.utcnow())))
+
+def revoke_care_access(doctor_id, patient_id):
+    """Revoke a doctor's access to a patient; returns True if an active grant was revoked"""
+    table = CareAccessGrant.__table__
+    return bool(db.session.execute(table.update()
+                                   .where(table.c.doctor_id == doctor_id, table.c.patient_id == patient_id,
+                                          table.c.revoked_at.is_(None))
+                                   .values(revoked_at=datetime.utcnow())).rowcount)
+
+def doctor_can_access_patient(doctor_id, patient_id):
+    """True if the doctor holds an active grant for the patient's records"""
+    key = (doctor_id, patient_id)
+    grant = care_access_cache.get(key)
+    if grant is None:
+        row = db.session.execute(db.select(CareAccessGrant.revoked_at, CareAccessGrant.expires_at)
+                                 .where(CareAccessGrant.doctor_id == doctor_id,
+                                        CareAccessGrant.patient_id == patient_id)).first()
+        grant = (row is not None and row.revoked_at is None, row.expires_at if row else None)
+        care_access_cache.set(key, grant)
+    active, expires_at = grant
+    return active and (expires_at is None or expires_at > datetime.utcnow())
+
+def get_care_access_grants(patient_id):
+    """Doctors currently able to open the patient's records, most recently granted first"""
+    now = datetime.utcnow()
+    return (CareAccessGrant.query.options(db.joinedload(CareAccessGrant.doctor))
+            .filter(CareAccessGrant.patient_id == patient_id, CareAccessGrant.revoked_at.is_(None),
+                    db.or_(CareAccessGrant.expires_at.is_(None), CareAccessGrant.expires_at > now))
+            .order_by(CareAccessGrant.granted_at.desc()).all())
+
+# CHRONIC CONDITIONS
+#
+# Patient.chronic_conditions and the records' chronic_condition stay as typed for display;
+# the registry holds their parsed form so cohort and per-condition queries run on indexes.
+
+CONDITION_SEPARATORS = re.compile(r'[,;\n]+|\s+and\s+|\s*&\s*', re.IGNORECASE)
+
+def condition_key(name):
+    return ' '.join(name.split()).strip(' .').lower()
+
+def parse_conditions(text):
+    """Distinct conditions in a free-text list, as {key: display name} in the order written"""
+    conditions = {}
+    for part in CONDITION_SEPARATORS.split(text or ''):
+        name = ' '.join(part.split()).strip(' .')
+        if name and condition_key(name) not in conditions:
+            conditions[condition_key(name)] = name[:200]
+    return conditions
+
+def ensure_conditions(executor, conditions):
+    """Registry ids for {key: name}, creating missing entries; executor is a connection or the session"""
+    if not conditions:
+        return {}
+    table = ChronicCondition.__table__
+    ids = dict(executor.execute(db.select(table.c.key, table.c.id).where(table.c.key.in_(conditions))).all())
+    for key, name in conditions.items():
+        if key in ids:
+            continue
+        try:
+            with executor.begin_nested():
+                ids[key] = executor.execute(table.insert().values(key=key, name=name)).inserted_primary_key[0]
+        except IntegrityError:
+            # Another transaction registered it first
+            ids[key] = executor.execute(db.select(table.c.id).where(table.c.key == key)).scalar_one()
+    return ids
+
+def set_patient_conditions(executor, patient_id, text):
+    """Replace a patient's registry conditions with those parsed from their profile text"""
+    ids = ensure_conditions(executor, parse_conditions(text))
+    table = PatientCondition.__table__
+    executor.execute(table.delete().where(table.c.patient_id == patient_id))
+    if ids:
+        executor.execute(table.insert(), [{'patient_id': patient_id, 'condition_id': condition_id}
+                                          for condition_id in ids.values()])
+
+def record_condition_id(text):
+    """Registry id of the first condition named in a record's chronic_condition, or None"""
+    conditions = parse_conditions(text)
+    key = next(iter(conditions), None)
+    return ensure_conditions(db.session, {key: conditions[key]})[key] if key else None
+
+def chronic_record_fields(form):
+    """is_chronic_related, chronic_condition and condition_id for a record from an upload or note form"""
+    related = bool(form.get('is_chronic_related'))
+    name = (form.get('chronic_condition') or '').strip() if related else ''
+    return {'is_chronic_related': related, 'chronic_condition': name or None,
+            'condition_id': record_condition_id(name)}
+
+def rebuild_condition_registry(conn):
+    """Parse every patient's condition text and every untagged record's chronic_condition into the registry"""
+    patients = Patient.__table__
+    parsed = {patient_id: parse_conditions(text) for patient_id, text in conn.execute(
+        db.select(patients.c.id, patients.c.chronic_conditions).where(patients.c.chronic_conditions.isnot(None)))}
+    record_texts = {}
+    for model in (MedicalFile, TestResult, Procedure, Prescription):
+        table = model.__table__
+        record_texts[model] = {text: next(iter(parse_conditions(text)), None) for text in conn.execute(
+            db.select(table.c.chronic_condition).distinct()
+            .where(table.c.chronic_condition.isnot(None), table.c.condition_id.is_(None))).scalars()}
+
+    names = {}
+    for conditions in parsed.values():
+        names.update((key, name) for key, name in conditions.items() if key not in names)
+    for texts in record_texts.values():
+        for text, key in texts.items():
+            if key and key not in names:
+                names[key] = parse_conditions(text)[key]
+    ids = ensure_conditions(conn, names)
+
+    links = PatientCondition.__table__
+    conn.execute(links.delete())
+    rows = [{'patient_id': patient_id, 'condition_id': ids[key]}
+            for patient_id, conditions in parsed.items() for key in conditions]
+    if rows:
+        conn.execute(links.insert(), rows)
+    for model, texts in record_texts.items():
+        table = model.__table__
+        updates = [{'text': text, 'new_id': ids[key]} for text, key in texts.items() if key]
+        if updates:
+            conn.execute(table.update()
+                         .where(table.c.chronic_condition == db.bindparam('text'), table.c.condition_id.is_(None))
+                         .values(condition_id=db.bindparam('new_id')), updates)
+
+@app.cli.command('rebuild-condition-registry')
+def rebuild_condition_registry_command():
+    """Re-parse patients' chronic conditions and tag records with their registry condition"""
+    with db.engine.begin() as conn:
+        rebuild_condition_registry(conn)
+    click.echo(f'{ChronicCondition.query.count()} conditions, '
+               f'{PatientCondition.query.count()} patient conditions')
+
+def get_patient_conditions(patient_ids):
+    """{patient id: [ChronicCondition, ...]} for the given patients in one query"""
+    conditions = {patient_id: [] for patient_id in patient_ids}
+    if conditions:
+        rows = (db.session.query(PatientCondition.patient_id, ChronicCondition)
+                .join(ChronicCondition, ChronicCondition.id == PatientCondition.condition_id)
+                .filter(PatientCondition.patient_id.in_(conditions.keys()))
+                .order_by(ChronicCondition.name))
+        for patient_id, condition in rows:
+            conditions[patient_id].append(condition)
+    return conditions
+
+def get_doctor_condition_counts(doctor_id):
+    """(condition, number of the doctor's patients with it), most common first"""
+    patients = db.func.count(PatientCondition.patient_id)
+    return (db.session.query(ChronicCondition, patients)
+            .join(PatientCondition, PatientCondition.condition_id == ChronicCondition.id)
+            .join(DoctorPatientLink, db.and_(DoctorPatientLink.patient_id == PatientCondition.patient_id,
+                                             DoctorPatientLink.doctor_id == doctor_id))
+            .group_by(ChronicCondition.id, ChronicCondition.key, ChronicCondition.name)
+            .order_by(patients.desc(), ChronicCondition.name).all())
+
+def get_condition_cohort(doctor_id, term=None):
+    """The doctor's patients with a chronic condition whose name contains term (any condition if empty)"""
+    has_condition = db.select(PatientCondition.patient_id).where(PatientCondition.patient_id == Patient.id)
+    if term:
+        matching = db.select(ChronicCondition.id).where(
+            ChronicCondition.key.contains(condition_key(term), autoescape=True))
+        has_condition = has_condition.where(PatientCondition.condition_id.in_(matching))
+    return (Patient.query
+            .join(DoctorPatientLink, db.and_(DoctorPatientLink.patient_id == Patient.id,
+                                             DoctorPatientLink.doctor_id == doctor_id))
+            .filter(has_condition.exists())
+            .order_by(Patient.username).all())
+
+# DASHBOARD QUERIES
+
+def get_doctor_dashboard_stats(doctor_id):
+    """Dashboard tile counters computed with GROUP BY instead of walking doctor.appointments"""
+    status_counts = dict(
+        db.session.query(Appointment.status, db.func.count(Appointment.id))
+        .filter(Appointment.doctor_id == doctor_id)
+        .group_by(Appointment.status)
+        .all()
+    )
+
+    has_chronic = db.select(PatientCondition.patient_id).where(
+        PatientCondition.patient_id == DoctorPatientLink.patient_id).exists()
+    total_patients, chronic_patients = db.session.query(
+        db.func.count(),
+        db.func.count(db.case((has_chronic, 1)))
+    ).filter(DoctorPatientLink.doctor_id == doctor_id).one()
+
+    return {
+        'total_appointments': sum(status_counts.values()),
+        'pending': status_counts.get('pending', 0),
+        'completed': status_counts.get('completed', 0),
+        'total_patients': total_patients,
+        'chronic_patients': chronic_patients,
+    }
+
+def get_patient_record_counts(patient_ids):
+    """Per-patient counts of files, tests, procedures and prescriptions in a single UNION ALL query"""
+    counts = {pid: {'files': 0, 'tests': 0, 'procedures': 0, 'prescriptions': 0, 'total': 0}
+              for pid in patient_ids}
+    if not counts:
+        return counts
+
+    per_type = [
+        db.select(db.literal(key).label('kind'), model.patient_id, db.func.count(model.id).label('n'))
+        .where(model.patient_id.in_(counts.keys()))
+        .group_by(model.patient_id)
+        for key, model in (('files', MedicalFile), ('tests', TestResult),
+                           ('procedures', Procedure), ('prescriptions', Prescription))
+    ]
+    for kind, patient_id, n in db.session.execute(db.union_all(*per_type)):
+        counts[patient_id][kind] = n
+        counts[patient_id]['total'] += n
+
+    return counts
+
+def get_doctor_dashboard_data(doctor_id, after=None, before=None, per_page=5):
+    """Everything the doctor dashboard renders, fetched in a fixed number of queries"""
+    query = Appointment.query.options(db.joinedload(Appointment.patient)).filter_by(doctor_id=doctor_id)
+    page = paginate_by_created(query, Appointment, after=after, before=before, per_page=per_page)
+
+    return {
+        'stats': get_doctor_dashboard_stats(doctor_id),
+        'page': page,
+        'recent_appointments': page.items,
+        'record_counts': get_patient_record_counts({apt.patient_id for apt in page.items}),
+    }
+
+# PAGINATION
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+KeysetPage = namedtuple('KeysetPage', ['items', 'next_cursor', 'prev_cursor', 'per_page'])
+
+def encode_cursor(when, row_id, kind=None):
+    parts = [when.isoformat(), str(row_id)] + ([kind] if kind else [])
+    return base64.urlsafe_b64encode('|'.join(parts).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Return (when, id, kind) for a cursor, or None if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        when, row_id, *kind = raw.split('|')
+        return datetime.fromisoformat(when), int(row_id), (kind[0] if kind else None)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def get_page_args(default_size=DEFAULT_PAGE_SIZE):
+    """Read after/before cursors and per_page from the query string"""
+    per_page = request.args.get('per_page', default_size, type=int)
+    return {
+        'after': request.args.get('after'),
+        'before': request.args.get('before'),
+        'per_page': max(1, min(per_page, MAX_PAGE_SIZE)),
+    }
+
+def paginate_by_created(query, model, after=None, before=None, per_page=DEFAULT_PAGE_SIZE):
+    """Keyset (seek) pagination over (created_at, id), newest first.
+
+    `after` continues towards older rows, `before` goes back towards newer rows.
+    """
+    created_at, row_id = model.created_at, model.id
+    after_key = decode_cursor(after) if after else None
+    before_key = decode_cursor(before) if before else None
+
+    if before_key:
+        ts, rid, _ = before_key
+        rows = query.filter(db.or_(created_at > ts, db.and_(created_at == ts, row_id > rid))).order_by(
+            created_at.asc(), row_id.asc()).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_newer, has_older = has_more, True
+    else:
+        if after_key:
+            ts, rid, _ = after_key
+            query = query.filter(db.or_(created_at < ts, db.and_(created_at == ts, row_id < rid)))
+        rows = query.order_by(created_at.desc(), row_id.desc()).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_newer, has_older = after_key is not None, len(rows) > per_page
+
+    next_cursor = encode_cursor(items[-1].created_at, items[-1].id) if items and has_older else None
+    prev_cursor = encode_cursor(items[0].created_at, items[0].id) if items and has_newer else None
+    return KeysetPage(items, next_cursor, prev_cursor, per_page)
+
+# DOCTOR SEARCH
+
+DOCTOR_SEARCH_PAGE_SIZE = 12
+
+def prefix_match(column, prefix):
+    """Case-insensitive prefix test written as a range on lower(column) so its index can be used.
+
+    The prefix is lowered the way the database's lower() will lower the column. SQLite's
+    lower() only folds ASCII, so there 'émile' does not match 'Émile'; Postgres folds both.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        prefix = ''.join(char.lower() if char.isascii() else char for char in prefix)
+    else:
+        prefix = prefix.lower()
+    upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return db.and_(db.func.lower(column) >= prefix, db.func.lower(column) < upper_bound)
+
+def get_doctor_search_filters():
+    """Read the doctor search filters from the query string"""
+    return {
+        'q': request.args.get('q', '').strip(),
+        'specialization': request.args.get('specialization', '').strip(),
+        'hospital': request.args.get('hospital', '').strip(),
+        'min_experience': request.args.get('min_experience', type=int),
+    }
+
+def search_doctors(q='', specialization='', hospital='', min_experience=None, page=1, per_page=DOCTOR_SEARCH_PAGE_SIZE):
+    """Filtered, paginated doctor directory ordered by username"""
+    query = Doctor.query
+    if q:
+        query = query.filter(prefix_match(Doctor.username, q))
+    if specialization:
+        query = query.filter(prefix_match(Doctor.specialization, specialization))
+    if hospital:
+        query = query.filter(prefix_match(Doctor.hospital, hospital))
+    if min_experience:
+        query = query.filter(Doctor.years_experience >= min_experience)
+    return query.order_by(db.func.lower(Doctor.username), Doctor.id).paginate(
+        page=page, per_page=min(per_page, MAX_PAGE_SIZE), error_out=False)
+
+def get_doctor_card_stats(doctor_ids):
+    """Patients seen and completed consultations for a page of doctors, in one GROUP BY"""
+    stats = {doctor_id: {'patients': 0, 'completed': 0} for doctor_id in doctor_ids}
+    if not stats:
+        return stats
+    rows = db.session.query(
+        Appointment.doctor_id,
+        db.func.count(db.distinct(Appointment.patient_id)),
+        db.func.count(db.case((Appointment.status == 'completed', Appointment.id)))
+    ).filter(Appointment.doctor_id.in_(stats.keys())).group_by(Appointment.doctor_id)
+    for doctor_id, patients, completed in rows:
+        stats[doctor_id] = {'patients': patients, 'completed': completed}
+    return stats
+
+# PATIENT TIMELINE
+
+TIMELINE_SOURCES = {
+    'file': (MedicalFile, MedicalFile.test_date),
+    'test': (TestResult, TestResult.test_date),
+    'procedure': (Procedure, Procedure.procedure_date),
+    'prescription': (Prescription, Prescription.prescribed_date),
+}
+
+def get_timeline_filters():
+    """Read type, date range, chronic-only and condition filters from the query string"""
+    kinds = [kind for kind in request.args.getlist('type') if kind in TIMELINE_SOURCES]
+    filters = {'kinds': kinds or list(TIMELINE_SOURCES), 'start': None, 'end': None,
+               'chronic_only': request.args.get('chronic') == '1',
+               'condition_id': request.args.get('condition', type=int)}
+    for key, arg in (('start', 'from'), ('end', 'to')):
+        try:
+            filters[key] = datetime.strptime(request.args.get(arg, ''), '%Y-%m-%d')
+        except ValueError:
+            pass
+    return filters
+
+def timeline_query_params(filters):
+    """Query string parameters that reproduce the given timeline filters"""
+    params = {}
+    if len(filters['kinds']) < len(TIMELINE_SOURCES):
+        params['type'] = filters['kinds']
+    if filters['start']:
+        params['from'] = filters['start'].strftime('%Y-%m-%d')
+    if filters['end']:
+        params['to'] = filters['end'].strftime('%Y-%m-%d')
+    if filters['chronic_only']:
+        params['chronic'] = '1'
+    if filters['condition_id']:
+        params['condition'] = filters['condition_id']
+    return params
+
+def _timeline_branch(kind, patient_id, start, end, chronic_only, condition_id, seek, descending, limit):
+    """One record table's slice of the timeline, already seeked, ordered and limited"""
+    model, date_col = TIMELINE_SOURCES[kind]
+    stmt = db.select(db.literal(kind).label('kind'), model.id.label('id'), date_col.label('date')).where(
+        model.patient_id == patient_id)
+
+    if start:
+        stmt = stmt.where(date_col >= start)
+    if end:
+        stmt = stmt.where(date_col < end + timedelta(days=1))
+    if chronic_only:
+        stmt = stmt.where(model.is_chronic_related.is_(True))
+    if condition_id:
+        stmt = stmt.where(model.condition_id == condition_id)
+
+    # Timeline order is (date, kind, id); kind is constant within a branch so the
+    # seek predicate reduces to a plain range on (date, id) that an index can serve
+    if seek:
+        ts, rid, seek_kind = seek
+        past_date = (date_col < ts) if descending else (date_col > ts)
+        if kind == seek_kind:
+            past_id = (model.id < rid) if descending else (model.id > rid)
+            stmt = stmt.where(db.or_(past_date, db.and_(date_col == ts, past_id)))
+        elif (kind < seek_kind) == descending:
+            stmt = stmt.where(db.or_(past_date, date_col == ts))
+        else:
+            stmt = stmt.where(past_date)
+
+    order = (date_col.desc(), model.id.desc()) if descending else (date_col.asc(), model.id.asc())
+    return db.select(stmt.order_by(*order).limit(limit).subquery())
+
+def _load_timeline_records(rows):
+    """Hydrate (kind, id, date) rows with one IN query per record type"""
+    ids_by_kind = {}
+    for kind, row_id, _ in rows:
+        ids_by_kind.setdefault(kind, []).append(row_id)
+
+    loaded = {}
+    for kind, ids in ids_by_kind.items():
+        model, _ = TIMELINE_SOURCES[kind]
+        for record in model.query.options(db.joinedload(model.doctor)).filter(model.id.in_(ids)):
+            loaded[(kind, record.id)] = record
+
+    return [{'type': kind, 'date': date, 'data': loaded[(kind, row_id)]} for kind, row_id, date in rows]
+
+def get_patient_timeline(patient_id, kinds=None, start=None, end=None, chronic_only=False, condition_id=None,
+                         after=None, before=None, per_page=25):
+    """Merged, date-ordered timeline of a patient's files, tests, procedures and prescriptions.
+
+    The record tables are merged with UNION ALL in SQL and paged with a (date, kind, id)
+    cursor, so only one page of rows is ever loaded.
+    """
+    kinds = kinds or list(TIMELINE_SOURCES)
+    seek = decode_cursor(before or after) if (before or after) else None
+    if seek and seek[2] not in TIMELINE_SOURCES:
+        seek = None
+    descending = not (before and seek)
+
+    branches = [_timeline_branch(kind, patient_id, start, end, chronic_only, condition_id, seek, descending,
+                                 per_page + 1)
+                for kind in kinds]
+    merged = db.union_all(*branches).subquery()
+    direction = db.desc if descending else db.asc
+    rows = db.session.execute(
+        db.select(merged.c.kind, merged.c.id, merged.c.date)
+        .order_by(direction(merged.c.date), direction(merged.c.kind), direction(merged.c.id))
+        .limit(per_page + 1)
+    ).all()
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if descending:
+        has_newer, has_older = seek is not None, has_more
+    else:
+        rows.reverse()
+        has_newer, has_older = has_more, True
+
+    items = _load_timeline_records(rows)
+    next_cursor = encode_cursor(items[-1]['date'], items[-1]['data'].id, items[-1]['type']) if items and has_older else None
+    prev_cursor = encode_cursor(items[0]['date'], items[0]['data'].id, items[0]['type']) if items and has_newer else None
+    return KeysetPage(items, next_cursor, prev_cursor, per_page)
+
+# RECORD SEARCH
+
+RECORD_SEARCH_PAGE_SIZE = 20
+SEARCH_DATES = {'test': TestResult.test_date, 'prescription': Prescription.start_date,
+                'procedure': Procedure.procedure_date, 'file': MedicalFile.test_date, 'record': MedicalRecord.created_at}
+SEARCH_KINDS_BY_CODE = {code: kind for kind, (_, code, _) in SEARCH_SOURCES.items()}
+
+SearchPage = namedtuple('SearchPage', ['items', 'page', 'per_page', 'has_next'])
+
+def search_terms(q):
+    """Words of a search box query; everything else is dropped so input never reaches MATCH/tsquery syntax"""
+    return re.findall(r'\w+', q.lower())[:10]
+
+def _search_sqlite_fts(patient_id, terms, limit, offset):
+    # The patient_key filter is itself an index lookup, so other patients' records are never scored
+    match = f'patient_key:p{int(patient_id)} AND body:(' + ' '.join(f'"{term}"*' for term in terms) + ')'
+    rows = db.session.execute(db.text(
+        'SELECT rowid, bm25(record_search, 0.0, 1.0) AS rank FROM record_search '
+        'WHERE record_search MATCH :match ORDER BY rank, rowid LIMIT :limit OFFSET :offset'),
+        {'match': match, 'limit': limit, 'offset': offset})
+    return [(SEARCH_KINDS_BY_CODE[rowid % 8], rowid // 8) for rowid, _ in rows]
+
+def _search_union(branches, order_by, limit, offset):
+    merged = db.union_all(*branches).subquery()
+    rows = db.session.execute(db.select(merged.c.kind, merged.c.id)
+                              .order_by(*order_by(merged.c)).limit(limit).offset(offset))
+    return [(kind, row_id) for kind, row_id in rows]
+
+def _search_postgres(patient_id, terms, limit, offset):
+    query = db.func.to_tsquery('english', ' & '.join(f'{term}:*' for term in terms))
+    branches = []
+    for kind, (model, _, _) in SEARCH_SOURCES.items():
+        vector = db.literal_column(f'{model.__tablename__}.search_vector')
+        branches.append(db.select(db.literal(kind).label('kind'), model.id.label('id'),
+                                  SEARCH_DATES[kind].label('date'), db.func.ts_rank_cd(vector, query).label('rank'))
+                        .where(model.patient_id == patient_id, vector.op('@@')(query)))
+    return _search_union(branches, lambda c: (c.rank.desc(), c.date.desc(), c.kind, c.id), limit, offset)
+
+def _search_like(patient_id, terms, limit, offset):
+    """Unranked fallback for SQLite builds without FTS5; only scans the one patient's rows"""
+    branches = []
+    for kind, (model, _, columns) in SEARCH_SOURCES.items():
+        # autoescape keeps a term's '_' (a word character) from matching any character
+        matches = [db.or_(*(getattr(model, column).icontains(term, autoescape=True) for column in columns))
+                   for term in terms]
+        branches.append(db.select(db.literal(kind).label('kind'), model.id.label('id'), SEARCH_DATES[kind].label('date'))
+                        .where(model.patient_id == patient_id, *matches))
+    return _search_union(branches, lambda c: (c.date.desc(), c.kind, c.id), limit, offset)
+
+@lru_cache(maxsize=None)
+def sqlite_search_table_exists():
+    # Created by migration 7 at startup, unless this SQLite build lacks FTS5
+    return db.inspect(db.engine).has_table('record_search')
+
+def search_patient_records(patient_id, q, page=1, per_page=RECORD_SEARCH_PAGE_SIZE):
+    """Ranked full-text search over one patient's tests, prescriptions, procedures, files and notes"""
+    terms = search_terms(q)
+    page, per_page = max(page, 1), min(per_page, MAX_PAGE_SIZE)
+    if not terms:
+        return SearchPage([], page, per_page, False)
+    args = (patient_id, terms, per_page + 1, (page - 1) * per_page)
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        hits = _search_postgres(*args)
+    elif dialect == 'sqlite' and sqlite_search_table_exists():
+        hits = _search_sqlite_fts(*args)
+    else:
+        hits = _search_like(*args)
+
+    has_next = len(hits) > per_page
+    hits = hits[:per_page]
+    ids_by_kind = {}
+    for kind, row_id in hits:
+        ids_by_kind.setdefault(kind, []).append(row_id)
+    loaded = {(kind, record.id): record for kind, ids in ids_by_kind.items()
+              for record in SEARCH_SOURCES[kind][0].query.filter(SEARCH_SOURCES[kind][0].id.in_(ids))}
+    items = [{'type': kind, 'data': loaded[(kind, row_id)],
+              'date': getattr(loaded[(kind, row_id)], SEARCH_DATES[kind].key)}
+             for kind, row_id in hits if (kind, row_id) in loaded]
+    return SearchPage(items, page, per_page, has_next)
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the patient record full-text index (e.g. after restoring tables by hand)"""
+    with db.engine.begin() as conn:
+        create_record_search_index(conn)
+    click.echo('Search index rebuilt')
+
+# LAB TRENDS
+#
+# Numeric test results are parsed into lab_value when written. Trends are computed per
+# (patient, test, unit) series over rows sorted by time, with NumPy when it is installed.
+
+LAB_VALUE_PATTERN = re.compile(r'^\s*(?:[<>≤≥]=?\s*)?(-?\d+(?:\.\d+)?)\s*([a-zA-Zµμ%°][^\n]*)?$')
+LAB_RANGE_BETWEEN = re.compile(r'(-?\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(-?\d+(?:\.\d+)?)', re.IGNORECASE)
+LAB_RANGE_BOUND = re.compile(r'^\s*(<=?|≤|up to|below|under|>=?|≥|above|over)\s*(-?\d+(?:\.\d+)?)', re.IGNORECASE)
+LAB_UPPER_BOUNDS = ('<', '≤', 'up to', 'below', 'under')
+LAB_THOUSANDS = re.compile(r'(?<![\d.,])[1-9]\d{0,2}(?:,\d{3})+(?![\d,])')
+LAB_TREND_POINTS = 40  # most recent values drawn in a sparkline
+
+def normalize_lab_number(text):
+    """Drop thousands separators ('4,500'), then read any comma left as a decimal point ('5,6')"""
+    return LAB_THOUSANDS.sub(lambda match: match.group().replace(',', ''), text or '').replace(',', '.')
+
+def parse_lab_value(text):
+    """(value, unit) from a result such as '7.2 %' or '< 0.5 mg/dL', or None if it is not numeric"""
+    match = LAB_VALUE_PATTERN.match(normalize_lab_number(text))
+    if not match:
+        return None
+    return float(match.group(1)), ' '.join((match.group(2) or '').split())[:50]
+
+def parse_normal_range(text):
+    """(low, high) from a range such as '4.0-5.6', '< 7' or '> 60'; missing bounds are None"""
+    text = normalize_lab_number(text)
+    match = LAB_RANGE_BOUND.match(text)
+    if match:
+        bound = float(match.group(2))
+        return (None, bound) if match.group(1).lower().startswith(LAB_UPPER_BOUNDS) else (bound, None)
+    match = LAB_RANGE_BETWEEN.search(text)
+    if match:
+        low, high = sorted((float(match.group(1)), float(match.group(2))))
+        return low, high
+    return None, None
+
+def lab_value_fields(patient_id, test_name, result_value, normal_range, test_date):
+    parsed = parse_lab_value(result_value)
+    if parsed is None or not test_name or test_date is None:
+        return None
+    low, high = parse_normal_range(normal_range)
+    return {'patient_id': patient_id, 'test_key': condition_key(test_name), 'value': parsed[0], 'unit': parsed[1],
+            'range_low': low, 'range_high': high, 'measured_at': test_date}
+
+def build_lab_value(test_result):
+    """LabValue for a new TestResult, or None when its result is not numeric"""
+    fields = lab_value_fields(test_result.patient_id, test_result.test_name, test_result.result_value,
+                              test_result.normal_range, test_result.test_date)
+    return LabValue(**fields) if fields else None
+
+def index_lab_values(executor, patient_ids=None, batch_size=5000):
+    """Parse test results that have no lab_value row yet; returns how many were added"""
+    results, values = TestResult.__table__, LabValue.__table__
+    stmt = (db.select(results.c.id, results.c.patient_id, results.c.test_name, results.c.result_value,
+                      results.c.normal_range, results.c.test_date)
+            .where(~db.exists().where(values.c.test_result_id == results.c.id))
+            .order_by(results.c.id).limit(batch_size))
+    if patient_ids is not None:
+        stmt = stmt.where(results.c.patient_id.in_(list(patient_ids)))
+    added, last_id = 0, 0
+    while True:
+        rows = executor.execute(stmt.where(results.c.id > last_id)).all()
+        if not rows:
+            return added
+        last_id = rows[-1].id
+        parsed = [dict(fields, test_result_id=row.id) for row in rows
+                  for fields in [lab_value_fields(*row[1:])] if fields]
+        if parsed:
+            executor.execute(values.insert(), parsed)
+            added += len(parsed)
+
+def _lab_stats_numpy(rows, starts, window):
+    n = len(rows)
+    _, _, _, _, value, low, high, _, day = zip(*rows)
+    t, v = np.fromiter(day, np.float64, n), np.fromiter(value, np.float64, n)
+    low, high = np.array(low, dtype=np.float64), np.array(high, dtype=np.float64)  # None becomes NaN
+    starts = np.array(starts)
+    counts = np.diff(np.append(starts, n))
+    series = np.repeat(np.arange(len(starts)), counts)
+
+    # Least-squares slope of each series, on times and values centred per series
+    mean_t = np.add.reduceat(t, starts) / counts
+    mean_v = np.add.reduceat(v, starts) / counts
+    tc, vc = t - mean_t[series], v - mean_v[series]
+    sxx, sxy = np.add.reduceat(tc * tc, starts), np.add.reduceat(tc * vc, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(sxx > 0, sxy / sxx * 365.25, np.nan)
+        is_high, is_low = v > high, v < low  # False where the bound is missing
+    out_of_range = np.add.reduceat((is_high | is_low).astype(np.int64), starts)
+
+    # Rolling mean over the last `window` values, never reaching back into the previous series
+    prefix = np.concatenate(([0.0], np.cumsum(v)))
+    index = np.arange(n)
+    first = np.maximum(index - window + 1, starts[series])
+    rolling = (prefix[index + 1] - prefix[first]) / (index + 1 - first)
+
+    minimum, maximum = np.minimum.reduceat(v, starts), np.maximum.reduceat(v, starts)
+    stats = []
+    for i, (start, count) in enumerate(zip(starts.tolist(), counts.tolist())):
+        end = start + count - 1
+        tail = slice(max(start, end - LAB_TREND_POINTS + 1), end + 1)
+        stats.append({
+            'count': count, 'mean': float(mean_v[i]), 'min': float(minimum[i]), 'max': float(maximum[i]),
+            'previous': float(v[end - 1]) if count > 1 else None, 'rolling_mean': float(rolling[end]),
+            'slope_per_year': None if np.isnan(slope[i]) else float(slope[i]),
+            'out_of_range': int(out_of_range[i]),
+            'flag': 'high' if is_high[end] else 'low' if is_low[end] else None,
+            'points': v[tail].tolist(), 'rolling_points': rolling[tail].tolist(),
+        })
+    return stats
+
+def _lab_stats_python(rows, starts, window):
+    stats = []
+    for start, end in zip(starts, starts[1:] + [len(rows)]):
+        values = [row[4] for row in rows[start:end]]
+        days = [row[8] - rows[start][8] for row in rows[start:end]]
+        count = len(values)
+        mean_t, mean_v = sum(days) / count, sum(values) / count
+        sxx = sum((t - mean_t) ** 2 for t in days)
+        sxy = sum((t - mean_t) * (v - mean_v) for t, v in zip(days, values))
+        rolling = [sum(values[max(0, i - window + 1):i + 1]) / (i + 1 - max(0, i - window + 1)) for i in range(count)]
+        flags = ['high' if high is not None and value > high else 'low' if low is not None and value < low else None
+                 for _, _, _, _, value, low, high, _, _ in rows[start:end]]
+        stats.append({
+            'count': count, 'mean': mean_v, 'min': min(values), 'max': max(values),
+            'previous': values[-2] if count > 1 else None, 'rolling_mean': rolling[-1],
+            'slope_per_year': sxy / sxx * 365.25 if sxx > 0 else None,
+            'out_of_range': sum(flag is not None for flag in flags), 'flag': flags[-1],
+            'points': values[-LAB_TREND_POINTS:], 'rolling_points': rolling[-LAB_TREND_POINTS:],
+        })
+    return stats
+
+def compute_lab_trends(rows, window=3, use_numpy=None):
+    """Statistics for each (patient, test, unit) series in rows of (patient_id, test_key, unit,
+    measured_at, value, range_low, range_high, test_result_id, day number), sorted by series then time"""
+    if not rows:
+        return []
+    keys = [row[:3] for row in rows]
+    starts = [0] + [i for i in range(1, len(keys)) if keys[i] != keys[i - 1]]
+    use_numpy = np is not None if use_numpy is None else use_numpy
+    stats = (_lab_stats_numpy if use_numpy else _lab_stats_python)(rows, starts, window)
+    for start, end, series in zip(starts, starts[1:] + [len(rows)], stats):
+        latest = rows[end - 1]
+        series.update(patient_id=latest[0], test_key=latest[1], unit=latest[2], first_at=rows[start][3],
+                      last_at=latest[3], latest=latest[4], low=latest[5], high=latest[6],
+                      test_result_id=latest[7])
+        if series['flag'] is None and (latest[5] is not None or latest[6] is not None):
+            series['flag'] = 'normal'
+    return stats
+
+def sparkline_points(values, width=120, height=30):
+    """SVG polyline points scaling values into a width x height box"""
+    if len(values) < 2:
+        return ''
+    low, high = min(values), max(values)
+    span = (high - low) or 1.0
+    step = width / (len(values) - 1)
+    return ' '.join(f'{i * step:.1f},{height - (value - low) / span * height:.1f}' for i, value in enumerate(values))
+
+def day_number(column):
+    """A datetime column as fractional days, computed by the database"""
+    if db.engine.dialect.name == 'sqlite':
+        return db.func.julianday(column)
+    return db.extract('epoch', column) / 86400.0
+
+def lab_value_rows(patient_ids):
+    """The patients' lab values as compute_lab_trends expects them"""
+    return db.session.execute(
+        db.select(LabValue.patient_id, LabValue.test_key, LabValue.unit, LabValue.measured_at, LabValue.value,
+                  LabValue.range_low, LabValue.range_high, LabValue.test_result_id, day_number(LabValue.measured_at))
+        .where(LabValue.patient_id.in_(patient_ids))
+        .order_by(LabValue.patient_id, LabValue.test_key, LabValue.unit, LabValue.measured_at, LabValue.id)).all()
+
+def get_lab_trends(patient_ids, use_numpy=None):
+    """{patient id: [series, ...]} for the patients' numeric test results, most recently measured first"""
+    trends = {patient_id: [] for patient_id in patient_ids}
+    if not trends:
+        return trends
+    stats = compute_lab_trends(lab_value_rows(list(trends)), app.config['LAB_TREND_WINDOW'], use_numpy)
+    names = dict(db.session.execute(db.select(TestResult.id, TestResult.test_name)
+                                    .where(TestResult.id.in_([series['test_result_id'] for series in stats]))).all())
+    for series in stats:
+        series['name'] = names.get(series['test_result_id'], series['test_key'])
+        series['sparkline'] = sparkline_points(series['points'])
+        trends[series['patient_id']].append(series)
+    for series_list in trends.values():
+        series_list.sort(key=lambda series: series['last_at'], reverse=True)
+    return trends
+
+# Keyed by records_version, so a new result makes the old summary unreachable
+lab_trend_cache = TTLCache(ttl=app.config['LAB_TREND_CACHE_TTL'], maxsize=1024)
+
+def get_lab_trend_summary(patient):
+    """Cached trend series for one patient's history page"""
+    key = (patient.id, patient.records_version)
+    summary = lab_trend_cache.get(key)
+    if summary is None:
+        summary = get_lab_trends([patient.id])[patient.id]
+        lab_trend_cache.set(key, summary)
+    return summary
+
+@app.cli.command('index-lab-values')
+def index_lab_values_command():
+    """Parse numeric values from test results that are not yet in the lab_value table"""
+    with db.engine.begin() as conn:
+        added = index_lab_values(conn)
+    click.echo(f'Indexed {added} lab values')
+
+# BULK IMPORT
+
+# Record types accepted by import-records and /api/import/records, keyed by their record_type
+IMPORT_MODELS = {
+    'test_result': TestResult, 'prescription': Prescription, 'procedure': Procedure,
+    'medical_record': MedicalRecord, 'medical_file': MedicalFile,
+}
+# Columns that only steer the import; patient_email/doctor_email stand in for the ids
+IMPORT_CONTROL_COLUMNS = {'record_type', 'patient_email', 'doctor_email'}
+# Columns the app fills in itself: where a file is stored and how far its processing got.
+# An imported medical_file names a blob already in the store by its sha256.
+IMPORT_SERVER_COLUMNS = {MedicalFile: {'filename', 'file_size', 'processing_status', 'processing_started_at',
+                                       'processing_error', 'has_preview'}}
+SHA256_PATTERN = re.compile(r'[0-9a-f]{64}')
+MAX_REPORTED_IMPORT_ERRORS = 1000
+
+class ImportRowError(ValueError):
+    pass
+
+def parse_import_value(column, value):
+    """Convert a CSV/JSON value to the column's Python type"""
+    if value is None or value == '':
+        return None
+    column_type = column.type
+    if isinstance(column_type, db.Boolean):
+        if isinstance(value, bool):
+            return value
+        if str(value).strip().lower() in ('1', 'true', 'yes', 'y'):
+            return True
+        if str(value).strip().lower() in ('0', 'false', 'no', 'n'):
+            return False
+        raise ImportRowError(f'{column.name} must be true or false')
+    try:
+        if isinstance(column_type, db.DateTime):
+            return datetime.fromisoformat(str(value).strip())
+        if isinstance(column_type, db.Date):
+            return date_type.fromisoformat(str(value).strip())
+        if isinstance(column_type, db.Integer):
+            if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                raise ValueError()
+            return int(value)
+    except ValueError:
+        raise ImportRowError(f'{column.name}: invalid value {str(value)[:50]!r}')
+    value = str(value)
+    if getattr(column_type, 'length', None) and len(value) > column_type.length:
+        raise ImportRowError(f'{column.name} is longer than {column_type.length} characters')
+    return value
+
+def is_required_column(column):
+    return (not column.nullable and not column.primary_key
+            and column.default is None and column.server_default is None)
+
+class RecordImporter:
+    """Validates rows as they stream in and inserts them in batches, collecting
+    per-row errors instead of aborting the import"""
+
+    def __init__(self, default_type=None, default_doctor_id=None):
+        if default_type is not None and default_type not in IMPORT_MODELS:
+            raise ValueError(f'Unknown record type {default_type!r}')
+        self.default_type = default_type
+        self.default_doctor_id = default_doctor_id
+        self.batch_size = app.config['IMPORT_BATCH_SIZE']
+        self.commit_rows = app.config['IMPORT_COMMIT_ROWS']
+        self.imported = {record_type: 0 for record_type in IMPORT_MODELS}
+        self.errors = []
+        self.error_count = 0
+        self._pending = {model: [] for model in IMPORT_MODELS.values()}
+        self._pending_rows = 0
+        self._uncommitted_rows = 0
+        self._touched_patients = set()
+        self._lab_patients = set()
+        self._ids_by_email = {}
+        self._existing_ids = {}
+        self._condition_ids = {}
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_IMPORT_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def _resolve_email(self, model, email):
+        key = (model, email.strip().lower())
+        if key not in self._ids_by_email:
+            self._ids_by_email[key] = db.session.execute(
+                db.select(model.id).where(model.email == key[1])).scalar()
+        if self._ids_by_email[key] is None:
+            raise ImportRowError(f'no {model.__tablename__} with email {email}')
+        return self._ids_by_email[key]
+
+    def _check_exists(self, model, record_id):
+        key = (model, record_id)
+        if key not in self._existing_ids:
+            self._existing_ids[key] = db.session.get(model, record_id) is not None
+        if not self._existing_ids[key]:
+            raise ImportRowError(f'{model.__tablename__} {record_id} does not exist')
+
+    def _stored_blob(self, digest):
+        """filename and file_size for a medical_file row, whose sha256 must name a stored blob"""
+        if digest is None:
+            raise ImportRowError('missing sha256')
+        if not SHA256_PATTERN.fullmatch(digest) or not blob_store.exists(digest):
+            raise ImportRowError(f'sha256 {digest[:80]} is not a stored file')
+        return {'filename': digest, 'file_size': os.path.getsize(blob_store.path_for(digest))}
+
+    def _resolve_condition(self, text):
+        if text not in self._condition_ids:
+            self._condition_ids[text] = record_condition_id(text)
+        return self._condition_ids[text]
+
+    def validate(self, row):
+        """Column values for one row, and its model; raises ImportRowError"""
+        record_type = row.get('record_type') or self.default_type
+        if record_type not in IMPORT_MODELS:
+            raise ImportRowError(f'record_type must be one of {", ".join(IMPORT_MODELS)}')
+        if None in row:
+            raise ImportRowError('more fields than the header has columns')
+        model = IMPORT_MODELS[record_type]
+        server_columns = IMPORT_SERVER_COLUMNS.get(model, set())
+        columns = {column.name: column for column in model.__table__.columns
+                   if not column.primary_key and column.name not in server_columns}
+        given = {name for name, value in row.items() if value not in (None, '')}
+        if given & server_columns:
+            raise ImportRowError(f'cannot import {", ".join(sorted(given & server_columns))}')
+        # Mixed-type CSVs carry every type's columns; only values in another type's columns are errors
+        unknown = {name for name in given if name not in columns and name not in IMPORT_CONTROL_COLUMNS}
+        if unknown:
+            raise ImportRowError(f'unknown columns for {record_type}: {", ".join(sorted(unknown))}')
 
-class MedicalRecord(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
-    doctor_id = db.Column(db.Integer, db.ForeignKey('doctor.id'), nullable=False)
-    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=True)
-    diagnosis = db.Column(db.Text, nullable=False)
-    treatment = db.Column(db.Text)
-    prescription = db.Column(db.Text)
-    notes = db.Column(db.Text)
-    visit_date = db.Column(db.String(20), nullable=False)
-    follow_up_required = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+        values = {name: parse_import_value(columns[name], value)
+                  for name, value in row.items() if name in columns}
+        if row.get('patient_email') and values.get('patient_id') is None:
+            values['patient_id'] = self._resolve_email(Patient, row['patient_email'])
+        if row.get('doctor_email') and values.get('doctor_id') is None:
+            values['doctor_id'] = self._resolve_email(Doctor, row['doctor_email'])
+        if values.get('doctor_id') is None and self.default_doctor_id is not None:
+            values['doctor_id'] = self.default_doctor_id
+        if model is MedicalFile:
+            values.update(self._stored_blob(values.get('sha256')))
 
-# EMAIL FUNCTIONS
+        missing = [name for name, column in columns.items() if is_required_column(column) and values.get(name) is None]
+        if missing:
+            raise ImportRowError(f'missing {", ".join(missing)}')
+        self._check_exists(Patient, values['patient_id'])
+        if values.get('doctor_id') is not None:
+            self._check_exists(Doctor, values['doctor_id'])
+        if values.get('chronic_condition') and 'condition_id' in columns and values.get('condition_id') is None:
+            values['condition_id'] = self._resolve_condition(values['chronic_condition'])
+        return model, {name: value for name, value in values.items() if value is not None}
+
+    def add(self, line, row):
+        try:
+            model, values = self.validate(row)
+        except ImportRowError as e:
+            self.error(line, str(e))
+            return
+        self._pending[model].append((line, values))
+        self._pending_rows += 1
+        if self._pending_rows >= self.batch_size:
+            self.flush()
+
+    def _insert(self, model, rows):
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(model), [values for _, values in rows])
+            return rows
+        except SQLAlchemyError:
+            if len(rows) == 1:
+                raise
+        # Retry one row at a time so only the rows the database rejects are reported
+        inserted = []
+        for row in rows:
+            try:
+                inserted += self._insert(model, [row])
+            except SQLAlchemyError as e:
+                self.error(row[0], str(getattr(e, 'orig', e)).splitlines()[0])
+        return inserted
 
-def send_email(to, subject, template_name, **kwargs):
+    def flush(self):
+        for record_type, model in IMPORT_MODELS.items():
+            rows, self._pending[model] = self._pending[model], []
+            if not rows:
+                continue
+            inserted = self._insert(model, rows)
+            self.imported[record_type] += len(inserted)
+            self._uncommitted_rows += len(inserted)
+            self._touched_patients.update(values['patient_id'] for _, values in inserted)
+            if model is TestResult:
+                self._lab_patients.update(values['patient_id'] for _, values in inserted)
+        self._pending_rows = 0
+        if self._uncommitted_rows >= self.commit_rows:
+            self.commit()
+
+    def commit(self):
+        # Numeric results are parsed into lab_value before their rows are committed
+        lab_patients = sorted(self._lab_patients)
+        for i in range(0, len(lab_patients), 500):
+            index_lab_values(db.session, lab_patients[i:i + 500])
+        self._lab_patients = set()
+        # Cached history fragments of every patient who received records are invalidated with the commit
+        if self._touched_patients:
+            db.session.execute(db.update(Patient).where(Patient.id.in_(self._touched_patients))
+                               .values(records_version=Patient.records_version + 1))
+        db.session.commit()
+        self._touched_patients = set()
+        self._uncommitted_rows = 0
+
+    def finish(self):
+        self.flush()
+        self.commit()
+        return {'imported': self.imported, 'error_count': self.error_count, 'errors': self.errors}
+
+def read_import_rows(stream, fmt):
+    """Yield (line number, row dict) from a CSV or JSON-lines text stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ImportRowError(f'invalid JSON: {e}')
+                continue
+            yield line_number, row if isinstance(row, dict) else ImportRowError('each line must be a JSON object')
+    else:
+        raise ValueError(f'Unknown import format {fmt!r}')
+
+def import_records(stream, fmt, default_type=None, default_doctor_id=None):
+    """Stream rows into the record tables; returns counts per type and the row errors"""
+    importer = RecordImporter(default_type=default_type, default_doctor_id=default_doctor_id)
     try:
-        print(f"🔍 Starting email send to: {to}")
-        print(f"🔍 SendGrid API Key exists: {bool(app.config.get('SENDGRID_API_KEY'))}")
-        print(f"🔍 API Key length: {len(app.config.get('SENDGRID_API_KEY', ''))}")
-        
-        # Check if SendGrid is configured
-        if not app.config.get('SENDGRID_API_KEY'):
-            print(" SENDGRID_API_KEY not found in environment!")
-            return False
-            
-        # Create email content
-        html_content = render_email_template(template_name, **kwargs)
-        print(f"🔍 Email content generated successfully")
-        
-        # Create SendGrid message
-        message = Mail(
-            from_email='s.kayitare@alustudent.com',
-            to_emails=to,
-            subject=f"E-Vura Healthcare: {subject}",
-            html_content=html_content
-        )
-        print(f" SendGrid message created")
-        
-        # Send via SendGrid
-        sg = SendGridAPIClient(api_key=app.config['SENDGRID_API_KEY'])
-        print(f" SendGrid client initialized")
-        
-        response = sg.send(message)
-        print(f"Email sent to {to}: {subject} (Status: {response.status_code})")
-        print(f"Response body: {response.body}")
+        for line, row in read_import_rows(stream, fmt):
+            if isinstance(row, ImportRowError):
+                importer.error(line, str(row))
+            else:
+                importer.add(line, row)
+        return importer.finish()
+    except Exception:
+        db.session.rollback()
+        raise
+
+@app.cli.command('import-records')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Defaults to the file extension.')
+@click.option('--type', 'record_type', type=click.Choice(list(IMPORT_MODELS)), default=None,
+              help='Record type for rows without a record_type column.')
+@click.option('--errors', 'errors_path', type=click.Path(dir_okay=False), default=None,
+              help='Write rejected rows to this JSON-lines file.')
+def import_records_command(path, fmt, record_type, errors_path):
+    """Bulk import historical records from a CSV or JSON-lines file"""
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    started = perf_counter()
+    with open(path, newline='', encoding='utf-8-sig') as stream:
+        report = import_records(stream, fmt, default_type=record_type)
+    total = sum(report['imported'].values())
+    click.echo(f"Imported {total} rows in {perf_counter() - started:.1f}s: "
+               + ', '.join(f'{n} {kind}' for kind, n in report['imported'].items() if n))
+    if report['error_count']:
+        click.echo(f"{report['error_count']} rows rejected")
+        if errors_path:
+            with open(errors_path, 'w') as out:
+                for error in report['errors']:
+                    out.write(json.dumps(error) + '\n')
+        else:
+            for error in report['errors'][:20]:
+                click.echo(f"  line {error['line']}: {error['error']}")
+
+# HISTORY EXPORT
+
+# Record tables in export order, with the column each is ordered by
+EXPORT_SOURCES = [
+    ('medical_record', MedicalRecord, MedicalRecord.visit_date),
+    ('test_result', TestResult, TestResult.test_date),
+    ('procedure', Procedure, Procedure.procedure_date),
+    ('prescription', Prescription, Prescription.start_date),
+    ('medical_file', MedicalFile, MedicalFile.test_date),
+]
+EXPORT_FORMATS = ('jsonl', 'fhir')
+EXPORT_BATCH_SIZE = 500
+EXPORT_FILE_CHUNK = 1024 * 1024
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+def _json_value(value):
+    if isinstance(value, (datetime, date_type, time_type)):
+        return value.isoformat()
+    return value
+
+def export_columns(obj, exclude=()):
+    return {column.name: _json_value(getattr(obj, column.key))
+            for column in obj.__mapper__.columns if column.name not in exclude}
+
+def iter_patient_records(patient_id):
+    """(record_type, row) for every record of a patient, fetched in batches rather than all at once"""
+    for record_type, model, order_column in EXPORT_SOURCES:
+        query = (db.select(model).where(model.patient_id == patient_id).order_by(order_column, model.id)
+                 .execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for record in db.session.scalars(query):
+            yield record_type, record
+
+def export_archive_path(medical_file):
+    return f'files/{medical_file.id}-{secure_filename(medical_file.original_filename) or "file"}'
+
+def _reference(resource_type, record_id):
+    return {'reference': f'{resource_type}/{record_id}'} if record_id is not None else None
+
+def _text(value):
+    return {'text': value} if value else None
+
+def fhir_resource(record_type, record):
+    """A FHIR R4-shaped resource for a record (free-text codes; no terminology mapping)"""
+    patient = _reference('Patient', getattr(record, 'patient_id', None))
+    doctor = _reference('Practitioner', getattr(record, 'doctor_id', None))
+    if record_type == 'patient':
+        resource = {
+            'resourceType': 'Patient', 'id': str(record.id), 'name': [{'text': record.username}],
+            'telecom': [t for t in ({'system': 'email', 'value': record.email},
+                                    {'system': 'phone', 'value': record.phone}) if t['value']],
+            'birthDate': record.date_of_birth or None,
+            'address': [{'text': record.address}] if record.address else None,
+            'extension': [{'url': f'urn:evura:{name}', 'valueString': getattr(record, name)}
+                          for name in ('blood_type', 'allergies', 'chronic_conditions', 'emergency_contact')
+                          if getattr(record, name)] or None,
+        }
+    elif record_type == 'medical_record':
+        resource = {
+            'resourceType': 'Encounter', 'id': str(record.id), 'status': 'finished', 'subject': patient,
+            'participant': [{'individual': doctor}], 'period': {'start': record.visit_date},
+            'reasonCode': [{'text': record.diagnosis}],
+            'note': [{'text': text} for text in (record.treatment, record.prescription, record.notes) if text] or None,
+        }
+    elif record_type == 'test_result':
+        resource = {
+            'resourceType': 'Observation', 'id': str(record.id), 'status': 'final', 'subject': patient,
+            'performer': [doctor] if doctor else None, 'code': {'text': record.test_name},
+            'category': [{'text': record.test_type}], 'valueString': record.result_value,
+            'referenceRange': [{'text': record.normal_range}] if record.normal_range else None,
+            'interpretation': [{'text': record.interpretation}] if record.interpretation else None,
+            'effectiveDateTime': _json_value(record.test_date),
+            'derivedFrom': [_reference('DocumentReference', record.medical_file_id)] if record.medical_file_id else None,
+        }
+    elif record_type == 'procedure':
+        resource = {
+            'resourceType': 'Procedure', 'id': str(record.id), 'status': 'completed', 'subject': patient,
+            'performer': [{'actor': doctor}] if doctor else None, 'code': {'text': record.procedure_name},
+            'category': _text(record.procedure_type), 'performedDateTime': _json_value(record.procedure_date),
+            'outcome': _text(record.outcome), 'complication': [{'text': record.complications}] if record.complications else None,
+            'note': [{'text': record.description}],
+        }
+    elif record_type == 'prescription':
+        resource = {
+            'resourceType': 'MedicationRequest', 'id': str(record.id), 'status': 'active' if not record.end_date else 'completed',
+            'intent': 'order', 'subject': patient, 'requester': doctor,
+            'medicationCodeableConcept': {'text': record.medication_name},
+            'dosageInstruction': [{'text': ', '.join(filter(None, (record.dosage, record.frequency, record.duration,
+                                                                    record.instructions)))}],
+            'reasonCode': [{'text': record.reason}], 'authoredOn': _json_value(record.prescribed_date),
+            'dispenseRequest': {'validityPeriod': {'start': _json_value(record.start_date),
+                                                   'end': _json_value(record.end_date)}},
+        }
+    else:
+        resource = {
+            'resourceType': 'DocumentReference', 'id': str(record.id), 'status': 'current', 'subject': patient,
+            'author': [doctor] if doctor else None, 'type': {'text': record.file_type},
+            'category': [{'text': record.file_category}], 'date': _json_value(record.uploaded_at),
+            'description': record.description,
+            'content': [{'attachment': {
+                'contentType': mimetypes.guess_type(record.original_filename)[0] or 'application/octet-stream',
+                'title': record.original_filename, 'size': record.file_size,
+                'url': url_for('download_medical_file', file_id=record.id),
+                'creation': _json_value(record.test_date),
+            }}],
+        }
+    return {key: value for key, value in resource.items() if value is not None}
+
+def iter_history_jsonl(patient, archive_paths=False):
+    """One JSON object per line: the profile first, then every record"""
+    yield json.dumps({'type': 'patient', 'data': export_columns(patient, exclude={'password'})}) + '\n'
+    for record_type, record in iter_patient_records(patient.id):
+        data = export_columns(record)
+        if archive_paths and record_type == 'medical_file':
+            data['archive_path'] = export_archive_path(record)
+        yield json.dumps({'type': record_type, 'data': data}) + '\n'
+
+def iter_history_fhir(patient):
+    """A FHIR collection Bundle, written entry by entry"""
+    yield json.dumps({'resourceType': 'Bundle', 'type': 'collection',
+                      'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z'})[:-1] + ', "entry": ['
+    yield json.dumps({'resource': fhir_resource('patient', patient)})
+    for record_type, record in iter_patient_records(patient.id):
+        yield ',\n' + json.dumps({'resource': fhir_resource(record_type, record)})
+    yield ']}\n'
+
+class ZipStream(io.RawIOBase):
+    """Write-only sink for zipfile; what was written so far is taken with drain()"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
         return True
-        
-    except Exception as e:
-        print(f" Email failed to {to}: {e}")
-        print(f" Error type: {type(e).__name__}")
-        import traceback
-        print(f" Full traceback: {traceback.format_exc()}")
-        return False
-        
-def render_email_template(template_name, **kwargs):
-    """Email templates with alerts"""
-    base_style = """
-    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; border: 1px solid #e5e7eb; border-radius: 15px; overflow: hidden;">
-        <div style="background: linear-gradient(135deg, #0d9488, #14b8a6); color: white; padding: 25px; text-align: center;">
-            <h2 style="margin: 0; font-size: 28px; font-weight: bold;">E-Vura Healthcare</h2>
-            <p style="margin: 8px 0 0; opacity: 0.9; font-size: 16px;">Your Smart Healthcare Connection</p>
-        </div>
-        <div style="padding: 30px;">
-            {content}
-        </div>
-        <div style="background: #f9fafb; padding: 20px; text-align: center; border-top: 1px solid #e5e7eb; color: #6b7280;">
-            <p style="margin: 0; font-size: 14px;">© 2025 E-Vura Healthcare Platform</p>
-            <p style="margin: 5px 0 0; font-size: 14px;">Bumbogo, Kigali Innovation City, Rwanda</p>
-            <p style="margin: 5px 0 0; font-size: 14px;">+250 784 650 21/2 | info@e-vura.com</p>
-        </div>
-    </div>
-    """
-    
-    templates = {
-        'appointment_request': f"""
-            <div style="text-align: center; margin-bottom: 25px;">
-                <h3 style="color: #0d9488; font-size: 24px; margin-bottom: 10px;">🩺 New Appointment Request</h3>
-            </div>
-            
-            <p style="font-size: 16px; line-height: 1.6;">Dear <strong>Dr. {kwargs.get('doctor_name')}</strong>,</p>
-            <p style="font-size: 16px; line-height: 1.6;">You have received a new appointment request from a patient:</p>
-            
-            <div style="background: #f0f9ff; border-left: 4px solid #0ea5e9; padding: 20px; margin: 25px 0; border-radius: 8px;">
-                <p style="margin: 8px 0; font-size: 15px;"><strong>** Patient:</strong> {kwargs.get('patient_name')}</p>
-                <p style="margin: 8px 0; font-size: 15px;"><strong>** Date:</strong> {kwargs.get('date')}</p>
-                <p style="margin: 8px 0; font-size: 15px;"><strong>** Time:</strong> {kwargs.get('time')}</p>
-                <p style="margin: 8px 0; font-size: 15px;"><strong>** Reason:</strong> {kwargs.get('reason', 'General consultation')}</p>
-                {f"<div style='background: #fef2f2; border: 1px solid #fecaca; padding: 15px; border-radius: 8px; margin-top: 15px;'><p style='margin: 0; color: #dc2626; font-weight: bold; font-size: 15px;'>⚠️ CHRONIC CONDITION: {kwargs.get('chronic_conditions')}</p></div>" if kwargs.get('chronic_conditions') else ""}
-            </div>
-            
-            <div style="background: #ecfdf5; border-left: 4px solid #10b981; padding: 15px; margin: 25px 0; border-radius: 8px;">
-                <p style="margin: 0; color: #065f46; font-size: 14px;">
-                    <strong>** Next Steps:</strong> Please log in to your E-Vura dashboard to review and respond to this appointment request.
-                </p>
-            </div>
-            
-            <p style="margin-top: 30px; font-size: 16px;">Best regards,<br><strong>The E-Vura Healthcare Team</strong></p>
-        """,
-        
-        'appointment_confirmed': f"""
-            <div style="text-align: center; margin-bottom: 25px;">
-                <h3 style="color: #10b981; font-size: 24px; margin-bottom: 10px;"> Appointment Confirmed!</h3>
-            </div>
-            
-            <p style="font-size: 16px; line-height: 1.6;">Dear <strong>{kwargs.get('patient_name')}</strong>,</p>
-            <p style="font-size: 16px; line-height: 1.6;">Great news! Your appointment has been <strong style="color: #10b981;">confirmed</strong>:</p>
-            
-            <div style="background: #ecfdf5; border-left: 4px solid #10b981; padding: 20px; margin: 25px 0; border-radius: 8px;">
-                <p style="margin: 8px 0; font-size: 15px;"><strong>** Doctor:</strong> Dr. {kwargs.get('doctor_name')}</p>
-                <p style="margin: 8px 0; font-size: 15px;"><strong>** Date:</strong> {kwargs.get('date')}</p>
-                <p style="margin: 8px 0; font-size: 15px;"><strong>** Time:</strong> {kwargs.get('time')}</p>
-                <p style="margin: 8px 0; font-size: 15px;"><strong>** Location:</strong> {kwargs.get('hospital', 'Please contact doctor for location details')}</p>
-            </div>
-            
-            <div style="background: #fef7f0; border-left: 4px solid #f59e0b; padding: 20px; margin: 25px 0; border-radius: 8px;">
-                <p style="margin: 0 0 10px; color: #92400e; font-weight: bold; font-size: 15px;">** Important Reminders:</p>
-                <ul style="margin: 0; color: #78350f; line-height: 1.8;">
-                    <li>Please arrive 15 minutes early for check-in</li>
-                    <li>Bring a valid ID and any relevant medical documents</li>
-                    <li>Your complete medical history is already accessible to the doctor via E-Vura</li>
-                </ul>
-            </div>
-            
-            <p style="font-size: 16px; line-height: 1.6;">If you need to reschedule or have any questions, please contact us.</p>
-            <p style="margin-top: 30px; font-size: 16px;">Best regards,<br><strong>The E-Vura Healthcare Team</strong></p>
-        """,
-        
-        'appointment_rejected': f"""
-            <div style="text-align: center; margin-bottom: 25px;">
-                <h3 style="color: #ef4444; font-size: 24px; margin-bottom: 10px;">** Appointment Update</h3>
-            </div>
-            
-            <p style="font-size: 16px; line-height: 1.6;">Dear <strong>{kwargs.get('patient_name')}</strong>,</p>
-            <p style="font-size: 16px; line-height: 1.6;">We regret to inform you that <strong>Dr. {kwargs.get('doctor_name')}</strong> is not available for your requested appointment on <strong>{kwargs.get('date')}</strong> at <strong>{kwargs.get('time')}</strong>.</p>
-            
-            <div style="background: #fef2f2; border-left: 4px solid #ef4444; padding: 20px; margin: 25px 0; border-radius: 8px;">
-                <p style="margin: 0 0 10px; color: #dc2626; font-weight: bold; font-size: 15px;">** What's Next?</p>
-                <ul style="margin: 0; color: #991b1b; line-height: 1.8;">
-                    <li>Log in to your E-Vura dashboard</li>
-                    <li>Select a different available time slot</li>
-                    <li>Or choose another qualified doctor</li>
-                </ul>
-            </div>
-            
-            <p style="font-size: 16px; line-height: 1.6;">We apologize for any inconvenience and appreciate your understanding.</p>
-            <p style="margin-top: 30px; font-size: 16px;">Best regards,<br><strong>The E-Vura Healthcare Team</strong></p>
-        """,
-        
-        'appointment_completed': f"""
-            <div style="text-align: center; margin-bottom: 25px;">
-                <h3 style="color: #0d9488; font-size: 24px; margin-bottom: 10px;">** Consultation Complete</h3>
-            </div>
-            
-            <p style="font-size: 16px; line-height: 1.6;">Dear <strong>{kwargs.get('patient_name')}</strong>,</p>
-            <p style="font-size: 16px; line-height: 1.6;">Your consultation with <strong>Dr. {kwargs.get('doctor_name')}</strong> on <strong>{kwargs.get('date')}</strong> has been completed successfully.</p>
-            
-            <div style="background: #f0fdfa; border-left: 4px solid #0d9488; padding: 20px; margin: 25px 0; border-radius: 8px;">
-                <p style="margin: 0 0 10px; color: #065f46; font-weight: bold; font-size: 15px;">** What's Been Updated:</p>
-                <ul style="margin: 0; color: #047857; line-height: 1.8;">
-                    <li>Your medical records have been updated with new information</li>
-                    <li>New diagnosis and treatment details added to your history</li>
-                    <li>All records are accessible for your next doctor visit</li>
-                    <li>Chronic condition status updated if applicable</li>
-                </ul>
-            </div>
-            
-            <p style="font-size: 16px; line-height: 1.6;">You can view your updated medical history anytime in your E-Vura dashboard.</p>
-            <p style="font-size: 16px; line-height: 1.6;">Take care and thank you for trusting E-Vura with your healthcare journey!</p>
-            <p style="margin-top: 30px; font-size: 16px;">Best regards,<br><strong>The E-Vura Healthcare Team</strong></p>
-        """
-    }
-    
-    content = templates.get(template_name, f"<p>E-Vura Healthcare Platform notification</p>")
-    return base_style.format(content=content)
 
-# HELPER FUNCTIONS
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
 
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session or 'user_type' not in session:
-            flash('Please log in to access this page.', 'warning')
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
+    def drain(self):
+        data, self._chunks = b''.join(self._chunks), []
+        return data
 
-def patient_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if session.get('user_type') != 'patient':
-            flash('Access denied. Patients only.', 'danger')
-            return redirect(url_for('index'))
-        return f(*args, **kwargs)
-    return decorated_function
+def iter_history_zip(patient, fmt):
+    """The history document plus every stored file, zipped on the fly"""
+    sink = ZipStream()
+    with zipfile.ZipFile(sink, 'w') as archive:
+        member = zipfile.ZipInfo(f'history.{"json" if fmt == "fhir" else "jsonl"}', datetime.now().timetuple()[:6])
+        member.compress_type = zipfile.ZIP_DEFLATED
+        with archive.open(member, 'w') as out:
+            lines = iter_history_fhir(patient) if fmt == 'fhir' else iter_history_jsonl(patient, archive_paths=True)
+            for line in lines:
+                out.write(line.encode())
+                yield sink.drain()
+        files = db.session.scalars(db.select(MedicalFile).where(MedicalFile.patient_id == patient.id)
+                                   .order_by(MedicalFile.id)).all()
+        for medical_file in files:
+            path = medical_file_path(medical_file)
+            if not os.path.exists(path):
+                continue
+            # Scans and PDFs are already compressed, so files are stored as-is
+            member = zipfile.ZipInfo(export_archive_path(medical_file), medical_file.test_date.timetuple()[:6])
+            with open(path, 'rb') as source, archive.open(member, 'w', force_zip64=True) as out:
+                for chunk in iter(lambda: source.read(EXPORT_FILE_CHUNK), b''):
+                    out.write(chunk)
+                    yield sink.drain()
+    yield sink.drain()
 
-def doctor_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if session.get('user_type') != 'doctor':
-            flash('Access denied. Doctors only.', 'danger')
-            return redirect(url_for('index'))
-        return f(*args, **kwargs)
-    return decorated_function
+def buffered_chunks(chunks, size=EXPORT_BUFFER_SIZE):
+    """Regroup many small str/bytes chunks into fewer writes of about size bytes"""
+    buffer, buffered = [], 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer, buffered = [], 0
+    if buffered:
+        yield b''.join(buffer)
+
+def export_patient_history(patient, fmt, with_files):
+    """Streaming download of a patient's whole history"""
+    stamp = datetime.now().strftime('%Y%m%d')
+    name = f'evura-history-{patient.id}-{stamp}'
+    if with_files:
+        body, mimetype, filename = iter_history_zip(patient, fmt), 'application/zip', f'{name}.zip'
+    elif fmt == 'fhir':
+        body, mimetype, filename = iter_history_fhir(patient), 'application/fhir+json', f'{name}.json'
+    else:
+        body, mimetype, filename = iter_history_jsonl(patient), 'application/x-ndjson', f'{name}.jsonl'
+    response = Response(stream_with_context(buffered_chunks(body)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+# FILE PROCESSING
+
+FILE_PROCESSING_LEASE = timedelta(minutes=30)
+
+def _claimable_files(now):
+    return db.and_(db.text(FILE_QUEUE_SQL), db.or_(
+        MedicalFile.processing_status == 'pending',
+        MedicalFile.processing_started_at < now - FILE_PROCESSING_LEASE))
+
+def claim_pending_files(limit):
+    """Mark up to limit queued files as processing in one UPDATE and return their rows.
+    Files held by a worker that died are claimed again once the lease runs out."""
+    now = datetime.utcnow()
+    due_ids = db.select(MedicalFile.id).where(_claimable_files(now)).order_by(MedicalFile.id).limit(limit)
+    rows = db.session.execute(
+        db.update(MedicalFile).where(MedicalFile.id.in_(due_ids), _claimable_files(now))
+        .values(processing_status='processing', processing_started_at=now)
+        .returning(MedicalFile.id, MedicalFile.patient_id, MedicalFile.sha256, MedicalFile.filename,
+                   MedicalFile.original_filename)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.session.commit()
+    return rows
+
+def _processing_result(row, status, error=None, info=None):
+    info = info or {}
+    return {'id': row.id, 'processing_status': status, 'processing_error': error,
+            'has_preview': info.get('preview', False), 'study_date': info.get('study_date'),
+            'modality': info.get('modality'),
+            'file_metadata': json.dumps(info['details'], default=str) if info.get('details') else None}
+
+def process_pending_files(executor, batch_size=None):
+    """Claim a batch of uploaded files, build their previews and read their metadata on the
+    worker processes, then store every result in one transaction. Returns the number handled."""
+    rows = claim_pending_files(batch_size or app.config['FILE_PROCESSING_BATCH_SIZE'])
+    results, futures = [], {}
+    for row in rows:
+        kind = file_processing.file_kind(row.original_filename)
+        if kind is None:
+            results.append(_processing_result(row, 'unsupported'))
+            continue
+        future = executor.submit(
+            file_processing.process_file, os.path.abspath(medical_file_path(row)), kind,
+            os.path.abspath(medical_file_preview_path(row, 'thumbnail')),
+            os.path.abspath(medical_file_preview_path(row, 'preview')),
+            app.config['THUMBNAIL_PX'], app.config['PREVIEW_PX'])
+        futures[future] = row
+    for future in as_completed(futures):
+        row = futures[future]
+        try:
+            results.append(_processing_result(row, 'ready', info=future.result()))
+        except file_processing.MissingDependency as e:
+            results.append(_processing_result(row, 'skipped', str(e)))
+        except Exception as e:
+            results.append(_processing_result(row, 'failed', f'{type(e).__name__}: {e}'))
+
+    if results:
+        db.session.execute(db.update(MedicalFile), results)
+        # New previews show up on cached history pages straight away
+        db.session.execute(db.update(Patient).where(Patient.id.in_({row.patient_id for row in rows}))
+                           .values(records_version=Patient.records_version + 1))
+        db.session.commit()
+    return len(rows)
+
+def create_file_process_pool(processes):
+    # Spawned, not forked: workers never inherit the web process's threads or database connections
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+class FileProcessingPool:
+    """A dispatcher thread that claims uploaded files and hands them to a pool of worker processes"""
+    def __init__(self, flask_app, poll_interval=10):
+        self.app = flask_app
+        self.poll_interval = poll_interval
+        self._processes = None
+        self._executor = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self, processes=None):
+        with self._lock:
+            if self._thread:
+                return
+            self._stopping.clear()
+            self._processes = processes or self.app.config['FILE_PROCESSING_WORKERS']
+            self._executor = create_file_process_pool(self._processes)
+            self._thread = threading.Thread(target=self._run, name='file-processing', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Nudge the dispatcher after an upload commits, starting the pool on first use.
+        Without Pillow no file could be previewed, so uploads stay pending until it is installed."""
+        if self.app.config['FILE_PROCESSING_WORKERS'] > 0 and file_processing.Image is not None:
+            self.start()
+        self._wakeup.set()
+
+    def stop(self, timeout=30):
+        self._stopping.set()
+        self._wakeup.set()
+        with self._lock:
+            if self._thread:
+                self._thread.join(timeout)
+                self._thread = None
+            if self._executor:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    handled = process_pending_files(self._executor)
+            except BrokenProcessPool as e:
+                print(f" File processing pool died, starting a new one: {e}")
+                self._executor = create_file_process_pool(self._processes)
+                handled = 0
+            except Exception as e:
+                print(f" File processing error: {type(e).__name__}: {e}")
+                handled = 0
+            if not handled:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+file_processors = FileProcessingPool(app)
+
+@app.cli.command('process-files')
+@click.option('--workers', default=None, type=int, help='Worker processes')
+@click.option('--once', is_flag=True, help='Process every queued file and exit')
+@click.option('--retry', is_flag=True, help='Queue files that failed or were skipped again first')
+def process_files_command(workers, once, retry):
+    """Build previews and read scan metadata for uploaded medical files"""
+    workers = workers or max(app.config['FILE_PROCESSING_WORKERS'], 1)
+    if retry:
+        requeued = (MedicalFile.query.filter(MedicalFile.processing_status.in_(('failed', 'skipped')))
+                    .update({'processing_status': 'pending', 'processing_error': None}, synchronize_session=False))
+        db.session.commit()
+        click.echo(f'Queued {requeued} file(s) again')
+    if once:
+        total = 0
+        with create_file_process_pool(workers) as executor:
+            while True:
+                handled = process_pending_files(executor, batch_size=max(workers * 4, 8))
+                total += handled
+                if not handled:
+                    break
+        click.echo(f'Processed {total} file(s)')
+        return
+    file_processors.start(workers)
+    click.echo('File processing running, press Ctrl+C to stop')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        file_processors.stop()
+
+# APPOINTMENT SLOTS
+
+# Used for doctors who have not set their own working hours: weekdays
+# 08:00-12:00 and 14:00-17:30 in 30 minute slots.
+DEFAULT_WORKING_HOURS = [(weekday, time_type(start_h, start_m), time_type(end_h, end_m), 30)
+                         for weekday in range(5)
+                         for (start_h, start_m), (end_h, end_m) in (((8, 0), (12, 0)), ((14, 0), (17, 30)))]
+MAX_SLOT_RANGE_DAYS = 31
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def parse_slot_date(value):
+    return datetime.strptime(value.strip(), '%Y-%m-%d').date()
+
+def parse_slot_time(value):
+    """Accepts 24-hour ("14:30") and 12-hour ("02:30 PM") times"""
+    value = value.strip()
+    for fmt in ('%H:%M', '%I:%M %p', '%H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt).time()
+        except ValueError:
+            pass
+    raise ValueError(f'Unrecognised time: {value!r}')
+
+def get_working_hours(doctor_id):
+    """(weekday, start, end, slot_minutes) blocks for a doctor, or the defaults"""
+    blocks = DoctorWorkingHours.query.filter_by(doctor_id=doctor_id).order_by(
+        DoctorWorkingHours.weekday, DoctorWorkingHours.start_time).all()
+    if not blocks:
+        return DEFAULT_WORKING_HOURS
+    return [(b.weekday, b.start_time, b.end_time, b.slot_minutes) for b in blocks]
+
+def get_weekly_slot_grid(doctor_id):
+    """Bookable start times for each weekday (0 = Monday)"""
+    grid = {weekday: [] for weekday in range(7)}
+    for weekday, start, end, slot_minutes in get_working_hours(doctor_id):
+        step = timedelta(minutes=slot_minutes)
+        slot, stop = datetime.combine(date_type.min, start), datetime.combine(date_type.min, end)
+        while slot + step <= stop:
+            grid[weekday].append(slot.time())
+            slot += step
+    return {weekday: sorted(set(times)) for weekday, times in grid.items()}
+
+def booked_slots_query(doctor_id, start, end):
+    """Active bookings for a doctor in a date range, served by uq_appointment_active_slot"""
+    return db.select(Appointment.slot_date, Appointment.slot_time).where(
+        Appointment.doctor_id == doctor_id, Appointment.slot_date.between(start, end), db.text(ACTIVE_SLOT_SQL))
+
+def get_free_slots(doctor_id, start, end):
+    """Free future slots per day from start to end inclusive, as {date: [time, ...]}"""
+    grid = get_weekly_slot_grid(doctor_id)
+    booked = set(db.session.execute(booked_slots_query(doctor_id, start, end)).all())
+    now = datetime.now()
+    free = {}
+    day = start
+    while day <= end:
+        free[day] = [slot for slot in grid[day.weekday()]
+                     if (day, slot) not in booked and datetime.combine(day, slot) > now]
+        day += timedelta(days=1)
+    return free
+
+def is_bookable_slot(doctor_id, slot_date, slot_time):
+    """True if the slot is in the future and inside the doctor's working hours"""
+    return (datetime.combine(slot_date, slot_time) > datetime.now()
+            and slot_time in get_weekly_slot_grid(doctor_id)[slot_date.weekday()])
+
+# APPOINTMENT REMINDERS
+
+def reminder_window(now):
+    """Confirmed appointments not yet reminded whose slot starts between now and the reminder lead time"""
+    end = now + timedelta(hours=app.config['REMINDER_LEAD_HOURS'])
+    slot = db.tuple_(Appointment.slot_date, Appointment.slot_time)
+    return db.and_(db.text(REMINDER_DUE_SQL), slot >= db.tuple_(db.literal(now.date()), db.literal(now.time())),
+                   slot <= db.tuple_(db.literal(end.date()), db.literal(end.time())))
+
+def claim_due_reminders(now, limit):
+    """Mark up to limit due appointments as reminded in one UPDATE and return their ids.
+    Rows another scheduler already claimed no longer match, so each appointment is reminded once."""
+    due_ids = (db.select(Appointment.id).where(reminder_window(now))
+               .order_by(Appointment.slot_date, Appointment.slot_time, Appointment.id).limit(limit))
+    return db.session.execute(
+        db.update(Appointment).where(Appointment.id.in_(due_ids), db.text(REMINDER_DUE_SQL))
+        .values(reminder_sent_at=datetime.utcnow()).returning(Appointment.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+
+def queue_appointment_reminders(now=None, batch_size=None):
+    """Queue a reminder email for every appointment in the reminder window. Each batch is claimed,
+    joined to its patient and doctor in one query and written to the outbox in one transaction.
+    Returns the number queued."""
+    now = now or datetime.now()
+    batch_size = batch_size or app.config['REMINDER_BATCH_SIZE']
+    total = 0
+    while True:
+        ids = claim_due_reminders(now, batch_size)
+        if not ids:
+            return total
+        rows = db.session.execute(
+            db.select(Appointment.date, Appointment.time, Patient.email, Patient.username,
+                      Doctor.username.label('doctor_name'), Doctor.hospital)
+            .join(Patient, Patient.id == Appointment.patient_id)
+            .join(Doctor, Doctor.id == Appointment.doctor_id)
+            .where(Appointment.id.in_(ids))
+        ).all()
+        db.session.execute(db.insert(EmailOutbox), [
+            {'to_email': row.email, 'subject': 'Appointment Reminder', 'template_name': 'appointment_reminder',
+             'context': json.dumps({'patient_name': row.username, 'doctor_name': row.doctor_name,
+                                    'date': row.date, 'time': row.time, 'hospital': row.hospital or 'TBD'})}
+            for row in rows
+        ])
+        db.session.commit()
+        total += len(ids)
+
+@app.cli.command('send-reminders')
+@click.option('--once', is_flag=True, help='Run a single pass and exit')
+@click.option('--interval', default=None, type=int, help='Seconds between passes')
+def send_reminders_command(once, interval):
+    """Queue reminders for upcoming confirmed appointments and deliver them, every interval seconds"""
+    interval = interval or app.config['REMINDER_INTERVAL_SECONDS']
+    transport = create_email_transport()
+    try:
+        while True:
+            started = perf_counter()
+            queued = queue_appointment_reminders()
+            delivered = drain_outbox(transport)
+            click.echo(f'{datetime.now():%Y-%m-%d %H:%M:%S} queued {queued} reminder(s), '
+                       f'processed {delivered} email(s) in {perf_counter() - started:.1f}s')
+            if once:
+                return
+            threading.Event().wait(interval)
+    except KeyboardInterrupt:
+        pass
 
 @app.route('/')
 def index():
@@ -447,7 +3308,11 @@ def register_patient():
             flash('Username already taken. Please choose another.', 'warning')
             return redirect(url_for('register_patient'))
         
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        try:
+            hashed_password = password_hasher.hash(password)
+        except PasswordHashBusy:
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('register_patient.html'), 503
         new_patient = Patient(username=username, email=email, password=hashed_password)
         
         try:
@@ -486,7 +3351,11 @@ def register_doctor():
             flash('Username already taken. Please choose another.', 'warning')
             return redirect(url_for('register_doctor'))
         
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+        try:
+            hashed_password = password_hasher.hash(password)
+        except PasswordHashBusy:
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('register_doctor.html'), 503
         new_doctor = Doctor(
             username=username, email=email, password=hashed_password,
             specialization=specialization, license_number=license_number, hospital=hospital
@@ -509,12 +3378,33 @@ def login():
         password = request.form['password']
         user_type = request.form['user_type']
         
+        retry_after = login_retry_after(user_type, email)
+        if retry_after:
+            LOGINS_THROTTLED_TOTAL.inc('failures')
+            flash(f'Too many failed sign-in attempts. Please try again in {(retry_after + 59) // 60} minutes.', 'danger')
+            return render_template('login.html'), 429, {'Retry-After': str(retry_after)}
+        
         if user_type == 'patient':
             user = Patient.query.filter_by(email=email).first()
         else:
             user = Doctor.query.filter_by(email=email).first()
         
-        if user and bcrypt.check_password_hash(user.password, password):
+        try:
+            valid = user is not None and password_hasher.verify(user.password, password)
+        except PasswordHashBusy:
+            LOGINS_THROTTLED_TOTAL.inc('busy')
+            flash('The server is busy. Please try again in a moment.', 'warning')
+            return render_template('login.html'), 503, {'Retry-After': '5'}
+        
+        if valid:
+            login_throttle.reset(('account', user_type, email))
+            if password_hasher.needs_rehash(user.password):
+                try:
+                    user.password = password_hasher.hash(password)
+                    db.session.commit()
+                except PasswordHashBusy:
+                    pass  # keep the old hash; it is upgraded on a later login
+            
             session['user_id'] = user.id
             session['user_type'] = user_type
             session['username'] = user.username
@@ -526,6 +3416,7 @@ def login():
             else:
                 return redirect(url_for('doctor_dashboard'))
         else:
+            record_login_failure(user_type, email)
             flash('Invalid email, password, or user type.', 'danger')
     
     return render_template('login.html')
@@ -542,30 +3433,38 @@ def logout():
 @login_required
 @patient_required
 def patient_dashboard():
-    patient = Patient.query.get(session['user_id'])
-    appointments = Appointment.query.filter_by(patient_id=patient.id).order_by(Appointment.created_at.desc()).all()
+    patient = current_user()
+    query = Appointment.query.options(db.joinedload(Appointment.doctor)).filter_by(patient_id=patient.id)
+    page = paginate_by_created(query, Appointment, **get_page_args(default_size=10))
+    total_appointments, doctors_consulted = db.session.query(
+        db.func.count(Appointment.id), db.func.count(db.distinct(Appointment.doctor_id))
+    ).filter(Appointment.patient_id == patient.id).one()
     records = MedicalRecord.query.filter_by(patient_id=patient.id).order_by(MedicalRecord.created_at.desc()).limit(5).all()
-    doctors = Doctor.query.all()
+    # The booking form offers the patient's recent doctors and searches the rest through /api/doctors
+    recent_doctor_ids = db.select(Appointment.doctor_id).where(Appointment.patient_id == patient.id).group_by(
+        Appointment.doctor_id).order_by(db.func.max(Appointment.created_at).desc()).limit(10)
+    doctors = Doctor.query.filter(Doctor.id.in_(recent_doctor_ids)).order_by(Doctor.username).all()
     
     return render_template('patient_dashboard.html', 
-                         patient=patient, appointments=appointments,
+                         patient=patient, appointments=page.items, page=page,
+                         total_appointments=total_appointments, doctors_consulted=doctors_consulted,
+                         record_counts=get_patient_record_counts([patient.id])[patient.id],
                          records=records, doctors=doctors)
 
 @app.route('/doctor/dashboard')
 @login_required
 @doctor_required
 def doctor_dashboard():
-    doctor = Doctor.query.get(session['user_id'])
-    appointments = Appointment.query.filter_by(doctor_id=doctor.id).order_by(Appointment.created_at.desc()).all()
-    patients = Patient.query.join(Appointment).filter(Appointment.doctor_id == doctor.id).distinct().all()
-    
-    return render_template('doctor_dashboard.html', doctor=doctor, appointments=appointments, patients=patients)
+    doctor = current_user()
+    dashboard = get_doctor_dashboard_data(doctor.id, **get_page_args(default_size=5))
+
+    return render_template('doctor_dashboard.html', doctor=doctor, **dashboard)
 
 @app.route('/patient/profile', methods=['GET', 'POST'])
 @login_required
 @patient_required
 def patient_profile():
-    patient = Patient.query.get(session['user_id'])
+    patient = current_user()
     
     if request.method == 'POST':
         patient.phone = request.form.get('phone', '').strip()
@@ -574,10 +3473,13 @@ def patient_profile():
         patient.blood_type = request.form.get('blood_type', '').strip()
         patient.allergies = request.form.get('allergies', '').strip()
         patient.chronic_conditions = request.form.get('chronic_conditions', '').strip()
+        set_patient_conditions(db.session, patient.id, patient.chronic_conditions)
         patient.emergency_contact = request.form.get('emergency_contact', '').strip()
+        patient.records_version = Patient.records_version + 1
         
         try:
             db.session.commit()
+            invalidate_user_profile('patient', patient.id)
             flash('Profile updated successfully!', 'success')
         except Exception as e:
             flash('Error updating profile.', 'danger')
@@ -585,13 +3487,27 @@ def patient_profile():
         return redirect(url_for('patient_profile'))
     
     records = MedicalRecord.query.filter_by(patient_id=patient.id).order_by(MedicalRecord.created_at.desc()).all()
-    return render_template('patient_profile.html', patient=patient, records=records)
+    return render_template('patient_profile.html', patient=patient, records=records,
+                           care_grants=get_care_access_grants(patient.id))
+
+@app.route('/patient/care-access/<int:doctor_id>/revoke', methods=['POST'])
+@login_required
+@patient_required
+def revoke_doctor_access(doctor_id):
+    """Patient withdraws a doctor's access to their records"""
+    patient_id = session['user_id']
+    revoked = revoke_care_access(doctor_id, patient_id)
+    db.session.commit()
+    care_access_cache.invalidate((doctor_id, patient_id))
+    if revoked:
+        flash('Access revoked. The doctor can no longer open your records.', 'success')
+    return redirect(url_for('patient_profile'))
 
 @app.route('/doctor/profile', methods=['GET', 'POST'])
 @login_required
 @doctor_required
 def doctor_profile():
-    doctor = Doctor.query.get(session['user_id'])
+    doctor = current_user()
     
     if request.method == 'POST':
         doctor.phone = request.form.get('phone', '').strip()
@@ -604,30 +3520,94 @@ def doctor_profile():
         
         try:
             db.session.commit()
+            invalidate_user_profile('doctor', doctor.id)
             flash('Profile updated successfully!', 'success')
         except Exception as e:
             flash('Error updating profile.', 'danger')
     
-    return render_template('doctor_profile.html', doctor=doctor)
+    return render_template('doctor_profile.html', doctor=doctor, stats=get_doctor_profile_stats(doctor.id),
+                           working_hours=get_working_hours(doctor.id), weekdays=WEEKDAY_NAMES)
+
+@app.route('/doctor/working-hours', methods=['POST'])
+@login_required
+@doctor_required
+def update_working_hours():
+    """Replace the doctor's weekly hours; each weekday takes up to two blocks"""
+    blocks = []
+    try:
+        slot_minutes = int(request.form.get('slot_minutes', 30))
+        if not 5 <= slot_minutes <= 240:
+            raise ValueError(slot_minutes)
+        for weekday in range(7):
+            for block in range(2):
+                start = request.form.get(f'start_{weekday}_{block}', '').strip()
+                end = request.form.get(f'end_{weekday}_{block}', '').strip()
+                if not start and not end:
+                    continue
+                start, end = parse_slot_time(start), parse_slot_time(end)
+                if start >= end:
+                    raise ValueError(start)
+                blocks.append(DoctorWorkingHours(doctor_id=session['user_id'], weekday=weekday,
+                                                 start_time=start, end_time=end, slot_minutes=slot_minutes))
+    except ValueError:
+        flash('Working hours need a start before the end, and slots between 5 and 240 minutes.', 'warning')
+        return redirect(url_for('doctor_profile'))
+    
+    DoctorWorkingHours.query.filter_by(doctor_id=session['user_id']).delete()
+    db.session.add_all(blocks)
+    db.session.commit()
+    flash('Working hours updated.' if blocks else 'Working hours reset to the default schedule.', 'success')
+    return redirect(url_for('doctor_profile'))
 
 @app.route('/patient/find-doctors')
 @login_required
 @patient_required
 def find_doctors():
-    doctors = Doctor.query.all()
-    return render_template('find_doctors.html', doctors=doctors)
+    filters = get_doctor_search_filters()
+    pagination = search_doctors(**filters, page=request.args.get('page', 1, type=int))
+    return render_template('find_doctors.html', doctors=pagination.items, pagination=pagination,
+                           filters=filters, doctor_stats=get_doctor_card_stats([d.id for d in pagination.items]))
+
+@app.route('/api/doctors')
+@login_required
+def api_search_doctors():
+    """JSON doctor search used by the booking forms"""
+    pagination = search_doctors(**get_doctor_search_filters(), page=request.args.get('page', 1, type=int),
+                                per_page=request.args.get('per_page', DOCTOR_SEARCH_PAGE_SIZE, type=int))
+    return jsonify({
+        'doctors': [{
+            'id': doctor.id, 'username': doctor.username, 'specialization': doctor.specialization,
+            'hospital': doctor.hospital, 'years_experience': doctor.years_experience,
+        } for doctor in pagination.items],
+        'page': pagination.page,
+        'pages': pagination.pages,
+        'total': pagination.total,
+    })
+
+@app.route('/api/doctors/<int:doctor_id>/slots')
+@login_required
+def api_doctor_slots(doctor_id):
+    """Free slots for a doctor between ?from= and ?to= (YYYY-MM-DD, at most 31 days)"""
+    Doctor.query.get_or_404(doctor_id)
+    try:
+        start = parse_slot_date(request.args['from']) if request.args.get('from') else datetime.now().date()
+        end = parse_slot_date(request.args['to']) if request.args.get('to') else start + timedelta(days=6)
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD.'}), 400
+    if end < start or (end - start).days >= MAX_SLOT_RANGE_DAYS:
+        return jsonify({'error': f'Ask for between 1 and {MAX_SLOT_RANGE_DAYS} days.'}), 400
+
+    free = get_free_slots(doctor_id, start, end)
+    return jsonify({
+        'doctor_id': doctor_id,
+        'slots': {day.isoformat(): [slot.strftime('%H:%M') for slot in slots] for day, slots in free.items()},
+    })
 
 @app.route('/doctor/<int:doctor_id>/profile')
 @login_required
 def view_doctor_profile(doctor_id):
     doctor = Doctor.query.get_or_404(doctor_id)
-    total_patients = Patient.query.join(Appointment).filter(Appointment.doctor_id == doctor_id).distinct().count()
-    total_appointments = Appointment.query.filter_by(doctor_id=doctor_id).count()
-    completed_appointments = Appointment.query.filter_by(doctor_id=doctor_id, status='completed').count()
-    
-    return render_template('view_doctor_profile.html', doctor=doctor, 
-                         total_patients=total_patients, total_appointments=total_appointments,
-                         completed_appointments=completed_appointments)
+    return render_template('view_doctor_profile.html', doctor=doctor, **get_doctor_profile_stats(doctor_id))
 
 @app.route('/appointment/book', methods=['POST'])
 @login_required
@@ -635,43 +3615,56 @@ def view_doctor_profile(doctor_id):
 def book_appointment():
     try:
         doctor_id = request.form['doctor_id']
-        date = request.form['date']
-        time = request.form['time']
         reason = request.form.get('reason', '').strip()
+        try:
+            slot_date = parse_slot_date(request.form['date'])
+            slot_time = parse_slot_time(request.form['time'])
+        except (KeyError, ValueError):
+            flash('Please choose a valid date and time.', 'warning')
+            return redirect(request.referrer or url_for('find_doctors'))
+        date, time = slot_date.isoformat(), slot_time.strftime('%H:%M')
         
         doctor = Doctor.query.get(doctor_id)
-        patient = Patient.query.get(session['user_id'])
+        patient = current_user()
         
         if not doctor:
             flash('Doctor not found.', 'danger')
             return redirect(url_for('find_doctors'))
         
-        existing = Appointment.query.filter_by(doctor_id=doctor_id, date=date, time=time).filter(
-            Appointment.status.in_(['pending', 'confirmed'])).first()
-        
-        if existing:
-            flash('This time slot is already booked.', 'warning')
+        if not is_bookable_slot(doctor.id, slot_date, slot_time):
+            flash(f'Dr. {doctor.username} is not available at that time.', 'warning')
             return redirect(request.referrer or url_for('find_doctors'))
         
+        # No check-then-insert: uq_appointment_active_slot rejects a concurrent double booking
         appointment = Appointment(
-            patient_id=session['user_id'], doctor_id=doctor_id,
-            date=date, time=time, reason=reason, status='pending'
+            patient_id=session['user_id'], doctor_id=doctor.id, date=date, time=time,
+            slot_date=slot_date, slot_time=slot_time, reason=reason, status='pending'
         )
         
         db.session.add(appointment)
-        db.session.commit()
+        record_appointment_booked(doctor.id, patient.id)
+        grant_care_access(doctor.id, patient.id)
         
-        # Send email alert
-        send_email(
+        # Email alert is queued in the same transaction as the appointment
+        queue_email(
             to=doctor.email, subject="New Appointment Request", template_name='appointment_request',
             doctor_name=doctor.username, patient_name=patient.username, date=date, time=time,
             reason=reason or 'General consultation',
             chronic_conditions=patient.chronic_conditions if patient.has_chronic_conditions() else None
         )
+        db.session.commit()
+        doctor_stats_cache.invalidate(doctor.id)
+        care_access_cache.invalidate((doctor.id, patient.id))
+        email_workers.wake()
         
         flash('Appointment booked! Doctor will be notified.', 'success')
         
+    except IntegrityError:
+        db.session.rollback()
+        flash('This time slot is already booked.', 'warning')
+        return redirect(request.referrer or url_for('find_doctors'))
     except Exception as e:
+        db.session.rollback()
         flash('Error booking appointment.', 'danger')
     
     return redirect(url_for('patient_dashboard'))
@@ -680,97 +3673,79 @@ def book_appointment():
 @login_required
 @doctor_required
 def consultations():
-    doctor = Doctor.query.get(session['user_id'])
-    appointments = Appointment.query.filter_by(doctor_id=doctor.id).order_by(Appointment.created_at.desc()).all()
-    return render_template('consultations.html', doctor=doctor, appointments=appointments)
+    doctor = current_user()
+    query = Appointment.query.options(db.joinedload(Appointment.patient)).filter_by(doctor_id=doctor.id)
+    page = paginate_by_created(query, Appointment, **get_page_args())
+    return render_template('consultations.html', doctor=doctor, appointments=page.items, page=page)
+
+@app.route('/doctor/chronic-patients')
+@login_required
+@doctor_required
+def chronic_patients():
+    """Doctor's patients with chronic conditions, optionally narrowed to one condition (?condition=diabetes)"""
+    doctor = current_user()
+    term = request.args.get('condition', '').strip()
+    patients = get_condition_cohort(doctor.id, term)
+    return render_template('chronic_patients.html', doctor=doctor, term=term, patients=patients,
+                           conditions=get_patient_conditions([patient.id for patient in patients]),
+                           condition_counts=get_doctor_condition_counts(doctor.id))
 
 @app.route('/patient/medical-records')
 @login_required
 @patient_required
 def medical_records():
-    patient = Patient.query.get(session['user_id'])
-    
-    # Get all medical records sorted by date
-    medical_files = MedicalFile.query.filter_by(patient_id=patient.id).order_by(MedicalFile.test_date.desc()).all()
-    test_results = TestResult.query.filter_by(patient_id=patient.id).order_by(TestResult.test_date.desc()).all()
-    procedures = Procedure.query.filter_by(patient_id=patient.id).order_by(Procedure.procedure_date.desc()).all()
-    prescriptions = Prescription.query.filter_by(patient_id=patient.id).order_by(Prescription.prescribed_date.desc()).all()
-    
-    # Create timeline combining all records
-    timeline = []
-    
-    for file in medical_files:
-        timeline.append({
-            'type': 'file',
-            'date': file.test_date,
-            'data': file
-        })
-    
-    for test in test_results:
-        timeline.append({
-            'type': 'test',
-            'date': test.test_date,
-            'data': test
-        })
-    
-    for proc in procedures:
-        timeline.append({
-            'type': 'procedure',
-            'date': proc.procedure_date,
-            'data': proc
-        })
-    
-    for presc in prescriptions:
-        timeline.append({
-            'type': 'prescription',
-            'date': presc.prescribed_date,
-            'data': presc
-        })
+    patient = current_user()
     
-    timeline.sort(key=lambda x: x['date'], reverse=True)
+    filters = get_timeline_filters()
+    page = get_patient_timeline(patient.id, **filters, **get_page_args(default_size=25))
     
     return render_template('medical_records.html', 
                          patient=patient,
-                         timeline=timeline,
-                         medical_files=medical_files,
-                         test_results=test_results,
-                         procedures=procedures,
-                         prescriptions=prescriptions)
+                         timeline=page.items,
+                         page=page,
+                         page_params=timeline_query_params(filters),
+                         record_counts=get_patient_record_counts([patient.id])[patient.id])
 
 @app.route('/patient/upload-records', methods=['GET', 'POST'])
 @login_required
 @patient_required
+@large_upload
 def upload_records():
     """Upload medical files and records"""
     if request.method == 'POST':
         try:
-            patient = Patient.query.get(session['user_id'])
+            patient = current_user()
             
             # files upload handling
+            file_uploaded = False
             if 'medical_file' in request.files:
                 file = request.files['medical_file']
                 if file and file.filename:
-                    # Generate unique filename
                     filename = secure_filename(file.filename)
-                    unique_filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(filepath)
+                    if not allowed_file(filename):
+                        flash('Unsupported file type. Upload a PDF, image, Word or DICOM file.', 'error')
+                        return redirect(url_for('upload_records'))
+                    
+                    # Identical files are stored once, under their SHA-256
+                    digest, size = blob_store.put_file_storage(file)
                     
                     # Create medical file record
                     medical_file = MedicalFile(
                         patient_id=patient.id,
-                        filename=unique_filename,
+                        filename=digest,
+                        sha256=digest,
+                        file_size=size,
                         original_filename=filename,
                         file_type=request.form.get('file_type'),
                         file_category=request.form.get('file_category'),
                         description=request.form.get('description'),
                         diagnosis=request.form.get('diagnosis'),
                         hospital_name=request.form.get('hospital_name'),
-                        is_chronic_related=bool(request.form.get('is_chronic_related')),
-                        chronic_condition=request.form.get('chronic_condition') if request.form.get('is_chronic_related') else None,
+                        **chronic_record_fields(request.form),
                         test_date=datetime.strptime(request.form.get('test_date'), '%Y-%m-%d')
                     )
                     db.session.add(medical_file)
+                    file_uploaded = True
             
             # Handle test result entry (without file)
             if request.form.get('add_test_result'):
@@ -782,22 +3757,71 @@ def upload_records():
                     normal_range=request.form.get('normal_range'),
                     interpretation=request.form.get('interpretation'),
                     hospital_name=request.form.get('hospital_name'),
-                    is_chronic_related=bool(request.form.get('is_chronic_related')),
-                    chronic_condition=request.form.get('chronic_condition') if request.form.get('is_chronic_related') else None,
+                    **chronic_record_fields(request.form),
                     test_date=datetime.strptime(request.form.get('test_date'), '%Y-%m-%d')
                 )
+                test_result.lab_value = build_lab_value(test_result)
                 db.session.add(test_result)
             
+            bump_records_version(patient.id)
             db.session.commit()
+            if file_uploaded:
+                # Previews and metadata are made in the background, so the upload returns at once
+                file_processors.wake()
             flash('Medical record uploaded successfully!', 'success')
             return redirect(url_for('medical_records'))
             
+        except RequestEntityTooLarge:
+            raise
         except Exception as e:
             db.session.rollback()
             flash(f'Error uploading record: {str(e)}', 'error')
     
-    patient = Patient.query.get(session['user_id'])
-    return render_template('upload_records.html', patient=patient)
+    patient = current_user()
+    return render_template('upload_records.html', patient=patient, max_upload_mb=app.config['MAX_UPLOAD_MB'])
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    if request.endpoint != 'upload_records':
+        return e
+    flash(f"File is too large. The limit is {app.config['MAX_UPLOAD_MB']} MB.", 'error')
+    return redirect(url_for('upload_records'))
+
+@app.route('/api/import/records', methods=['POST'])
+@large_upload
+def api_import_records():
+    """Bulk import for hospital systems: CSV or JSON-lines body, authorised by IMPORT_API_TOKEN"""
+    token = app.config['IMPORT_API_TOKEN']
+    supplied = request.headers.get('Authorization', '')
+    supplied = supplied[len('Bearer '):].strip() if supplied.startswith('Bearer ') else ''
+    if not token:
+        return jsonify({'error': 'Bulk import is not enabled.'}), 404
+    if not hmac.compare_digest(supplied.encode(), token.encode()):
+        return jsonify({'error': 'Invalid import token.'}), 401
+
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'jsonl')
+    record_type = request.args.get('type')
+    if fmt not in ('csv', 'jsonl') or (record_type and record_type not in IMPORT_MODELS):
+        return jsonify({'error': f'format must be csv or jsonl and type one of {", ".join(IMPORT_MODELS)}.'}), 400
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+    return jsonify(import_records(stream, fmt, default_type=record_type))
+
+@app.cli.command('store-legacy-uploads')
+def store_legacy_uploads_command():
+    """Move files uploaded before the blob store into it, deduplicating as they go"""
+    moved = 0
+    for medical_file in MedicalFile.query.filter(MedicalFile.sha256.is_(None)):
+        path = medical_file_path(medical_file)
+        if not os.path.exists(path):
+            click.echo(f'missing: {path}')
+            continue
+        with open(path, 'rb') as legacy:
+            digest, size = blob_store.put_stream(legacy)
+        medical_file.filename, medical_file.sha256, medical_file.file_size = digest, digest, size
+        db.session.commit()
+        os.remove(path)
+        moved += 1
+    click.echo(f'Moved {moved} legacy uploads into {blob_store.root}')
 
 @app.route('/doctor/patient-history/<int:patient_id>')
 @login_required
@@ -805,55 +3829,48 @@ def upload_records():
 def view_patient_history(patient_id):
     """Doctor views complete patient medical history"""
     patient = Patient.query.get_or_404(patient_id)
-    doctor = Doctor.query.get(session['user_id'])
+    doctor = current_user()
     
     # Check if doctor has permission (has treated or is treating this patient)
-    has_permission = Appointment.query.filter_by(
-        patient_id=patient_id,
-        doctor_id=doctor.id
-    ).first() is not None
-    
-    if not has_permission:
+    if not doctor_can_access_patient(doctor.id, patient_id):
         flash('You do not have permission to view this patient\'s records', 'error')
         return redirect(url_for('doctor_dashboard'))
     
-    # Get all medical records
-    medical_files = MedicalFile.query.filter_by(patient_id=patient.id).order_by(MedicalFile.test_date.desc()).all()
-    test_results = TestResult.query.filter_by(patient_id=patient.id).order_by(TestResult.test_date.desc()).all()
-    procedures = Procedure.query.filter_by(patient_id=patient.id).order_by(Procedure.procedure_date.desc()).all()
-    prescriptions = Prescription.query.filter_by(patient_id=patient.id).order_by(Prescription.prescribed_date.desc()).all()
-    
-    # Create timeline
-    timeline = []
-    
-    for file in medical_files:
-        timeline.append({'type': 'file', 'date': file.test_date, 'data': file})
-    for test in test_results:
-        timeline.append({'type': 'test', 'date': test.test_date, 'data': test})
-    for proc in procedures:
-        timeline.append({'type': 'procedure', 'date': proc.procedure_date, 'data': proc})
-    for presc in prescriptions:
-        timeline.append({'type': 'prescription', 'date': presc.prescribed_date, 'data': presc})
-    
-    timeline.sort(key=lambda x: x['date'], reverse=True)
+    filters = get_timeline_filters()
+    page = get_patient_timeline(patient.id, **filters, **get_page_args(default_size=25))
     
     return render_template('view_patient_history.html',
                          patient=patient,
                          doctor=doctor,
-                         timeline=timeline,
-                         medical_files=medical_files,
-                         test_results=test_results,
-                         procedures=procedures,
-                         prescriptions=prescriptions,
+                         timeline=page.items,
+                         page=page,
+                         filters=filters,
+                         page_params=dict(timeline_query_params(filters), patient_id=patient.id),
+                         record_counts=get_patient_record_counts([patient.id])[patient.id],
+                         lab_trends=get_lab_trend_summary(patient),
                          now=datetime.now())
 
+@app.route('/doctor/patient-history/<int:patient_id>/search')
+@login_required
+@doctor_required
+def search_patient_history(patient_id):
+    """Doctor searches a patient's records, best matches first"""
+    patient = Patient.query.get_or_404(patient_id)
+    if not doctor_can_access_patient(session['user_id'], patient_id):
+        flash('You do not have permission to view this patient\'s records', 'error')
+        return redirect(url_for('doctor_dashboard'))
+
+    q = request.args.get('q', '').strip()
+    results = search_patient_records(patient.id, q, page=request.args.get('page', 1, type=int))
+    return render_template('patient_record_search.html', patient=patient, q=q, results=results)
+
 @app.route('/doctor/add-medical-note/<int:patient_id>', methods=['POST'])
 @login_required
 @doctor_required
 def add_medical_note(patient_id):
     """Doctor adds test results or prescriptions for patient"""
     try:
-        doctor = Doctor.query.get(session['user_id'])
+        doctor = current_user()
         patient = Patient.query.get_or_404(patient_id)
         
         record_type = request.form.get('record_type')
@@ -868,10 +3885,10 @@ def add_medical_note(patient_id):
                 normal_range=request.form.get('normal_range'),
                 interpretation=request.form.get('interpretation'),
                 hospital_name=doctor.hospital,
-                is_chronic_related=bool(request.form.get('is_chronic_related')),
-                chronic_condition=request.form.get('chronic_condition'),
+                **chronic_record_fields(request.form),
                 test_date=datetime.now()
             )
+            test_result.lab_value = build_lab_value(test_result)
             db.session.add(test_result)
             
         elif record_type == 'prescription':
@@ -884,8 +3901,7 @@ def add_medical_note(patient_id):
                 duration=request.form.get('duration'),
                 reason=request.form.get('reason'),
                 instructions=request.form.get('instructions'),
-                is_chronic_related=bool(request.form.get('is_chronic_related')),
-                chronic_condition=request.form.get('chronic_condition'),
+                **chronic_record_fields(request.form),
                 start_date=datetime.now()
             )
             db.session.add(prescription)
@@ -899,12 +3915,12 @@ def add_medical_note(patient_id):
                 description=request.form.get('description'),
                 outcome=request.form.get('outcome'),
                 hospital_name=doctor.hospital,
-                is_chronic_related=bool(request.form.get('is_chronic_related')),
-                chronic_condition=request.form.get('chronic_condition'),
+                **chronic_record_fields(request.form),
                 procedure_date=datetime.now()
             )
             db.session.add(procedure)
         
+        bump_records_version(patient_id)
         db.session.commit()
         flash('Medical record added successfully!', 'success')
         
@@ -914,6 +3930,33 @@ def add_medical_note(patient_id):
     
     return redirect(url_for('view_patient_history', patient_id=patient_id))
 
+@app.route('/patient/export')
+@login_required
+@patient_required
+def export_my_history():
+    """Download my whole history (?format=jsonl|fhir, &files=1 for a ZIP with the files)"""
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in EXPORT_FORMATS:
+        flash('Unknown export format.', 'warning')
+        return redirect(url_for('medical_records'))
+    return export_patient_history(current_user(), fmt, request.args.get('files') == '1')
+
+@app.route('/doctor/patient-history/<int:patient_id>/export')
+@login_required
+@doctor_required
+def export_patient_history_route(patient_id):
+    """Doctor downloads a patient's whole history, same formats as the patient export"""
+    patient = Patient.query.get_or_404(patient_id)
+    if not doctor_can_access_patient(session['user_id'], patient_id):
+        flash('You do not have permission to view this patient\'s records', 'error')
+        return redirect(url_for('doctor_dashboard'))
+
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in EXPORT_FORMATS:
+        flash('Unknown export format.', 'warning')
+        return redirect(url_for('view_patient_history', patient_id=patient_id))
+    return export_patient_history(patient, fmt, request.args.get('files') == '1')
+
 @app.route('/download-medical-file/<int:file_id>')
 @login_required
 def download_medical_file(file_id):
@@ -927,23 +3970,32 @@ def download_medical_file(file_id):
             return redirect(url_for('index'))
     elif session.get('user_type') == 'doctor':
         # Check if doctor has treated this patient
-        has_permission = Appointment.query.filter_by(
-            patient_id=medical_file.patient_id,
-            doctor_id=session['user_id']
-        ).first() is not None
-        if not has_permission:
+        if not doctor_can_access_patient(session['user_id'], medical_file.patient_id):
             flash('Unauthorized access', 'error')
             return redirect(url_for('doctor_dashboard'))
     
-    try:
-        return send_file(
-            os.path.join(app.config['UPLOAD_FOLDER'], medical_file.filename),
-            as_attachment=True,
-            download_name=medical_file.original_filename
-        )
-    except Exception as e:
+    if not os.path.exists(medical_file_path(medical_file)):
         flash('File not found', 'error')
-        return redirect(url_for('medical_records'))
+        return redirect(url_for('medical_records' if session.get('user_type') == 'patient' else 'doctor_dashboard'))
+    
+    return send_medical_file(medical_file)
+
+@app.route('/medical-file/<int:file_id>/<any(thumbnail, preview):size>')
+@login_required
+def medical_file_image(file_id, size):
+    """Downscaled JPEG of an uploaded scan or document, made by the file processing pool"""
+    medical_file = MedicalFile.query.get_or_404(file_id)
+    if session.get('user_type') == 'patient':
+        allowed = medical_file.patient_id == session['user_id']
+    else:
+        allowed = doctor_can_access_patient(session['user_id'], medical_file.patient_id)
+    path = os.path.abspath(medical_file_preview_path(medical_file, size))
+    if not allowed or not medical_file.has_preview or not os.path.exists(path):
+        abort(404)
+    response = send_file(path, mimetype='image/jpeg', etag=True, conditional=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
     
 
 
@@ -959,36 +4011,49 @@ def update_appointment_status(appointment_id):
             return redirect(url_for('doctor_dashboard'))
         
         new_status = request.form['status']
+        record_status_change(appointment.doctor_id, appointment.status, new_status)
         appointment.status = new_status
         
-        doctor = Doctor.query.get(appointment.doctor_id)
-        patient = Patient.query.get(appointment.patient_id)
-        
-        db.session.commit()
+        doctor = current_user()
+        patient = appointment.patient
         
         if new_status == 'confirmed':
-            send_email(
+            renew_care_access(appointment.doctor_id, appointment.patient_id)
+            queue_email(
                 to=patient.email, subject="Appointment Confirmed", template_name='appointment_confirmed',
                 patient_name=patient.username, doctor_name=doctor.username,
                 date=appointment.date, time=appointment.time, hospital=doctor.hospital or 'TBD'
             )
-            flash('Appointment confirmed and patient notified.', 'success')
+            message = ('Appointment confirmed and patient notified.', 'success')
         elif new_status == 'cancelled':
-            send_email(
+            queue_email(
                 to=patient.email, subject="Appointment Update", template_name='appointment_rejected',
                 patient_name=patient.username, doctor_name=doctor.username,
                 date=appointment.date, time=appointment.time
             )
-            flash('Appointment cancelled and patient notified.', 'info')
+            message = ('Appointment cancelled and patient notified.', 'info')
         elif new_status == 'completed':
-            send_email(
+            queue_email(
                 to=patient.email, subject="Consultation Complete", template_name='appointment_completed',
                 patient_name=patient.username, doctor_name=doctor.username,
                 date=appointment.date, time=appointment.time
             )
-            flash('Consultation completed and patient notified.', 'success')
+            message = ('Consultation completed and patient notified.', 'success')
+        else:
+            message = None
+        
+        db.session.commit()
+        doctor_stats_cache.invalidate(appointment.doctor_id)
+        care_access_cache.invalidate((appointment.doctor_id, appointment.patient_id))
+        email_workers.wake()
+        if message:
+            flash(*message)
     
+    except IntegrityError:
+        db.session.rollback()
+        flash('That time slot has already been taken by another appointment.', 'warning')
     except Exception as e:
+        db.session.rollback()
         flash('Error updating status.', 'danger')
     
     return redirect(url_for('consultations'))
@@ -1014,6 +4079,7 @@ def add_medical_record(appointment_id):
         
         db.session.add(record)
         appointment.notes = request.form.get('notes', '')
+        bump_records_version(appointment.patient_id)
         db.session.commit()
         
         flash('Medical record added successfully!', 'success')
@@ -1025,7 +4091,7 @@ def add_medical_record(appointment_id):
 
 print(f"🔍 DATABASE_URL exists: {bool(os.environ.get('DATABASE_URL'))}")
 
-print(f"🔍 Final DB URI: {app.config['SQLALCHEMY_DATABASE_URI']}")
+print(f"🔍 Final DB URI: {make_url(app.config['SQLALCHEMY_DATABASE_URI']).render_as_string(hide_password=True)}")
 
 # Create database tables on startup
 
@@ -1037,7 +4103,11 @@ with app.app_context():
 
         db.create_all()
 
+        applied = run_migrations()
+
         print(' E-Vura Database tables created successfully!')
+        if applied:
+            print(f' Applied schema migrations: {applied}')
 
     except Exception as e:
 
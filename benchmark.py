@@ -0,0 +1,838 @@
+"""Load test and benchmark harness for E-Vura.
+
+Seed a database with synthetic patients, doctors, appointments and records, then
+drive the main routes and report throughput, p50/p95/p99 latency and SQL
+statements per request. Results are saved as JSON tagged with the git commit so
+runs can be compared across commits.
+
+    python benchmark.py seed --database sqlite:////tmp/evura-bench.db --patients 2000
+    python benchmark.py run --database sqlite:////tmp/evura-bench.db --json before.json
+    python benchmark.py run --url http://127.0.0.1:8000 --json live.json   # against gunicorn
+    python benchmark.py compare before.json after.json
+
+The database must be chosen before app.py is imported (it creates tables on
+import), which is why this is a standalone script rather than a flask command.
+"""
+import io
+import itertools
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar
+from time import perf_counter
+
+import click
+
+BENCH_PASSWORD = 'benchmark-password'
+DEFAULT_DATABASE = 'sqlite:////tmp/evura-bench.db'
+CHRONIC_CONDITIONS = ['Diabetes', 'Hypertension', 'Asthma', 'Sickle cell disease', 'HIV', 'Osteomyelitis']
+SPECIALIZATIONS = ['Cardiology', 'Pediatrics', 'General Practice', 'Orthopedics', 'Neurology', 'Dermatology']
+HOSPITALS = ['King Faisal Hospital', 'CHUK', 'Rwanda Military Hospital', 'Kibagabaga Hospital', 'Masaka Hospital']
+
+
+def load_app(database):
+    """Import app.py against the given database URL"""
+    os.environ['DATABASE_URL'] = database
+    os.environ.setdefault('EMAIL_WORKER_THREADS', '0')
+    os.environ.setdefault('FILE_PROCESSING_WORKERS', '0')
+    os.environ.setdefault('EMAIL_TRANSPORT', 'fake')
+    os.environ.setdefault('REQUEST_LOG', '0')
+    import app as evura
+    return evura
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+# SYNTHETIC DATA
+
+def weekday_slot_times(evura):
+    """Start times of the default working-hours slots on a weekday"""
+    times = []
+    for weekday, start, end, minutes in evura.DEFAULT_WORKING_HOURS:
+        if weekday == 0:
+            current = datetime.combine(datetime.min, start)
+            while current.time() < end:
+                times.append(current.time())
+                current += timedelta(minutes=minutes)
+    return times
+
+def seed_database(evura, doctors, patients, appointments, records, seed):
+    """Replace the database contents with a reproducible synthetic data set"""
+    rng = random.Random(seed)
+    db = evura.db
+    password = evura.bcrypt.generate_password_hash(BENCH_PASSWORD).decode('utf-8')
+    start = datetime(2015, 1, 1)
+    span_days = (datetime(2025, 1, 1) - start).days
+
+    with evura.app.app_context():
+        db.drop_all()
+        db.create_all()
+        evura.run_migrations()
+
+        def insert(model, rows, chunk=5000):
+            for i in range(0, len(rows), chunk):
+                db.session.execute(db.insert(model), rows[i:i + chunk])
+
+        insert(evura.Doctor, [{
+            'username': f'doctor{i}', 'email': f'doctor{i}@bench.invalid', 'password': password,
+            'specialization': rng.choice(SPECIALIZATIONS), 'hospital': rng.choice(HOSPITALS),
+            'years_experience': rng.randint(1, 35), 'license_number': f'RMDC-{i:05d}',
+        } for i in range(doctors)])
+        insert(evura.Patient, [{
+            'username': f'patient{i}', 'email': f'patient{i}@bench.invalid', 'password': password,
+            'blood_type': rng.choice(['A+', 'B+', 'O+', 'AB+', 'O-']), 'date_of_birth': f'{rng.randint(1940, 2015)}-01-01',
+            'chronic_conditions': rng.choice(CHRONIC_CONDITIONS) if rng.random() < 0.3 else '',
+        } for i in range(patients)])
+        doctor_ids = [row[0] for row in db.session.execute(db.select(evura.Doctor.id))]
+        patient_ids = [row[0] for row in db.session.execute(db.select(evura.Patient.id))]
+
+        # Past appointments, each in a distinct slot of its doctor's default grid
+        slot_times = weekday_slot_times(evura)
+        taken = set()
+        rows = []
+        while len(rows) < appointments:
+            doctor_id = rng.choice(doctor_ids)
+            when = start + timedelta(days=rng.randrange(span_days))
+            slot = (doctor_id, when.date(), rng.choice(slot_times))
+            if when.weekday() >= 5 or slot in taken:
+                continue
+            taken.add(slot)
+            rows.append({
+                'patient_id': rng.choice(patient_ids), 'doctor_id': doctor_id,
+                'date': slot[1].isoformat(), 'time': slot[2].strftime('%H:%M'),
+                'slot_date': slot[1], 'slot_time': slot[2], 'reason': 'Follow-up visit',
+                'status': rng.choice(['completed', 'completed', 'cancelled', 'confirmed']), 'created_at': when,
+            })
+        insert(evura.Appointment, rows)
+
+        def when():
+            return start + timedelta(days=rng.randrange(span_days), minutes=rng.randrange(1440))
+
+        for kind, model, build in [
+            ('tests', evura.TestResult, lambda pid, did: {
+                'test_name': rng.choice(['CBC', 'HbA1c', 'Lipid panel', 'Creatinine']), 'test_type': 'Blood',
+                'result_value': f'{rng.uniform(3, 12):.1f}', 'test_date': when()}),
+            ('procedures', evura.Procedure, lambda pid, did: {
+                'procedure_name': rng.choice(['Debridement', 'Bone biopsy', 'Cast application']),
+                'procedure_type': 'Treatment', 'description': 'Synthetic benchmark procedure', 'procedure_date': when()}),
+            ('prescriptions', evura.Prescription, lambda pid, did: {
+                'medication_name': rng.choice(['Metformin', 'Amlodipine', 'Ciprofloxacin']), 'dosage': '500mg',
+                'frequency': 'Twice daily', 'duration': '30 days', 'reason': 'Synthetic', 'start_date': when(),
+                'prescribed_date': when()}),
+            ('files', evura.MedicalFile, lambda pid, did: {
+                'filename': 'missing.pdf', 'original_filename': 'report.pdf', 'file_type': 'Lab Report',
+                'file_category': 'Lab', 'test_date': when()}),
+        ]:
+            insert(model, [{'patient_id': pid, 'doctor_id': rng.choice(doctor_ids),
+                            'is_chronic_related': rng.random() < 0.2, **build(pid, None)}
+                           for pid in patient_ids for _ in range(records)])
+        db.session.commit()
+
+        with db.engine.begin() as conn:
+            evura.rebuild_doctor_stats(conn)
+            evura.backfill_care_access(conn)
+            evura.rebuild_condition_registry(conn)
+            evura.index_lab_values(conn)
+    return {'doctors': doctors, 'patients': patients, 'appointments': appointments, 'records_per_type': records}
+
+
+# SCENARIOS
+
+class Scenario:
+    def __init__(self, name, endpoint, user_type, build):
+        self.name, self.endpoint, self.user_type, self.build = name, endpoint, user_type, build
+
+
+def build_scenarios(evura, users, doctor_ids, slot_counter):
+    """Each build(rng, user) returns (method, path, form data, files) for one request"""
+    slot_times = [t.strftime('%H:%M') for t in weekday_slot_times(evura)]
+
+    def next_slot():
+        # Every booking gets its own future (weekday, time), so none collide
+        n = next(slot_counter)
+        day = datetime.now().date()
+        for _ in range(1 + n // len(slot_times)):
+            day += timedelta(days=1)
+            while day.weekday() >= 5:
+                day += timedelta(days=1)
+        return day, slot_times[n % len(slot_times)]
+
+    def book(rng, user):
+        day, time = next_slot()
+        return 'POST', '/appointment/book', {'doctor_id': rng.choice(doctor_ids), 'date': day.isoformat(),
+                                             'time': time, 'reason': 'Benchmark booking'}, None
+
+    def upload(rng, user):
+        return 'POST', '/patient/upload-records', {
+            'upload_type': 'file', 'file_type': 'Lab Report', 'file_category': 'Lab', 'test_date': '2024-06-01',
+        }, {'medical_file': ('bench.pdf', rng.randbytes(32 * 1024))}
+
+    return [
+        Scenario('login', 'login', None, lambda rng, user: (
+            'POST', '/login', {'email': rng.choice(users['patient'])['email'],
+                               'password': BENCH_PASSWORD, 'user_type': 'patient'}, None)),
+        Scenario('patient_dashboard', 'patient_dashboard', 'patient',
+                 lambda rng, user: ('GET', '/patient/dashboard', None, None)),
+        Scenario('doctor_dashboard', 'doctor_dashboard', 'doctor',
+                 lambda rng, user: ('GET', '/doctor/dashboard', None, None)),
+        Scenario('consultations', 'consultations', 'doctor',
+                 lambda rng, user: ('GET', '/doctor/consultations', None, None)),
+        Scenario('patient_history', 'view_patient_history', 'doctor',
+                 lambda rng, user: ('GET', f"/doctor/patient-history/{user['patient_id']}", None, None)),
+        Scenario('medical_records', 'medical_records', 'patient',
+                 lambda rng, user: ('GET', '/patient/medical-records', None, None)),
+        Scenario('find_doctors', 'find_doctors', 'patient', lambda rng, user: (
+            'GET', '/patient/find-doctors?' + urllib.parse.urlencode({'q': rng.choice('abcdefghd')}), None, None)),
+        Scenario('book_appointment', 'book_appointment', 'patient', book),
+        Scenario('upload_record', 'upload_records', 'patient', upload),
+    ]
+
+
+class TestClientDriver:
+    """Runs requests in-process through the Flask test client and counts SQL per request"""
+
+    def __init__(self, evura):
+        self.evura = evura
+        self._local = threading.local()
+        evura.event.listen(evura.Engine, 'after_cursor_execute', self._count_statement)
+
+    def _count_statement(self, *args):
+        self._local.statements = getattr(self._local, 'statements', 0) + 1
+
+    def client_for(self, user):
+        client = self.evura.app.test_client()
+        if user:
+            with client.session_transaction() as session:
+                session['user_id'], session['user_type'] = user['id'], user['type']
+                session['username'] = user['username']
+        return client
+
+    def request(self, client, method, path, data, files):
+        if files:
+            data = dict(data, **{name: (io.BytesIO(content), filename) for name, (filename, content) in files.items()})
+        self._local.statements = 0
+        started = perf_counter()
+        response = client.open(path, method=method, data=data)
+        elapsed = perf_counter() - started
+        return elapsed, response.status_code, self._local.statements
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver:
+    """Runs requests against a live server (e.g. gunicorn wsgi:app); SQL counts come from /metrics"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def client_for(self, user):
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+        if user:
+            self._send(opener, 'POST', '/login', {'email': user['email'], 'password': BENCH_PASSWORD,
+                                                  'user_type': user['type']}, None)
+        return opener
+
+    def _send(self, opener, method, path, data, files):
+        body, headers = None, {}
+        if files:
+            boundary = 'evura-bench-boundary'
+            parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+                     for name, value in (data or {}).items()]
+            for name, (filename, content) in files.items():
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                             f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+            body = b''.join(parts) + f'--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        request = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        try:
+            with opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def request(self, client, method, path, data, files):
+        started = perf_counter()
+        status = self._send(client, method, path, data, files)
+        return perf_counter() - started, status, None
+
+    def sql_totals(self):
+        """(sum, count) of evura_request_sql_statements per endpoint, from the server's /metrics"""
+        totals = {}
+        try:
+            request = urllib.request.Request(self.base_url + '/metrics',
+                                             headers={'Authorization': f"Bearer {os.environ.get('METRICS_TOKEN', '')}"})
+            with urllib.request.urlopen(request) as response:
+                text = response.read().decode()
+        except OSError:
+            return totals
+        for line in text.splitlines():
+            for suffix, index in (('_sum', 0), ('_count', 1)):
+                prefix = f'evura_request_sql_statements{suffix}{{endpoint="'
+                if line.startswith(prefix):
+                    endpoint, value = line[len(prefix):].split('"}')
+                    totals.setdefault(endpoint, [0.0, 0.0])[index] = float(value)
+        return totals
+
+
+def run_scenario(driver, scenario, users, requests_per_scenario, concurrency, seed):
+    latencies, statements, errors = [], [], 0
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker(worker_id):
+        nonlocal errors
+        rng = random.Random(seed * 1000 + worker_id)
+        user = rng.choice(users[scenario.user_type]) if scenario.user_type else None
+        client = driver.client_for(user)
+        while next(counter) < requests_per_scenario:
+            elapsed, status, sql = driver.request(client, *scenario.build(rng, user))
+            with lock:
+                latencies.append(elapsed)
+                if sql is not None:
+                    statements.append(sql)
+                if status >= 400:
+                    errors += 1
+
+    started = perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies), 'errors': errors, 'throughput_rps': round(len(latencies) / wall, 2),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2), 'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'sql_per_request': round(sum(statements) / len(statements), 2) if statements else None,
+    }
+
+
+def load_users(evura):
+    """Benchmark users: patients, and doctors paired with a patient they have seen"""
+    with evura.app.app_context():
+        db = evura.db
+        pairs = db.session.execute(db.select(evura.Appointment.doctor_id, evura.Appointment.patient_id)
+                                   .group_by(evura.Appointment.doctor_id, evura.Appointment.patient_id)
+                                   .limit(500)).all()
+        doctors = {d.id: d for d in evura.Doctor.query.filter(evura.Doctor.id.in_({p[0] for p in pairs}))}
+        patients = evura.Patient.query.filter(evura.Patient.email.like('%@bench.invalid')).limit(500).all()
+        users = {
+            'patient': [{'id': p.id, 'type': 'patient', 'username': p.username, 'email': p.email} for p in patients],
+            'doctor': [{'id': did, 'type': 'doctor', 'username': doctors[did].username, 'email': doctors[did].email,
+                        'patient_id': pid} for did, pid in pairs],
+        }
+        doctor_ids = [row[0] for row in db.session.execute(db.select(evura.Doctor.id))]
+        # Earlier runs' bookings hold the first slots; continue after them
+        future_bookings = evura.Appointment.query.filter(evura.Appointment.slot_date > datetime.now().date()).count()
+    if not users['patient'] or not users['doctor']:
+        raise click.ClickException('No benchmark data found; run "python benchmark.py seed" first.')
+    return users, doctor_ids, future_bookings
+
+
+def print_results(results):
+    click.echo(f"{'scenario':<20}{'reqs':>7}{'err':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'sql/req':>9}")
+    for name, r in results['scenarios'].items():
+        sql = '-' if r['sql_per_request'] is None else f"{r['sql_per_request']:.1f}"
+        click.echo(f"{name:<20}{r['requests']:>7}{r['errors']:>6}{r['throughput_rps']:>9.1f}"
+                   f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{sql:>9}")
+
+
+# EMAIL RENDERING BASELINE
+
+def legacy_render_email_template(template_name, **kwargs):
+    """The f-string email renderer app.py used before the Jinja templates, kept as the
+    baseline for `flask --app app bench-email-render`. Values are not escaped."""
+    base_style = """
+    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; border: 1px solid #e5e7eb; border-radius: 15px; overflow: hidden;">
+        <div style="background: linear-gradient(135deg, #0d9488, #14b8a6); color: white; padding: 25px; text-align: center;">
+            <h2 style="margin: 0; font-size: 28px; font-weight: bold;">E-Vura Healthcare</h2>
+            <p style="margin: 8px 0 0; opacity: 0.9; font-size: 16px;">Your Smart Healthcare Connection</p>
+        </div>
+        <div style="padding: 30px;">
+            {content}
+        </div>
+        <div style="background: #f9fafb; padding: 20px; text-align: center; border-top: 1px solid #e5e7eb; color: #6b7280;">
+            <p style="margin: 0; font-size: 14px;">© 2025 E-Vura Healthcare Platform</p>
+            <p style="margin: 5px 0 0; font-size: 14px;">Bumbogo, Kigali Innovation City, Rwanda</p>
+            <p style="margin: 5px 0 0; font-size: 14px;">+250 784 650 21/2 | info@e-vura.com</p>
+        </div>
+    </div>
+    """
+    
+    templates = {
+        'appointment_request': f"""
+            <div style="text-align: center; margin-bottom: 25px;">
+                <h3 style="color: #0d9488; font-size: 24px; margin-bottom: 10px;">🩺 New Appointment Request</h3>
+            </div>
+            
+            <p style="font-size: 16px; line-height: 1.6;">Dear <strong>Dr. {kwargs.get('doctor_name')}</strong>,</p>
+            <p style="font-size: 16px; line-height: 1.6;">You have received a new appointment request from a patient:</p>
+            
+            <div style="background: #f0f9ff; border-left: 4px solid #0ea5e9; padding: 20px; margin: 25px 0; border-radius: 8px;">
+                <p style="margin: 8px 0; font-size: 15px;"><strong>** Patient:</strong> {kwargs.get('patient_name')}</p>
+                <p style="margin: 8px 0; font-size: 15px;"><strong>** Date:</strong> {kwargs.get('date')}</p>
+                <p style="margin: 8px 0; font-size: 15px;"><strong>** Time:</strong> {kwargs.get('time')}</p>
+                <p style="margin: 8px 0; font-size: 15px;"><strong>** Reason:</strong> {kwargs.get('reason', 'General consultation')}</p>
+                {f"<div style='background: #fef2f2; border: 1px solid #fecaca; padding: 15px; border-radius: 8px; margin-top: 15px;'><p style='margin: 0; color: #dc2626; font-weight: bold; font-size: 15px;'>⚠️ CHRONIC CONDITION: {kwargs.get('chronic_conditions')}</p></div>" if kwargs.get('chronic_conditions') else ""}
+            </div>
+            
+            <div style="background: #ecfdf5; border-left: 4px solid #10b981; padding: 15px; margin: 25px 0; border-radius: 8px;">
+                <p style="margin: 0; color: #065f46; font-size: 14px;">
+                    <strong>** Next Steps:</strong> Please log in to your E-Vura dashboard to review and respond to this appointment request.
+                </p>
+            </div>
+            
+            <p style="margin-top: 30px; font-size: 16px;">Best regards,<br><strong>The E-Vura Healthcare Team</strong></p>
+        """,
+        
+        'appointment_confirmed': f"""
+            <div style="text-align: center; margin-bottom: 25px;">
+                <h3 style="color: #10b981; font-size: 24px; margin-bottom: 10px;"> Appointment Confirmed!</h3>
+            </div>
+            
+            <p style="font-size: 16px; line-height: 1.6;">Dear <strong>{kwargs.get('patient_name')}</strong>,</p>
+            <p style="font-size: 16px; line-height: 1.6;">Great news! Your appointment has been <strong style="color: #10b981;">confirmed</strong>:</p>
+            
+            <div style="background: #ecfdf5; border-left: 4px solid #10b981; padding: 20px; margin: 25px 0; border-radius: 8px;">
+                <p style="margin: 8px 0; font-size: 15px;"><strong>** Doctor:</strong> Dr. {kwargs.get('doctor_name')}</p>
+                <p style="margin: 8px 0; font-size: 15px;"><strong>** Date:</strong> {kwargs.get('date')}</p>
+                <p style="margin: 8px 0; font-size: 15px;"><strong>** Time:</strong> {kwargs.get('time')}</p>
+                <p style="margin: 8px 0; font-size: 15px;"><strong>** Location:</strong> {kwargs.get('hospital', 'Please contact doctor for location details')}</p>
+            </div>
+            
+            <div style="background: #fef7f0; border-left: 4px solid #f59e0b; padding: 20px; margin: 25px 0; border-radius: 8px;">
+                <p style="margin: 0 0 10px; color: #92400e; font-weight: bold; font-size: 15px;">** Important Reminders:</p>
+                <ul style="margin: 0; color: #78350f; line-height: 1.8;">
+                    <li>Please arrive 15 minutes early for check-in</li>
+                    <li>Bring a valid ID and any relevant medical documents</li>
+                    <li>Your complete medical history is already accessible to the doctor via E-Vura</li>
+                </ul>
+            </div>
+            
+            <p style="font-size: 16px; line-height: 1.6;">If you need to reschedule or have any questions, please contact us.</p>
+            <p style="margin-top: 30px; font-size: 16px;">Best regards,<br><strong>The E-Vura Healthcare Team</strong></p>
+        """,
+        
+        'appointment_rejected': f"""
+            <div style="text-align: center; margin-bottom: 25px;">
+                <h3 style="color: #ef4444; font-size: 24px; margin-bottom: 10px;">** Appointment Update</h3>
+            </div>
+            
+            <p style="font-size: 16px; line-height: 1.6;">Dear <strong>{kwargs.get('patient_name')}</strong>,</p>
+            <p style="font-size: 16px; line-height: 1.6;">We regret to inform you that <strong>Dr. {kwargs.get('doctor_name')}</strong> is not available for your requested appointment on <strong>{kwargs.get('date')}</strong> at <strong>{kwargs.get('time')}</strong>.</p>
+            
+            <div style="background: #fef2f2; border-left: 4px solid #ef4444; padding: 20px; margin: 25px 0; border-radius: 8px;">
+                <p style="margin: 0 0 10px; color: #dc2626; font-weight: bold; font-size: 15px;">** What's Next?</p>
+                <ul style="margin: 0; color: #991b1b; line-height: 1.8;">
+                    <li>Log in to your E-Vura dashboard</li>
+                    <li>Select a different available time slot</li>
+                    <li>Or choose another qualified doctor</li>
+                </ul>
+            </div>
+            
+            <p style="font-size: 16px; line-height: 1.6;">We apologize for any inconvenience and appreciate your understanding.</p>
+            <p style="margin-top: 30px; font-size: 16px;">Best regards,<br><strong>The E-Vura Healthcare Team</strong></p>
+        """,
+        
+        'appointment_completed': f"""
+            <div style="text-align: center; margin-bottom: 25px;">
+                <h3 style="color: #0d9488; font-size: 24px; margin-bottom: 10px;">** Consultation Complete</h3>
+            </div>
+            
+            <p style="font-size: 16px; line-height: 1.6;">Dear <strong>{kwargs.get('patient_name')}</strong>,</p>
+            <p style="font-size: 16px; line-height: 1.6;">Your consultation with <strong>Dr. {kwargs.get('doctor_name')}</strong> on <strong>{kwargs.get('date')}</strong> has been completed successfully.</p>
+            
+            <div style="background: #f0fdfa; border-left: 4px solid #0d9488; padding: 20px; margin: 25px 0; border-radius: 8px;">
+                <p style="margin: 0 0 10px; color: #065f46; font-weight: bold; font-size: 15px;">** What's Been Updated:</p>
+                <ul style="margin: 0; color: #047857; line-height: 1.8;">
+                    <li>Your medical records have been updated with new information</li>
+                    <li>New diagnosis and treatment details added to your history</li>
+                    <li>All records are accessible for your next doctor visit</li>
+                    <li>Chronic condition status updated if applicable</li>
+                </ul>
+            </div>
+            
+            <p style="font-size: 16px; line-height: 1.6;">You can view your updated medical history anytime in your E-Vura dashboard.</p>
+            <p style="font-size: 16px; line-height: 1.6;">Take care and thank you for trusting E-Vura with your healthcare journey!</p>
+            <p style="margin-top: 30px; font-size: 16px;">Best regards,<br><strong>The E-Vura Healthcare Team</strong></p>
+        """
+    }
+    
+    content = templates.get(template_name, "<p>E-Vura Healthcare Platform notification</p>")
+    return base_style.format(content=content)
+
+
+
+# COMMANDS
+
+@click.group()
+def cli():
+    """E-Vura benchmark harness"""
+
+
+@cli.command()
+@click.option('--database', default=DEFAULT_DATABASE, show_default=True, help='Database URL to (re)create.')
+@click.option('--doctors', default=50, show_default=True)
+@click.option('--patients', default=2000, show_default=True)
+@click.option('--appointments', default=20000, show_default=True)
+@click.option('--records', default=5, show_default=True, help='Records of each type per patient.')
+@click.option('--seed', default=42, show_default=True, help='Random seed, for reproducible data.')
+def seed(database, doctors, patients, appointments, records, seed):
+    """Fill a database with synthetic benchmark data (drops existing tables)"""
+    evura = load_app(database)
+    started = perf_counter()
+    summary = seed_database(evura, doctors, patients, appointments, records, seed)
+    click.echo(f'Seeded {summary} in {perf_counter() - started:.1f}s')
+
+
+@cli.command()
+@click.option('--database', default=DEFAULT_DATABASE, show_default=True, help='Seeded database (test client mode).')
+@click.option('--url', default=None, help='Benchmark a running server instead, e.g. http://127.0.0.1:8000.')
+@click.option('--requests', 'requests_per_scenario', default=200, show_default=True, help='Requests per scenario.')
+@click.option('--concurrency', default=4, show_default=True, help='Concurrent virtual users.')
+@click.option('--scenario', 'only', multiple=True, help='Run only these scenarios (repeatable).')
+@click.option('--seed', default=42, show_default=True)
+@click.option('--json', 'json_path', default=None, help='Write results to this JSON file.')
+def run(database, url, requests_per_scenario, concurrency, only, seed, json_path):
+    """Drive the main routes and report throughput, latency percentiles and SQL per request"""
+    evura = load_app(database)
+    users, doctor_ids, future_bookings = load_users(evura)
+    if url:
+        driver = HttpDriver(url)
+    else:
+        driver = TestClientDriver(evura)
+        evura.blob_store.root = tempfile.mkdtemp(prefix='evura-bench-blobs-')
+        evura.blob_store.temp_dir = os.path.join(evura.blob_store.root, 'tmp')
+
+    scenarios = build_scenarios(evura, users, doctor_ids, itertools.count(future_bookings))
+    results = {'commit': git_commit(), 'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+               'mode': 'http' if url else 'test-client', 'database': None if url else evura.make_url(database).get_backend_name(),
+               'requests_per_scenario': requests_per_scenario, 'concurrency': concurrency, 'scenarios': {}}
+    for scenario in scenarios:
+        if only and scenario.name not in only:
+            continue
+        before = driver.sql_totals() if url else None
+        results['scenarios'][scenario.name] = result = run_scenario(
+            driver, scenario, users, requests_per_scenario, concurrency, seed)
+        if url:
+            after, start_totals = driver.sql_totals(), before.get(scenario.endpoint, [0.0, 0.0])
+            total, count = after.get(scenario.endpoint, [0.0, 0.0])
+            if count > start_totals[1]:
+                result['sql_per_request'] = round((total - start_totals[0]) / (count - start_totals[1]), 2)
+
+    print_results(results)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        click.echo(f'Results written to {json_path}')
+
+
+def write_worker(database, users, doctor_ids, slot_start, writes, barrier, results):
+    """One worker process booking appointments, like a gunicorn worker handling a booking burst"""
+    evura = load_app(database)
+    scenario = next(s for s in build_scenarios(evura, users, doctor_ids, itertools.count(slot_start))
+                    if s.name == 'book_appointment')
+    rng = random.Random(slot_start)
+    user = rng.choice(users['patient'])
+    driver = TestClientDriver(evura)
+    client = driver.client_for(user)
+    latencies = []
+    barrier.wait()
+    started = datetime.now().timestamp()
+    for _ in range(writes):
+        latencies.append(driver.request(client, *scenario.build(rng, user))[0])
+    results.put((started, datetime.now().timestamp(), latencies))
+
+
+def count_benchmark_bookings(evura):
+    with evura.app.app_context():
+        # Fresh connections pick up the journal mode being tested; none stay open for the workers
+        evura.db.engine.dispose()
+        count = evura.Appointment.query.filter_by(reason='Benchmark booking').count()
+        evura.db.engine.dispose()
+    return count
+
+
+@cli.command('write-bench')
+@click.option('--database', default=DEFAULT_DATABASE, show_default=True, help='Seeded database.')
+@click.option('--workers', default=4, show_default=True, help='Worker processes writing at once.')
+@click.option('--writes', default=100, show_default=True, help='Bookings per worker.')
+@click.option('--journal-mode', 'journal_modes', multiple=True, default=['delete', 'wal'], show_default=True,
+              help='SQLite journal modes to compare (ignored for other databases).')
+@click.option('--json', 'json_path', default=None, help='Write results to this JSON file.')
+def write_bench(database, workers, writes, journal_modes, json_path):
+    """Measure booking throughput with several worker processes writing at once"""
+    import multiprocessing
+    evura = load_app(database)
+    users, doctor_ids, future_bookings = load_users(evura)
+    if evura.make_url(database).get_backend_name() != 'sqlite':
+        journal_modes = [None]
+    context = multiprocessing.get_context('spawn')
+    results = {'commit': git_commit(), 'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+               'workers': workers, 'writes_per_worker': writes, 'runs': {}}
+    slot_start = future_bookings
+    for mode in journal_modes:
+        if mode:
+            os.environ['SQLITE_JOURNAL_MODE'] = evura.app.config['SQLITE_JOURNAL_MODE'] = mode.upper()
+        booked_before = count_benchmark_bookings(evura)
+        barrier, queue = context.Barrier(workers), context.Queue()
+        processes = [context.Process(target=write_worker, args=(
+            database, users, doctor_ids, slot_start + i * writes, writes, barrier, queue)) for i in range(workers)]
+        for process in processes:
+            process.start()
+        runs = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        slot_start += workers * writes
+
+        booked = count_benchmark_bookings(evura) - booked_before
+        wall = max(r[1] for r in runs) - min(r[0] for r in runs)
+        latencies = sorted(latency for r in runs for latency in r[2])
+        results['runs'][mode or 'default'] = {
+            'attempted': len(latencies), 'booked': booked, 'failed': len(latencies) - booked,
+            'writes_per_second': round(booked / wall, 1), 'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2), 'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        }
+
+    click.echo(f"{'journal mode':<14}{'booked':>8}{'failed':>8}{'writes/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for mode, r in results['runs'].items():
+        click.echo(f"{mode:<14}{r['booked']:>8}{r['failed']:>8}{r['writes_per_second']:>10.1f}"
+                   f"{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}")
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        click.echo(f'Results written to {json_path}')
+
+
+def login_scenario(accounts, password):
+    return Scenario('login', 'login', None, lambda rng, user: (
+        'POST', '/login', {'email': rng.choice(accounts)['email'], 'password': password, 'user_type': 'patient'}, None))
+
+
+@cli.command('login-bench')
+@click.option('--database', default=DEFAULT_DATABASE, show_default=True, help='Seeded database.')
+@click.option('--rounds', 'rounds_list', multiple=True, type=int, default=[10, 12], show_default=True,
+              help='bcrypt work factors to compare (repeatable).')
+@click.option('--requests', 'requests_per_run', default=100, show_default=True, help='Logins per work factor.')
+@click.option('--concurrency', default=8, show_default=True, help='Concurrent users logging in.')
+@click.option('--accounts', default=20, show_default=True, help='Distinct accounts logging in.')
+@click.option('--json', 'json_path', default=None, help='Write results to this JSON file.')
+def login_bench(database, rounds_list, requests_per_run, concurrency, accounts, json_path):
+    """Login throughput per bcrypt cost, and how much of a brute-force burst the throttle absorbs"""
+    evura = load_app(database)
+    users, _, _ = load_users(evura)
+    accounts = users['patient'][:accounts]
+    driver = TestClientDriver(evura)
+    results = {'commit': git_commit(), 'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+               'concurrency': concurrency, 'hash_threads': evura.app.config['PASSWORD_HASH_THREADS'], 'runs': {}}
+    for rounds in rounds_list:
+        evura.app.config['BCRYPT_LOG_ROUNDS'] = rounds
+        evura.login_throttle.clear()
+        # One login per account rehashes its password at the new cost
+        for account in accounts:
+            driver.request(driver.client_for(None), 'POST', '/login', {
+                'email': account['email'], 'password': BENCH_PASSWORD, 'user_type': 'patient'}, None)
+        run = run_scenario(driver, login_scenario(accounts, BENCH_PASSWORD), users,
+                           requests_per_run, concurrency, rounds)
+        # Wrong passwords against one account: throttled attempts (429) never reach bcrypt
+        brute = run_scenario(driver, login_scenario(accounts[:1], 'not-the-password'), users,
+                             requests_per_run, concurrency, rounds)
+        evura.login_throttle.clear()
+        results['runs'][rounds] = {'login': run, 'brute_force': {
+            'attempts': brute['requests'], 'throttled': brute['errors'], 'throughput_rps': brute['throughput_rps']}}
+
+    click.echo(f"{'rounds':<8}{'logins/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'err':>6}"
+               f"{'brute-force':>13}{'throttled':>11}")
+    for rounds, r in results['runs'].items():
+        login, brute = r['login'], r['brute_force']
+        click.echo(f"{rounds:<8}{login['throughput_rps']:>10.1f}{login['p50_ms']:>9.1f}{login['p95_ms']:>9.1f}"
+                   f"{login['p99_ms']:>9.1f}{login['errors']:>6}{brute['attempts']:>13}{brute['throttled']:>11}")
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        click.echo(f'Results written to {json_path}')
+
+
+LAB_TESTS = [('HbA1c', '%', 4.0, 5.6, 5.5), ('Creatinine', 'mg/dL', 0.6, 1.2, 1.0),
+             ('Potassium', 'mmol/L', 3.5, 5.0, 4.2), ('LDL cholesterol', 'mg/dL', 0, 130, 120)]
+
+
+@cli.command('lab-bench')
+@click.option('--database', default=DEFAULT_DATABASE, show_default=True, help='Seeded database.')
+@click.option('--patients', default=50, show_default=True, help='Patients analysed in one batch.')
+@click.option('--results', default=2000, show_default=True, help='Numeric test results per patient.')
+@click.option('--repeat', default=5, show_default=True, help='Timed runs per implementation.')
+@click.option('--seed', default=42, show_default=True)
+@click.option('--json', 'json_path', default=None, help='Write results to this JSON file.')
+def lab_bench(database, patients, results, repeat, seed, json_path):
+    """Lab trend analytics over patients with thousands of results, NumPy against pure Python"""
+    evura = load_app(database)
+    db = evura.db
+    rng = random.Random(seed)
+    with evura.app.app_context():
+        patient_ids = [row[0] for row in db.session.execute(db.select(evura.Patient.id).limit(patients))]
+        first_id = (db.session.execute(db.select(db.func.max(evura.TestResult.id))).scalar() or 0) + 1
+        start = datetime(2015, 1, 1)
+        for patient_id in patient_ids:
+            rows = []
+            for i in range(results):
+                name, unit, low, high, base = LAB_TESTS[i % len(LAB_TESTS)]
+                rows.append({'patient_id': patient_id, 'test_name': name, 'test_type': 'Blood',
+                             'result_value': f'{base * rng.uniform(0.7, 1.4):.2f} {unit}',
+                             'normal_range': f'{low}-{high}', 'test_date': start + timedelta(hours=i * 24)})
+            db.session.execute(evura.TestResult.__table__.insert(), rows)
+        evura.index_lab_values(db.session, patient_ids)
+        db.session.commit()
+
+        implementations = {'python': False}
+        if evura.np is not None:
+            implementations['numpy'] = True
+        output = {'commit': git_commit(), 'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+                  'patients': len(patient_ids), 'results_per_patient': results, 'runs': {}}
+        rows = evura.lab_value_rows(patient_ids)
+        window = evura.app.config['LAB_TREND_WINDOW']
+        for label, use_numpy in implementations.items():
+            evura.compute_lab_trends(rows[:100], window, use_numpy)  # warm up
+            compute, total = [], []
+            for _ in range(repeat):
+                started = perf_counter()
+                series = evura.compute_lab_trends(rows, window, use_numpy)
+                compute.append((perf_counter() - started) * 1000)
+                started = perf_counter()
+                evura.get_lab_trends(patient_ids, use_numpy=use_numpy)
+                total.append((perf_counter() - started) * 1000)
+            compute.sort()
+            total.sort()
+            output['runs'][label] = {'compute_ms': compute[len(compute) // 2], 'total_ms': total[len(total) // 2],
+                                     'series': len(series)}
+
+        # Leave the seeded database as it was for the other benchmarks
+        added = db.select(evura.TestResult.id).where(evura.TestResult.id >= first_id)
+        db.session.execute(evura.LabValue.__table__.delete().where(evura.LabValue.test_result_id.in_(added)))
+        db.session.execute(evura.TestResult.__table__.delete().where(evura.TestResult.id >= first_id))
+        db.session.commit()
+
+    total = len(patient_ids) * results
+    click.echo(f'{len(patient_ids)} patients x {results} results = {total} values')
+    click.echo(f"{'implementation':<16}{'compute ms':>12}{'values/s':>12}{'with SQL ms':>13}{'series':>8}")
+    for label, run in output['runs'].items():
+        click.echo(f"{label:<16}{run['compute_ms']:>12.1f}{total / run['compute_ms'] * 1000:>12.0f}"
+                   f"{run['total_ms']:>13.1f}{run['series']:>8}")
+    if 'numpy' not in output['runs']:
+        click.echo('NumPy is not installed; only the pure Python implementation was timed')
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(output, f, indent=2)
+        click.echo(f'Results written to {json_path}')
+
+
+@cli.command('reminder-bench')
+@click.option('--database', default=DEFAULT_DATABASE, show_default=True, help='Seeded database.')
+@click.option('--appointments', default=20000, show_default=True, help='Confirmed appointments due a reminder.')
+@click.option('--seed', default=42, show_default=True)
+@click.option('--json', 'json_path', default=None, help='Write results to this JSON file.')
+def reminder_bench(database, appointments, seed, json_path):
+    """One reminder scheduler pass over many upcoming confirmed appointments, delivered with the fake transport"""
+    evura = load_app(database)
+    db = evura.db
+    rng = random.Random(seed)
+    with evura.app.app_context():
+        doctor_ids = [row[0] for row in db.session.execute(db.select(evura.Doctor.id))]
+        patient_ids = [row[0] for row in db.session.execute(db.select(evura.Patient.id))]
+        first_id = (db.session.execute(db.select(db.func.max(evura.Appointment.id))).scalar() or 0) + 1
+        first_email_id = (db.session.execute(db.select(db.func.max(evura.EmailOutbox.id))).scalar() or 0) + 1
+        started_at = datetime.utcnow()
+        now = datetime.now()
+        rows = []
+        for i in range(appointments):
+            # Odd microseconds keep these clear of the seeded slots in the active-slot unique index
+            when = now.replace(microsecond=500000) + timedelta(minutes=1, seconds=i * 3)
+            rows.append({'patient_id': rng.choice(patient_ids), 'doctor_id': doctor_ids[i % len(doctor_ids)],
+                         'date': when.date().isoformat(), 'time': when.strftime('%H:%M'),
+                         'slot_date': when.date(), 'slot_time': when.time(), 'reason': 'Reminder benchmark',
+                         'status': 'confirmed', 'created_at': started_at})
+        db.session.execute(evura.Appointment.__table__.insert(), rows)
+        db.session.commit()
+
+        transport = evura.create_email_transport()
+        started = perf_counter()
+        queued = evura.queue_appointment_reminders(now)
+        queue_ms = (perf_counter() - started) * 1000
+        started = perf_counter()
+        delivered = evura.drain_outbox(transport)
+        deliver_ms = (perf_counter() - started) * 1000
+
+        # Leave the seeded database as it was for the other benchmarks
+        db.session.execute(evura.EmailOutbox.__table__.delete().where(evura.EmailOutbox.id >= first_email_id))
+        db.session.execute(evura.Appointment.__table__.delete().where(evura.Appointment.id >= first_id))
+        db.session.execute(evura.Appointment.__table__.update()
+                           .where(evura.Appointment.reminder_sent_at >= started_at).values(reminder_sent_at=None))
+        db.session.commit()
+
+    output = {'commit': git_commit(), 'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+              'appointments': appointments, 'queued': queued, 'delivered': delivered,
+              'queue_ms': queue_ms, 'deliver_ms': deliver_ms}
+    click.echo(f'{queued} reminders queued in {queue_ms:.0f} ms ({queued / queue_ms * 1000:.0f}/s)')
+    click.echo(f'{delivered} emails rendered and sent in {deliver_ms:.0f} ms ({delivered / deliver_ms * 1000:.0f}/s)')
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(output, f, indent=2)
+        click.echo(f'Results written to {json_path}')
+
+
+@cli.command()
+@click.argument('baseline', type=click.File())
+@click.argument('candidate', type=click.File())
+@click.option('--threshold', default=10.0, show_default=True, help='Allowed p95 slowdown in percent.')
+def compare(baseline, candidate, threshold):
+    """Compare two result files; exits 1 if any scenario's p95 or SQL count regressed"""
+    old, new = json.load(baseline), json.load(candidate)
+    click.echo(f"{old.get('commit')} -> {new.get('commit')}")
+    regressions = []
+    for name, after in new['scenarios'].items():
+        before = old['scenarios'].get(name)
+        if not before:
+            continue
+        change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0.0
+        sql_before, sql_after = before.get('sql_per_request'), after.get('sql_per_request')
+        more_sql = sql_before is not None and sql_after is not None and sql_after > sql_before
+        flag = 'REGRESSION' if change > threshold or more_sql else ''
+        if flag:
+            regressions.append(name)
+        click.echo(f"{name:<20} p95 {before['p95_ms']:>8.1f} -> {after['p95_ms']:>8.1f} ms ({change:+6.1f}%)"
+                   f"  sql {sql_before} -> {sql_after}  {flag}")
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    cli()
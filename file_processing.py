@@ -0,0 +1,146 @@
+"""Thumbnails, previews and metadata for uploaded medical files.
+
+These functions run in the worker processes started by app.py, so they never
+import the Flask app or touch the database: a job gets file paths and sizes,
+writes its JPEGs and returns plain metadata for the caller to store.
+"""
+import os
+from datetime import datetime
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional: no thumbnails or previews without Pillow
+    Image = None
+try:
+    import numpy as np
+except ImportError:  # optional: needed for DICOM previews
+    np = None
+try:
+    import pydicom
+except ImportError:  # optional: DICOM files are left unprocessed
+    pydicom = None
+try:
+    import pymupdf
+except ImportError:
+    try:
+        import fitz as pymupdf  # PyMuPDF before 1.24.3
+    except ImportError:  # optional: PDFs get no first-page preview
+        pymupdf = None
+
+FILE_KINDS = {'png': 'image', 'jpg': 'image', 'jpeg': 'image', 'pdf': 'pdf', 'dcm': 'dicom'}
+JPEG_QUALITY = 82
+
+class MissingDependency(Exception):
+    """The libraries needed for this kind of file are not installed"""
+
+def file_kind(filename):
+    """'image', 'pdf' or 'dicom' by extension; None for files that are never previewed"""
+    return FILE_KINDS.get(filename.rsplit('.', 1)[-1].lower()) if '.' in filename else None
+
+def parse_exif_date(value):
+    try:
+        return datetime.strptime(str(value).strip().rstrip('\x00'), '%Y:%m:%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+
+def parse_dicom_date(date_value, time_value=None):
+    """DICOM DA (YYYYMMDD) plus an optional TM (HHMMSS.ffffff) as a datetime"""
+    try:
+        day = datetime.strptime(str(date_value).strip()[:8], '%Y%m%d')
+    except (TypeError, ValueError):
+        return None
+    digits = str(time_value or '').split('.')[0].strip()
+    if len(digits) >= 4 and digits.isdigit():
+        digits = digits.ljust(6, '0')
+        day = day.replace(hour=min(int(digits[:2]), 23), minute=min(int(digits[2:4]), 59),
+                          second=min(int(digits[4:6]), 59))
+    return day
+
+def to_8bit(image):
+    """Stretch 16-bit and float greyscale images to 0-255 so they can be saved as JPEG"""
+    if image.mode in ('I', 'I;16', 'I;16B', 'F'):
+        image = image.convert('F')
+        low, high = image.getextrema()
+        scale = 255.0 / (high - low) if high > low else 1.0
+        image = image.point(lambda value: (value - low) * scale).convert('L')
+    elif image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+    return image
+
+def _process_image(source, preview_size):
+    if Image is None:
+        raise MissingDependency('Pillow is not installed')
+    with Image.open(source) as image:
+        details = {'format': image.format, 'width': image.width, 'height': image.height}
+        exif = image.getexif()
+        taken = exif.get_ifd(0x8769).get(36867) or exif.get(306)  # DateTimeOriginal, DateTime
+        device = ' '.join(str(exif[tag]).strip('\x00 ') for tag in (271, 272) if exif.get(tag))  # Make, Model
+        if device:
+            details['device'] = device
+        # JPEGs decode straight at a reduced scale instead of at full resolution
+        image.draft('RGB', (preview_size, preview_size))
+        preview = to_8bit(ImageOps.exif_transpose(image))
+    return preview, {'study_date': parse_exif_date(taken), 'modality': None, 'details': details}
+
+def _process_dicom(source, preview_size):
+    if pydicom is None:
+        raise MissingDependency('pydicom is not installed')
+    dataset = pydicom.dcmread(source, stop_before_pixels=True)
+    study_date = parse_dicom_date(dataset.get('StudyDate') or dataset.get('SeriesDate')
+                                  or dataset.get('AcquisitionDate'), dataset.get('StudyTime'))
+    details = {key: str(dataset.get(key)) for key in
+               ('StudyDescription', 'BodyPartExamined', 'Manufacturer', 'Rows', 'Columns', 'NumberOfFrames')
+               if dataset.get(key) not in (None, '')}
+    modality = str(dataset.get('Modality') or '').strip().upper()[:16] or None
+
+    preview = None
+    if Image is not None and np is not None:
+        try:
+            try:
+                from pydicom.pixels import pixel_array  # pydicom 3 reads just the first frame from disk
+                pixels = pixel_array(source, index=0)
+            except ImportError:
+                pixels = pydicom.dcmread(source).pixel_array
+                if int(dataset.get('NumberOfFrames') or 1) > 1:
+                    pixels = pixels[0]
+            if pixels.ndim == 3:
+                preview = Image.fromarray(pixels.astype(np.uint8))
+            else:
+                preview = to_8bit(Image.fromarray(pixels.astype(np.float32)))
+                if dataset.get('PhotometricInterpretation') == 'MONOCHROME1':
+                    preview = ImageOps.invert(preview)
+        except Exception as e:  # e.g. a compressed transfer syntax without its decoder installed
+            details['preview_error'] = f'{type(e).__name__}: {e}'
+    return preview, {'study_date': study_date, 'modality': modality, 'details': details}
+
+def _process_pdf(source, preview_size):
+    if pymupdf is None or Image is None:
+        raise MissingDependency('PyMuPDF and Pillow are needed for PDF previews')
+    with pymupdf.open(source) as document:
+        details = {'pages': document.page_count}
+        page = document[0]
+        zoom = preview_size / max(page.rect.width, page.rect.height, 1)
+        pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+        preview = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    return preview, {'study_date': None, 'modality': None, 'details': details}
+
+PROCESSORS = {'image': _process_image, 'dicom': _process_dicom, 'pdf': _process_pdf}
+
+def _write_jpeg(image, path):
+    # Written beside the target and renamed, so a page never loads a half-written file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{os.getpid()}.part'
+    image.save(partial, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    os.replace(partial, path)
+
+def process_file(source, kind, thumbnail_path, preview_path, thumbnail_size, preview_size):
+    """Write a thumbnail and a larger preview for one file and return what was read from it:
+    {'study_date': datetime or None, 'modality': str or None, 'details': {...}, 'preview': bool}"""
+    image, info = PROCESSORS[kind](source, preview_size)
+    if image is not None:
+        image.thumbnail((preview_size, preview_size))
+        _write_jpeg(image, preview_path)
+        image.thumbnail((thumbnail_size, thumbnail_size))
+        _write_jpeg(image, thumbnail_path)
+    info['preview'] = image is not None
+    return info
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+
+# app.py reads its settings and opens the database at import time
+_DB_DIR = tempfile.mkdtemp(prefix='evura-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_DB_DIR, 'evura.db')}"
+os.environ['EMAIL_WORKER_THREADS'] = '0'
+os.environ['FILE_PROCESSING_WORKERS'] = '0'
+os.environ['EMAIL_TRANSPORT'] = 'fake'
+os.environ['REQUEST_LOG'] = '0'
+os.environ['BCRYPT_LOG_ROUNDS'] = '4'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as evura  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+with evura.app.app_context():
+    engine = evura.db.engine
+
+CACHES = (evura.user_profile_cache, evura.doctor_stats_cache, evura.care_access_cache, evura.lab_trend_cache,
+          evura.fragment_cache, evura.login_throttle)
+
+
+def clear_caches():
+    for cache in CACHES:
+        cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clean_database():
+    """Empties every table after each test; requests made by a test get their own app context"""
+    yield
+    with engine.begin() as conn:
+        for table in reversed(evura.db.metadata.sorted_tables):
+            if table.name != 'schema_migration':
+                conn.execute(table.delete())
+    clear_caches()
+
+
+@pytest.fixture
+def client():
+    return evura.app.test_client()
+
+
+def log_in(client, user_type, user_id):
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = user_id
+        client_session['user_type'] = user_type
+
+
+@contextmanager
+def count_queries():
+    """Collects every SQL statement run inside the block"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
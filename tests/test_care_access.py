@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import evura, log_in
+
+db = evura.db
+
+
+@pytest.fixture
+def grant(monkeypatch):
+    """(doctor id, patient id) for a doctor holding a 30-day grant to the patient's records"""
+    monkeypatch.setitem(evura.app.config, 'CARE_ACCESS_DAYS', 30)
+    monkeypatch.setitem(evura.app.config, 'CARE_ACCESS_CACHE_TTL', 3600)
+    with evura.app.app_context():
+        doctor = evura.Doctor(username='dr-granted', email='dr-granted@example.invalid', password='!')
+        patient = evura.Patient(username='granting', email='granting@example.invalid', password='!')
+        db.session.add_all([doctor, patient])
+        db.session.flush()
+        evura.grant_care_access(doctor.id, patient.id)
+        db.session.commit()
+        return doctor.id, patient.id
+
+
+def history(client, doctor_id, patient_id):
+    log_in(client, 'doctor', doctor_id)
+    return client.get(f'/doctor/patient-history/{patient_id}')
+
+
+def test_revoked_grant_is_refused_on_the_next_request(client, grant):
+    doctor_id, patient_id = grant
+    assert history(client, doctor_id, patient_id).status_code == 200  # the grant is now cached
+
+    patient_client = evura.app.test_client()
+    log_in(patient_client, 'patient', patient_id)
+    assert patient_client.post(f'/patient/care-access/{doctor_id}/revoke').status_code == 302
+
+    refused = history(client, doctor_id, patient_id)
+    assert refused.status_code == 302 and refused.location.endswith('/doctor/dashboard')
+    with evura.app.app_context():
+        assert not evura.doctor_can_access_patient(doctor_id, patient_id)
+
+
+def test_expired_grant_is_refused_while_still_cached(client, grant, monkeypatch):
+    doctor_id, patient_id = grant
+    assert history(client, doctor_id, patient_id).status_code == 200
+
+    class Later(datetime):
+        @classmethod
+        def utcnow(cls):
+            return datetime.utcnow() + timedelta(days=31)
+    monkeypatch.setattr(evura, 'datetime', Later)
+
+    assert history(client, doctor_id, patient_id).status_code == 302
@@ -0,0 +1,48 @@
+import threading
+from datetime import datetime, timedelta
+
+from conftest import evura, log_in
+
+db = evura.db
+THREADS = 12
+
+
+def test_concurrent_bookings_of_one_slot_leave_one_appointment():
+    with evura.app.app_context():
+        doctor = evura.Doctor(username='dr-race', email='dr-race@example.invalid', password='!')
+        patients = [evura.Patient(username=f'race-patient-{i}', email=f'race-patient-{i}@example.invalid',
+                                  password='!') for i in range(THREADS)]
+        db.session.add_all([doctor] + patients)
+        db.session.commit()
+        doctor_id, patient_ids = doctor.id, [p.id for p in patients]
+        slot_date = datetime.now().date() + timedelta(days=1)
+        while slot_date.weekday() >= 5:
+            slot_date += timedelta(days=1)
+        slot_time = evura.get_weekly_slot_grid(doctor_id)[slot_date.weekday()][0]
+
+    barrier = threading.Barrier(THREADS)
+    outcomes = {}
+
+    def book(patient_id):
+        client = evura.app.test_client()
+        log_in(client, 'patient', patient_id)
+        barrier.wait()
+        response = client.post('/appointment/book', data={
+            'doctor_id': doctor_id, 'date': slot_date.isoformat(), 'time': slot_time.strftime('%H:%M'),
+            'reason': 'race'})
+        with client.session_transaction() as client_session:
+            messages = [message for _, message in client_session.get('_flashes', [])]
+        outcomes[patient_id] = (response.status_code, messages)
+
+    workers = [threading.Thread(target=book, args=(patient_id,)) for patient_id in patient_ids]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert all(status == 302 for status, _ in outcomes.values()), outcomes
+    messages = sorted(message for _, flashed in outcomes.values() for message in flashed)
+    assert messages == (['Appointment booked! Doctor will be notified.']
+                        + ['This time slot is already booked.'] * (THREADS - 1))
+    with evura.app.app_context():
+        assert evura.Appointment.query.filter_by(doctor_id=doctor_id).count() == 1
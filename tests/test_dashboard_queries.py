@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+from conftest import clear_caches, count_queries, engine, evura, log_in
+
+db = evura.db
+
+
+def seed_doctor(name, appointments):
+    """A doctor with one appointment from each of `appointments` different patients"""
+    with evura.app.app_context():
+        doctor = evura.Doctor(username=name, email=f'{name}@example.invalid', password='!',
+                              specialization='Cardiology', hospital='CHUK')
+        patients = [evura.Patient(username=f'{name}-patient-{i}', email=f'{name}-patient-{i}@example.invalid',
+                                  password='!') for i in range(appointments)]
+        db.session.add_all([doctor] + patients)
+        db.session.flush()
+        start = datetime(2025, 1, 6, 9, 0)
+        for i, patient in enumerate(patients):
+            when = start + timedelta(minutes=30 * i)
+            db.session.add(evura.Appointment(
+                patient_id=patient.id, doctor_id=doctor.id, date=when.date().isoformat(),
+                time=when.strftime('%H:%M'), slot_date=when.date(), slot_time=when.time(), reason='Check-up',
+                status=('pending', 'confirmed', 'completed')[i % 3], created_at=when))
+        db.session.commit()
+        return doctor.id
+
+
+def dashboard_statements(client, doctor_id):
+    log_in(client, 'doctor', doctor_id)
+    clear_caches()
+    with count_queries() as statements:
+        response = client.get('/doctor/dashboard')
+    assert response.status_code == 200
+    return statements
+
+
+def test_doctor_dashboard_query_count_does_not_grow_with_appointments(client):
+    few = seed_doctor('dr-few', 2)
+    many = seed_doctor('dr-many', 40)
+    with engine.begin() as conn:
+        evura.rebuild_doctor_stats(conn)
+        evura.backfill_care_access(conn)
+
+    dashboard_statements(client, few)  # warm up anything loaded once per process
+    assert len(dashboard_statements(client, many)) == len(dashboard_statements(client, few))
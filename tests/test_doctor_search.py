@@ -0,0 +1,27 @@
+import pytest
+
+from conftest import evura
+
+db = evura.db
+
+
+@pytest.fixture
+def doctors():
+    with evura.app.app_context():
+        db.session.add_all([evura.Doctor(username=name, email=f'{i}@example.invalid', password='!')
+                            for i, name in enumerate(('Émile', 'émile', 'Mugisha', 'MUKAMANA', 'Uwase'))])
+        db.session.commit()
+        yield
+
+
+@pytest.mark.parametrize('q, expected', [
+    ('mu', ['MUKAMANA', 'Mugisha']),
+    ('MUG', ['Mugisha']),
+    ('é', ['émile']),   # SQLite's lower() leaves 'É' as it is
+    ('É', ['Émile']),
+    ('x', []),
+])
+def test_doctor_name_prefix_search(doctors, q, expected):
+    found = evura.search_doctors(q=q, per_page=50)
+    names = [doctor.username for doctor in found.items]
+    assert sorted(names) == sorted(expected)
@@ -0,0 +1,66 @@
+import io
+import os
+from datetime import datetime
+
+import pytest
+
+from conftest import evura, log_in
+
+db = evura.db
+CONTENT = b'0123456789' * 100
+
+
+@pytest.fixture
+def stored_file(client):
+    """A patient logged in on client with one uploaded file in the real blob store"""
+    digest, size = evura.blob_store.put_stream(io.BytesIO(CONTENT))
+    with evura.app.app_context():
+        patient = evura.Patient(username='downloader', email='downloader@example.invalid', password='!')
+        db.session.add(patient)
+        db.session.flush()
+        medical_file = evura.MedicalFile(patient_id=patient.id, filename=digest, sha256=digest, file_size=size,
+                                         original_filename='scan.dcm', file_type='MRI', file_category='Imaging',
+                                         test_date=datetime(2025, 1, 6))
+        db.session.add(medical_file)
+        db.session.commit()
+        log_in(client, 'patient', patient.id)
+        yield medical_file.id, digest
+    os.remove(evura.blob_store.path_for(digest))
+
+
+def test_download_works_from_any_working_directory(client, stored_file, monkeypatch, tmp_path):
+    file_id, _ = stored_file
+    monkeypatch.chdir(tmp_path)
+    response = client.get(f'/download-medical-file/{file_id}')
+    assert response.status_code == 200 and response.data == CONTENT
+
+
+def test_matching_etag_is_answered_with_304(client, stored_file):
+    file_id, digest = stored_file
+    first = client.get(f'/download-medical-file/{file_id}')
+    assert first.headers['ETag'] == f'"{digest}"'
+    assert 'private' in first.headers['Cache-Control'] and 'no-cache' in first.headers['Cache-Control']
+
+    response = client.get(f'/download-medical-file/{file_id}', headers={'If-None-Match': f'"{digest}"'})
+    assert response.status_code == 304 and response.data == b''
+
+
+def test_range_request_returns_partial_content(client, stored_file):
+    file_id, _ = stored_file
+    response = client.get(f'/download-medical-file/{file_id}', headers={'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-9/{len(CONTENT)}'
+    assert response.data == CONTENT[:10]
+
+
+def test_x_accel_redirect_points_inside_the_offload_prefix(client, stored_file, monkeypatch):
+    file_id, digest = stored_file
+    monkeypatch.setitem(evura.app.config, 'FILE_OFFLOAD', 'x-accel-redirect')
+    monkeypatch.setitem(evura.app.config, 'FILE_OFFLOAD_PREFIX', '/protected-uploads/')
+    response = client.get(f'/download-medical-file/{file_id}')
+    assert response.status_code == 200 and response.data == b''
+    assert response.headers['X-Accel-Redirect'] == f'/protected-uploads/blobs/{digest[:2]}/{digest[2:4]}/{digest}'
+    assert response.headers['ETag'] == f'"{digest}"'
+
+    cached = client.get(f'/download-medical-file/{file_id}', headers={'If-None-Match': f'"{digest}"'})
+    assert cached.status_code == 304 and 'X-Accel-Redirect' not in cached.headers
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import engine, evura
+
+db = evura.db
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    monkeypatch.setitem(evura.app.config, 'EMAIL_MAX_ATTEMPTS', 3)
+    monkeypatch.setitem(evura.app.config, 'EMAIL_RETRY_BASE_SECONDS', 30)
+    with evura.app.app_context():
+        evura.queue_email(to='patient@example.invalid', subject='Appointment Confirmed',
+                          template_name='appointment_confirmed', patient_name='Uwase', doctor_name='Mugisha',
+                          date='2025-03-01', time='10:00')
+        db.session.commit()
+        yield
+
+
+def make_due():
+    """Skip the backoff wait so the next batch retries straight away"""
+    db.session.execute(db.update(evura.EmailOutbox).values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+
+
+def test_failed_sends_back_off_then_dead_letter(outbox):
+    transport = evura.FakeEmailTransport(fail_with=evura.EmailDeliveryError('provider timeout'))
+    for attempt, delay in ((1, 30), (2, 60)):
+        started = datetime.utcnow()
+        assert evura.deliver_outbox_batch(transport) == 1
+        entry = evura.EmailOutbox.query.one()
+        assert (entry.attempts, entry.status, entry.claim_token, entry.last_error) == (
+            attempt, 'pending', None, 'provider timeout')
+        assert started + timedelta(seconds=delay) <= entry.next_attempt_at <= datetime.utcnow() + timedelta(seconds=delay)
+        assert evura.deliver_outbox_batch(transport) == 0  # not due yet
+        make_due()
+
+    assert evura.deliver_outbox_batch(transport) == 1
+    assert evura.EmailOutbox.query.count() == 0
+    dead = evura.EmailDeadLetter.query.one()
+    assert (dead.to_email, dead.attempts, dead.last_error) == ('patient@example.invalid', 3, 'provider timeout')
+    assert transport.sent == []
+
+
+def test_send_succeeds_after_transient_failures(outbox):
+    transport = evura.FakeEmailTransport(fail_with=evura.EmailDeliveryError('rate limited'))
+    evura.deliver_outbox_batch(transport)
+    make_due()
+    transport.fail_with = None
+    assert evura.deliver_outbox_batch(transport) == 1
+    assert evura.EmailOutbox.query.count() == 0 and evura.EmailDeadLetter.query.count() == 0
+    assert [message['to'] for message in transport.sent] == ['patient@example.invalid']
+    assert 'Uwase' in transport.sent[0]['html']
+
+
+def test_permanent_failures_are_dead_lettered_at_once(outbox):
+    transport = evura.FakeEmailTransport(fail_with=evura.EmailDeliveryError('invalid address', permanent=True))
+    evura.deliver_outbox_batch(transport)
+    assert evura.EmailOutbox.query.count() == 0
+    assert evura.EmailDeadLetter.query.one().attempts == 1
+
+
+def test_email_is_queued_in_the_callers_transaction():
+    def committed_emails():
+        with engine.connect() as conn:
+            return conn.execute(db.select(db.func.count()).select_from(evura.EmailOutbox.__table__)).scalar()
+
+    with evura.app.app_context():
+        evura.queue_email(to='doctor@example.invalid', subject='New Appointment Request',
+                          template_name='appointment_request')
+        db.session.rollback()
+        assert evura.EmailOutbox.query.count() == 0
+
+        evura.queue_email(to='doctor@example.invalid', subject='New Appointment Request',
+                          template_name='appointment_request')
+        db.session.flush()
+        assert committed_emails() == 0
+        db.session.commit()
+        assert committed_emails() == 1
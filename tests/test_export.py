@@ -0,0 +1,103 @@
+import io
+import json
+import zipfile
+from datetime import datetime
+
+import pytest
+
+from conftest import evura, log_in
+
+db = evura.db
+
+
+def add_history(patient, doctor, name):
+    """One record of each kind for a patient, and a stored file; returns the file's bytes"""
+    content = f'{name} scan'.encode()
+    digest, size = evura.blob_store.put_stream(io.BytesIO(content))
+    when = datetime(2024, 5, 1)
+    db.session.add_all([
+        evura.TestResult(patient_id=patient.id, test_name=f'{name} HbA1c', test_type='Blood', result_value='6.1 %',
+                         test_date=when),
+        evura.Prescription(patient_id=patient.id, doctor_id=doctor.id, medication_name=f'{name} metformin',
+                           dosage='500 mg', frequency='twice daily', duration='3 months', reason='Diabetes',
+                           start_date=when),
+        evura.MedicalRecord(patient_id=patient.id, doctor_id=doctor.id, diagnosis=f'{name} review',
+                            visit_date='2024-05-01'),
+        evura.MedicalFile(patient_id=patient.id, filename=digest, sha256=digest, file_size=size,
+                          original_filename=f'{name}.png', file_type='X-ray', file_category='Imaging', test_date=when),
+    ])
+    return content
+
+
+@pytest.fixture
+def histories(client, monkeypatch, tmp_path):
+    """Two patients with full histories; the first is logged in on client"""
+    monkeypatch.setattr(evura.blob_store, 'root', str(tmp_path))
+    monkeypatch.setattr(evura.blob_store, 'temp_dir', str(tmp_path / 'tmp'))
+    with evura.app.app_context():
+        doctor = evura.Doctor(username='dr-export', email='dr-export@example.invalid', password='!')
+        mine = evura.Patient(username='exporter', email='exporter@example.invalid', password='secret-hash')
+        other = evura.Patient(username='bystander', email='bystander@example.invalid', password='!')
+        db.session.add_all([doctor, mine, other])
+        db.session.flush()
+        content = add_history(mine, doctor, 'mine')
+        add_history(other, doctor, 'other')
+        db.session.commit()
+        log_in(client, 'patient', mine.id)
+        return mine.id, other.id, content
+
+
+def test_jsonl_export_holds_only_the_patients_rows(client, histories):
+    mine, _, _ = histories
+    response = client.get('/patient/export?format=jsonl')
+    assert response.status_code == 200 and response.is_streamed
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert rows[0]['type'] == 'patient' and rows[0]['data']['id'] == mine
+    assert 'password' not in rows[0]['data']
+    assert sorted(row['type'] for row in rows[1:]) == ['medical_file', 'medical_record', 'prescription',
+                                                       'test_result']
+    assert all(row['data']['patient_id'] == mine for row in rows[1:])
+    assert 'other' not in response.get_data(as_text=True)
+
+
+def test_fhir_export_is_one_bundle_for_the_patient(client, histories):
+    mine, _, _ = histories
+    response = client.get('/patient/export?format=fhir')
+    bundle = json.loads(response.get_data(as_text=True))
+
+    assert (bundle['resourceType'], bundle['type']) == ('Bundle', 'collection')
+    resources = [entry['resource'] for entry in bundle['entry']]
+    assert resources[0] == {**resources[0], 'resourceType': 'Patient', 'id': str(mine)}
+    assert sorted(resource['resourceType'] for resource in resources[1:]) == [
+        'DocumentReference', 'Encounter', 'MedicationRequest', 'Observation']
+    assert all(resource['subject'] == {'reference': f'Patient/{mine}'} for resource in resources[1:])
+
+
+def test_zip_export_contains_the_history_and_only_the_patients_files(client, histories):
+    mine, _, content = histories
+    response = client.get('/patient/export?format=jsonl&files=1')
+    assert response.mimetype == 'application/zip'
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+
+    names = archive.namelist()
+    assert names[0] == 'history.jsonl' and len(names) == 2
+    rows = [json.loads(line) for line in archive.read('history.jsonl').decode().splitlines()]
+    files = [row['data'] for row in rows if row['type'] == 'medical_file']
+    assert [row['data']['patient_id'] for row in rows[1:]] == [mine] * 4
+    assert names[1] == files[0]['archive_path'] == f"files/{files[0]['id']}-mine.png"
+    assert archive.read(names[1]) == content
+
+
+def test_doctor_without_a_grant_cannot_export(histories):
+    mine, _, _ = histories
+    with evura.app.app_context():
+        stranger = evura.Doctor(username='dr-stranger', email='dr-stranger@example.invalid', password='!')
+        db.session.add(stranger)
+        db.session.commit()
+        stranger_id = stranger.id
+    doctor_client = evura.app.test_client()
+    log_in(doctor_client, 'doctor', stranger_id)
+    response = doctor_client.get(f'/doctor/patient-history/{mine}/export?format=jsonl')
+    assert response.status_code == 302 and response.location.endswith('/doctor/dashboard')
@@ -0,0 +1,9 @@
+from conftest import evura
+
+
+def test_pool_is_not_started_without_pillow(monkeypatch):
+    monkeypatch.setitem(evura.app.config, 'FILE_PROCESSING_WORKERS', 2)
+    monkeypatch.setattr(evura.file_processing, 'Image', None)
+    pool = evura.FileProcessingPool(evura.app)
+    pool.wake()
+    assert pool._thread is None and pool._executor is None
@@ -0,0 +1,112 @@
+import hashlib
+import io
+import json
+
+import pytest
+
+from conftest import count_queries, engine, evura
+
+db = evura.db
+TOKEN = 'import-token'
+
+
+@pytest.fixture
+def importer(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(evura.app.config, 'IMPORT_API_TOKEN', TOKEN)
+    monkeypatch.setattr(evura.blob_store, 'root', str(tmp_path))
+    monkeypatch.setattr(evura.blob_store, 'temp_dir', str(tmp_path / 'tmp'))
+    with evura.app.app_context():
+        db.session.add(evura.Patient(username='imported', email='imported@example.invalid', password='!'))
+        db.session.commit()
+
+    def post(rows, record_type=None):
+        body = '\n'.join(row if isinstance(row, str) else json.dumps(row) for row in rows)
+        url = '/api/import/records?format=jsonl' + (f'&type={record_type}' if record_type else '')
+        response = client.post(url, data=body, headers={'Authorization': f'Bearer {TOKEN}'})
+        assert response.status_code == 200
+        return response.get_json()
+    return post
+
+
+def test_row(**fields):
+    return dict({'patient_email': 'imported@example.invalid', 'test_name': 'HbA1c', 'test_type': 'Blood',
+                 'result_value': '6.1 %', 'test_date': '2024-03-01'}, **fields)
+
+
+def file_row(**fields):
+    return dict({'record_type': 'medical_file', 'patient_email': 'imported@example.invalid',
+                 'original_filename': 'scan.png', 'file_type': 'X-ray', 'file_category': 'Imaging',
+                 'test_date': '2024-03-01'}, **fields)
+
+
+def test_medical_file_rows_cannot_point_outside_the_blob_store(importer):
+    report = importer([file_row(filename='/etc/passwd', sha256=None),
+                       file_row(sha256='../../../../etc/hostname'),
+                       file_row(sha256='0' * 64),
+                       file_row(sha256='a' * 64, processing_status='ready')])
+    assert report['imported']['medical_file'] == 0
+    assert [error['line'] for error in report['errors']] == [1, 2, 3, 4]
+    assert report['errors'][0]['error'] == 'cannot import filename'
+    assert report['errors'][1]['error'].endswith('is not a stored file')
+    assert report['errors'][2]['error'].endswith('is not a stored file')
+    assert report['errors'][3]['error'] == 'cannot import processing_status'
+
+
+def test_medical_file_rows_import_a_stored_blob(importer):
+    content = b'scan bytes'
+    digest, size = evura.blob_store.put_stream(io.BytesIO(content))
+    assert digest == hashlib.sha256(content).hexdigest()
+
+    report = importer([file_row(sha256=digest)])
+    assert report['errors'] == [] and report['imported']['medical_file'] == 1
+    with evura.app.app_context():
+        medical_file = evura.MedicalFile.query.one()
+        assert (medical_file.filename, medical_file.file_size, medical_file.processing_status) == (
+            digest, size, 'pending')
+
+
+def test_rejected_lines_are_reported_and_the_rest_imported(importer):
+    report = importer([test_row(),
+                       test_row(result_value=None),
+                       test_row(patient_email='ghost@example.invalid'),
+                       test_row(test_date='01/03/2024'),
+                       '["not", "an", "object"]',
+                       '{"test_name": ',
+                       test_row(record_type='scan'),
+                       test_row(test_date='2024-04-01')], record_type='test_result')
+    assert report['imported']['test_result'] == 2
+    assert report['error_count'] == 6
+    errors = {error['line']: error['error'] for error in report['errors']}
+    assert errors[2] == 'missing result_value'
+    assert errors[3] == 'no patient with email ghost@example.invalid'
+    assert errors[4] == "test_date: invalid value '01/03/2024'"
+    assert errors[5] == 'each line must be a JSON object'
+    assert errors[6].startswith('invalid JSON')
+    assert errors[7].startswith('record_type must be one of')
+    with evura.app.app_context():
+        assert evura.TestResult.query.count() == 2
+        assert evura.LabValue.query.count() == 2
+
+
+def test_rows_are_inserted_in_batches_and_committed_every_commit_rows(importer, monkeypatch):
+    monkeypatch.setitem(evura.app.config, 'IMPORT_BATCH_SIZE', 3)
+    monkeypatch.setitem(evura.app.config, 'IMPORT_COMMIT_ROWS', 5)
+    committed = []
+    commit = evura.RecordImporter.commit
+
+    def counting_commit(self):
+        commit(self)
+        with engine.connect() as conn:  # what another connection can see
+            committed.append(conn.execute(db.select(db.func.count()).select_from(
+                evura.TestResult.__table__)).scalar())
+    monkeypatch.setattr(evura.RecordImporter, 'commit', counting_commit)
+
+    rows = [test_row(test_date=f'2024-01-{day:02d}') for day in range(1, 11)]
+    rows.insert(4, test_row(test_date='not a date'))  # rejected rows do not count towards a batch
+    with count_queries() as statements:
+        report = importer(rows, record_type='test_result')
+
+    assert report['imported']['test_result'] == 10 and report['error_count'] == 1
+    batches = [statement for statement in statements if statement.startswith('INSERT INTO test_result')]
+    assert len(batches) == 4  # 3 + 3 + 3 + 1 rows
+    assert committed == [6, 10]  # once 5 rows are uncommitted, then at the end
@@ -0,0 +1,89 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import engine, evura
+
+db = evura.db
+
+
+def lab_rows(seed=7):
+    """Rows as lab_value_rows returns them, sorted by series then time, with some awkward series mixed in"""
+    rng = random.Random(seed)
+    start = datetime(2020, 1, 1)
+    rows, result_id = [], 0
+    for patient_id in range(1, 6):
+        for test_key, unit, low, high in (('hba1c', '%', 4.0, 5.6), ('ldl', 'mg/dl', None, 130.0),
+                                          ('egfr', 'ml/min', 60.0, None), ('note', None, None, None)):
+            count = rng.choice([1, 2, 3, 8, 20])
+            days = sorted(rng.uniform(0, 1500) for _ in range(count))
+            if count == 2 and patient_id % 2:
+                days = [days[0], days[0]]  # two results on the same day: no slope
+            for day in days:
+                result_id += 1
+                rows.append((patient_id, test_key, unit, start + timedelta(days=day),
+                             round(rng.uniform(2, 200), 2), low, high, result_id, 2458849.5 + day))
+    return rows
+
+
+@pytest.mark.parametrize('window', [1, 3, 5])
+def test_numpy_and_python_lab_trends_match(window):
+    pytest.importorskip('numpy')
+    rows = lab_rows()
+    vectorized = evura.compute_lab_trends(rows, window, use_numpy=True)
+    python = evura.compute_lab_trends(rows, window, use_numpy=False)
+    assert len(vectorized) == len(python)
+    for fast, slow in zip(vectorized, python):
+        assert fast.keys() == slow.keys()
+        for key, value in slow.items():
+            expected = pytest.approx(value) if isinstance(value, (float, list)) else value
+            assert fast[key] == expected, (key, fast, slow)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('7.2 %', (7.2, '%')),
+    ('< 0.5 mg/dL', (0.5, 'mg/dL')),
+    ('5,6 mmol/L', (5.6, 'mmol/L')),
+    ('0,125 mg', (0.125, 'mg')),
+    ('4,500 cells/mcL', (4500.0, 'cells/mcL')),
+    ('1,200 mg', (1200.0, 'mg')),
+    ('1,250,000 cells/uL', (1250000.0, 'cells/uL')),
+    ('12,345.5 IU', (12345.5, 'IU')),
+    ('positive', None),
+])
+def test_parse_lab_value(text, expected):
+    assert evura.parse_lab_value(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('4.0-5.6', (4.0, 5.6)),
+    ('4,0 - 5,6', (4.0, 5.6)),
+    ('4,500-11,000', (4500.0, 11000.0)),
+    ('150,000 to 450,000', (150000.0, 450000.0)),
+    ('< 7', (None, 7.0)),
+    ('> 1,000', (1000.0, None)),
+    ('see report', (None, None)),
+])
+def test_parse_normal_range(text, expected):
+    assert evura.parse_normal_range(text) == expected
+
+
+def test_migration_reparses_values_read_with_a_decimal_comma():
+    with evura.app.app_context():
+        patient = evura.Patient(username='wbc', email='wbc@example.invalid', password='!')
+        db.session.add(patient)
+        db.session.flush()
+        result = evura.TestResult(patient_id=patient.id, test_name='WBC', test_type='Blood',
+                                  result_value='4,500 cells/mcL', normal_range='4,500-11,000',
+                                  test_date=datetime(2025, 1, 6))
+        db.session.add(result)
+        db.session.flush()
+        # As the parser used to store it
+        db.session.add(evura.LabValue(test_result_id=result.id, patient_id=patient.id, test_key='wbc', value=4.5,
+                                      unit='cells/mcL', range_low=4.5, range_high=11.0, measured_at=result.test_date))
+        db.session.commit()
+        with engine.begin() as conn:
+            evura.reparse_comma_lab_values(conn)
+        lab_value = evura.LabValue.query.one()
+        assert (lab_value.value, lab_value.range_low, lab_value.range_high) == (4500.0, 4500.0, 11000.0)
@@ -0,0 +1,74 @@
+import pytest
+
+from conftest import evura
+
+db = evura.db
+PASSWORD = 'correct horse battery staple'
+
+
+@pytest.fixture
+def patient():
+    with evura.app.app_context():
+        user = evura.Patient(username='locked', email='locked@example.invalid',
+                             password=evura.password_hasher.hash(PASSWORD))
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def log_in(client, password, email='locked@example.invalid', ip='198.51.100.7'):
+    return client.post('/login', data={'email': email, 'password': password, 'user_type': 'patient'},
+                       environ_base={'REMOTE_ADDR': ip})
+
+
+def test_account_is_locked_after_too_many_failures(client, patient, monkeypatch):
+    monkeypatch.setitem(evura.app.config, 'LOGIN_MAX_FAILURES_PER_ACCOUNT', 3)
+    for _ in range(3):
+        assert log_in(client, 'wrong').status_code == 200
+    locked = log_in(client, PASSWORD)  # even the right password waits out the lockout
+    assert locked.status_code == 429 and int(locked.headers['Retry-After']) > 0
+    # Other clients of the same account are locked out too
+    assert log_in(client, PASSWORD, ip='203.0.113.50').status_code == 429
+
+
+def test_lockout_ends_when_the_window_passes(client, patient, monkeypatch):
+    monkeypatch.setitem(evura.app.config, 'LOGIN_MAX_FAILURES_PER_ACCOUNT', 3)
+    clock = [1000.0]
+    monkeypatch.setattr(evura, 'monotonic', lambda: clock[0])
+    for _ in range(3):
+        log_in(client, 'wrong')
+    assert log_in(client, PASSWORD).status_code == 429
+    clock[0] += evura.login_throttle.window + 1
+    assert log_in(client, PASSWORD).status_code == 302
+
+
+def test_successful_login_resets_the_account_failures(client, patient, monkeypatch):
+    monkeypatch.setitem(evura.app.config, 'LOGIN_MAX_FAILURES_PER_ACCOUNT', 3)
+    for _ in range(2):
+        log_in(client, 'wrong')
+    assert log_in(client, PASSWORD).status_code == 302
+    for _ in range(2):
+        log_in(client, 'wrong')
+    assert log_in(client, PASSWORD).status_code == 302
+
+
+def test_client_ip_is_throttled_across_accounts(client, patient, monkeypatch):
+    monkeypatch.setitem(evura.app.config, 'LOGIN_MAX_FAILURES_PER_IP', 4)
+    for i in range(4):
+        log_in(client, 'wrong', email=f'guess-{i}@example.invalid')
+    assert log_in(client, PASSWORD).status_code == 429
+    assert log_in(client, PASSWORD, ip='203.0.113.50').status_code == 302
+
+
+def test_low_cost_hash_is_upgraded_on_login(client, patient, monkeypatch):
+    with evura.app.app_context():
+        old_hash = db.session.get(evura.Patient, patient).password
+    assert old_hash.split('$')[2] == '04'
+    monkeypatch.setitem(evura.app.config, 'BCRYPT_LOG_ROUNDS', 5)
+
+    assert log_in(client, PASSWORD).status_code == 302
+    with evura.app.app_context():
+        new_hash = db.session.get(evura.Patient, patient).password
+    assert new_hash.split('$')[2] == '05'
+    assert evura.password_hasher.verify(new_hash, PASSWORD)
+    assert not evura.password_hasher.needs_rehash(new_hash)
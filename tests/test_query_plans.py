@@ -0,0 +1,17 @@
+import pytest
+
+from conftest import engine, evura
+
+with evura.app.app_context():
+    HOT_QUERIES = evura.hot_query_plans()
+
+
+@pytest.mark.parametrize('stmt, index_name', [(stmt, index_name) for _, stmt, index_name in HOT_QUERIES],
+                         ids=[label for label, _, _ in HOT_QUERIES])
+def test_hot_query_uses_its_index(stmt, index_name):
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            # Small tables make the planner prefer sequential scans; ask whether an index path exists
+            conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        plan = evura.explain_query(stmt, conn)
+    assert index_name in plan, plan
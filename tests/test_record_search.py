@@ -0,0 +1,20 @@
+from datetime import datetime
+
+from conftest import evura
+
+db = evura.db
+
+
+def test_like_search_treats_underscores_literally():
+    with evura.app.app_context():
+        patient = evura.Patient(username='searcher', email='searcher@example.invalid', password='!')
+        db.session.add(patient)
+        db.session.flush()
+        for name in ('panel_a', 'panelxa'):
+            db.session.add(evura.TestResult(patient_id=patient.id, test_name=name, test_type='Blood',
+                                            result_value='normal', test_date=datetime(2025, 1, 6)))
+        db.session.commit()
+
+        hits = evura._search_like(patient.id, evura.search_terms('PANEL_A'), 10, 0)
+        names = [db.session.get(evura.TestResult, row_id).test_name for kind, row_id in hits]
+        assert names == ['panel_a']
@@ -0,0 +1,63 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import evura
+
+db = evura.db
+NOW = datetime(2025, 1, 6, 8, 0)
+
+
+@pytest.fixture
+def appointments():
+    """Appointments around NOW; only the two confirmed ones within 24 hours are due a reminder"""
+    with evura.app.app_context():
+        doctor = evura.Doctor(username='dr-remind', email='dr-remind@example.invalid', password='!', hospital='CHUK')
+        db.session.add(doctor)
+        db.session.flush()
+        for i, (hours, status) in enumerate(((2, 'confirmed'), (20, 'confirmed'), (30, 'confirmed'),
+                                             (3, 'pending'), (-1, 'confirmed'))):
+            patient = evura.Patient(username=f'remind-{i}', email=f'remind-{i}@example.invalid', password='!')
+            db.session.add(patient)
+            db.session.flush()
+            when = NOW + timedelta(hours=hours)
+            db.session.add(evura.Appointment(
+                patient_id=patient.id, doctor_id=doctor.id, date=when.date().isoformat(),
+                time=when.strftime('%H:%M'), slot_date=when.date(), slot_time=when.time(), status=status))
+        db.session.commit()
+
+
+def reminded():
+    return sorted(entry.to_email for entry in evura.EmailOutbox.query.filter_by(template_name='appointment_reminder'))
+
+
+def test_running_the_scheduler_twice_reminds_each_appointment_once(appointments):
+    with evura.app.app_context():
+        assert evura.queue_appointment_reminders(NOW, batch_size=1) == 2
+        assert evura.queue_appointment_reminders(NOW, batch_size=1) == 0
+        assert reminded() == ['remind-0@example.invalid', 'remind-1@example.invalid']
+
+        # The next day's appointment comes due later, and only it is queued
+        assert evura.queue_appointment_reminders(NOW + timedelta(hours=12)) == 1
+        assert reminded() == ['remind-0@example.invalid', 'remind-1@example.invalid', 'remind-2@example.invalid']
+
+
+def test_concurrent_schedulers_queue_each_reminder_once(appointments):
+    queued = []
+    barrier = threading.Barrier(4)
+
+    def scheduler():
+        with evura.app.app_context():
+            barrier.wait()
+            queued.append(evura.queue_appointment_reminders(NOW, batch_size=1))
+
+    workers = [threading.Thread(target=scheduler) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert sum(queued) == 2
+    with evura.app.app_context():
+        assert reminded() == ['remind-0@example.invalid', 'remind-1@example.invalid']
@@ -0,0 +1,25 @@
+import html
+import json
+
+from conftest import evura, log_in
+
+db = evura.db
+
+
+def test_revoke_confirmation_escapes_the_doctor_name(client):
+    name = "O'Brien'); alert(document.cookie); ('"
+    with evura.app.app_context():
+        doctor = evura.Doctor(username=name, email='obrien@example.invalid', password='!')
+        patient = evura.Patient(username='grantee', email='grantee@example.invalid', password='!')
+        db.session.add_all([doctor, patient])
+        db.session.flush()
+        evura.grant_care_access(doctor.id, patient.id)
+        db.session.commit()
+        log_in(client, 'patient', patient.id)
+
+    page = client.get('/patient/profile').get_data(as_text=True)
+    handler = page.split("onsubmit='", 1)[1].split("'>", 1)[0]
+    # The attribute holds exactly one JSON string, so the name cannot close it and inject script
+    script = html.unescape(handler)
+    assert script.startswith('return confirm(') and script.endswith(');')
+    assert json.loads(script[len('return confirm('):-len(');')]) == f"Revoke Dr. {name}'s access to your records?"
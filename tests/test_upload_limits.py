@@ -0,0 +1,47 @@
+import io
+
+import pytest
+
+from conftest import evura, log_in
+
+db = evura.db
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def patient_client(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(evura.app.config, 'MAX_CONTENT_LENGTH', 1 * MB)
+    monkeypatch.setitem(evura.app.config, 'MAX_UPLOAD_MB', 4)
+    monkeypatch.setattr(evura.blob_store, 'root', str(tmp_path))
+    monkeypatch.setattr(evura.blob_store, 'temp_dir', str(tmp_path / 'tmp'))
+    with evura.app.app_context():
+        patient = evura.Patient(username='uploader', email='uploader@example.invalid', password='!')
+        db.session.add(patient)
+        db.session.commit()
+        log_in(client, 'patient', patient.id)
+    return client
+
+
+def upload(client, size):
+    return client.post('/patient/upload-records', data={
+        'medical_file': (io.BytesIO(b'\0' * size), 'scan.png'), 'file_type': 'Imaging', 'file_category': 'scan',
+        'test_date': '2025-01-06'}, content_type='multipart/form-data')
+
+
+def test_upload_view_accepts_bodies_over_the_global_limit(patient_client):
+    response = upload(patient_client, 2 * MB)
+    assert response.status_code == 302 and response.location.endswith('/patient/medical-records')
+    with evura.app.app_context():
+        assert evura.MedicalFile.query.one().file_size == 2 * MB
+
+
+def test_upload_view_rejects_bodies_over_max_upload_mb(patient_client):
+    response = upload(patient_client, 5 * MB)
+    assert response.status_code == 302 and response.location.endswith('/patient/upload-records')
+    with evura.app.app_context():
+        assert evura.MedicalFile.query.count() == 0
+
+
+def test_other_views_keep_the_global_limit(patient_client):
+    response = patient_client.post('/login', data={'email': 'x' * (2 * MB), 'password': '!', 'user_type': 'patient'})
+    assert response.status_code == 413